@@ -1,8 +1,33 @@
+from functools import reduce
+from operator import xor
+
 from migen import *
 
 
-# increment this if the behavior (LEDs, registers, EEM pins) changes
-__proto_rev__ = 8
+# increment this if the behavior (LEDs, registers, EEM pins) of the default
+# build changes
+__proto_rev__ = 9
+
+# builds with protocol options report PROTO_REV_OPTIONS | (1 << i) for each
+# option OPTIONS[i] instead of __proto_rev__ (see Urukul)
+PROTO_REV_OPTIONS = 0x40
+OPTIONS = ("registered_miso", "att_sel", "status_poll",
+        "status_events", "io_update_seq", "cfg_mask")
+
+
+def protocol_revision(**options):
+    """Protocol revision reported by a build with the :data:`OPTIONS` given
+    as keyword arguments"""
+    bits = 0
+    for k, v in options.items():
+        if k not in OPTIONS:
+            raise ValueError("unknown option", k)
+        if v:
+            bits |= 1 << OPTIONS.index(k)
+    return PROTO_REV_OPTIONS | bits if bits else __proto_rev__
+
+# default test point assignment (see Urukul)
+TP = ("dds0.cs_n", "dds0.sck", "dds0.sdi", "dds0.sdo", "dds0.drover")
 
 
 class SR(Module):
@@ -23,11 +48,33 @@ class SR(Module):
       is loaded into the shift register
     * following at least one rising clock edge, on the deassertion of SEL,
       the shift register is loaded into the parallel data register DI
+
+    With ``short`` (a bit count):
+
+    * the first output bit is the MSB of DO (combinatorially until the first
+      rising edge)
+    * DI is only loaded if there were at least ``short`` rising clock edges
+      with SEL asserted. Shorter transfers are read-only.
+
+    With ``mask`` (a list of ``(start, stop)`` DI slices), a transfer of at
+    least ``len(mask)`` bits more than the highest slice stop is a masked
+    write: the last ``len(mask)`` bits are the mask, the bits before it the
+    data. Only the DI slices with their mask bit set (mask bit ``i`` for
+    slice ``i``) are loaded from the data.
+
+    With ``ext`` (a ``(start, stop)`` DI slice), DI[start:] is only loaded
+    by transfers of at least ``stop`` bits. Shorter transfers leave it
+    unchanged (their bits above ``start`` are stale DO bits).
+
+    ``FULL`` (valid in the LE domain) indicates a transfer of at least
+    ``width`` bits. It is always asserted unless ``short``, ``count``,
+    ``mask`` or ``ext``.
     """
-    def __init__(self, width):
+    def __init__(self, width, short=0, count=False, mask=(), ext=None):
         self.sdi = Signal()
         self.sdo = Signal()
         self.sel = Signal()
+        self.full = Signal()
 
         self.di = Signal(width)
         self.do = Signal(width)
@@ -44,12 +91,17 @@ class SR(Module):
                 i_D=0, i_C=ClockSignal("sck1"), i_CE=self.sel, i_PRE=~self.sel,
                 o_Q=self.cd_le.clk)
 
+        sdo = Signal()
         self.sync.sck0 += [
                 If(self.sel,
-                    self.sdo.eq(sr[-1]),
+                    sdo.eq(sr[-1]),
 
                 )
         ]
+        if short:
+            self.comb += self.sdo.eq(Mux(self.cd_le.clk, self.do[-1], sdo))
+        else:
+            self.comb += self.sdo.eq(sdo)
         self.sync.sck1 += [
                 If(self.sel,
                     sr[0].eq(self.sdi),
@@ -60,9 +112,39 @@ class SR(Module):
                     )
                 )
         ]
-        self.sync.le += [
-                self.di.eq(sr)
-        ]
+        if short or count or mask or ext:
+            # rising clock edges while selected, saturating
+            n = Signal(max=width + 1)
+            self.sync.sck1 += [
+                    If(self.sel,
+                        If(self.cd_le.clk,
+                            n.eq(1)
+                        ).Elif(n != width,
+                            n.eq(n + 1)
+                        )
+                    )
+            ]
+            self.comb += self.full.eq(n == width)
+        else:
+            self.comb += self.full.eq(1)
+        if ext:
+            start, stop = ext
+            load = [self.di[:start].eq(sr[:start]),
+                    If(n >= stop,
+                        self.di[start:].eq(sr[start:])
+                    )]
+        else:
+            load = [self.di.eq(sr)]
+        if short:
+            load = [If(n >= short, *load)]
+        if mask:
+            m = len(mask)
+            load = [If(n >= max(stop for start, stop in mask) + m,
+                        [If(sr[i], self.di[start:stop].eq(
+                            sr[m + start:m + stop]))
+                         for i, (start, stop) in enumerate(mask)]
+                    ).Else(*load)]
+        self.sync.le += load
 
 
 class CFG(Module):
@@ -77,8 +159,10 @@ class CFG(Module):
     |-----------+-------+-------------------------------------------------|
     | RF_SW     | 4     | Activates RF switch per channel                 |
     | LED       | 4     | Activates the red LED per channel               |
-    | PROFILE   | 3     | Controls DDS[0:3].PROFILE[0:2]                  |
-    | DUMMY     | 1     | Reserved (used in a previous revision)          |
+    | PROFILE   | 3     | Controls DDS[0:3].PROFILE[0:2] (unless          |
+    |           |       | EN_PROFILE)                                     |
+    | DUMMY     | 1     | Reserved (used in a previous revision), POLL    |
+    |           |       | with ``status_poll``: poll ordered status       |
     | IO_UPDATE | 1     | Asserts DDS[0:3].IO_UPDATE where CFG.MASK_NU    |
     |           |       | is high                                         |
     | MASK_NU   | 4     | Disables DDS from QSPI interface, disables      |
@@ -94,18 +178,34 @@ class CFG(Module):
     | DIV       | 2     | Clock divider configuration: 0: default,        |
     |           |       | 1: divide-by-one, 2: divider-by-two,            |
     |           |       | 3: divide-by-four                               |
+    | ATT_EN    | 4     | Only with ``att_sel``: attenuators in the ATT   |
+    |           |       | shift chain and latched on deselection          |
+    |           |       | (0: all)                                        |
+    | UPD_DLY   | 16    | Only with ``io_update_seq``: IO_UPDATE delay    |
+    |           |       | per channel in SYNC_CLK cycles (4 bits each)    |
+
+    ``fields`` lists the bit slices ``(start, stop)`` of the fields that can
+    be written individually by a masked write (all but DUMMY, in the order
+    above, POLL included). ``ext`` is the ``(start, stop)`` slice of the
+    optional fields (ATT_EN, UPD_DLY) or ``None``. They are only written by
+    transfers of at least ``stop`` bits: a standard 24 bit write leaves them
+    unchanged.
+
+    ``n`` is the number of channels (the width of the per channel fields).
+    Without ``eem1``, EEM1.SW[0:3] are not used.
     """
-    def __init__(self, platform, n=4):
-        self.data = Record([
+    def __init__(self, platform, n=4, att_sel=False, io_update_seq=False,
+            eem1=True, poll=False):
+        layout = [
             ("rf_sw", n),
             ("led", n),
 
             ("profile", 3),
 
-            ("dummy", 1),
+            ("poll" if poll else "dummy", 1),
             ("io_update", 1),
 
-            ("mask_nu", 4),
+            ("mask_nu", n),
 
             ("clk_sel0", 1),
             ("sync_sel", 1),
@@ -114,12 +214,27 @@ class CFG(Module):
             ("io_rst", 1),
             ("clk_sel1", 1),
             ("div", 2),
-        ])
+        ]
+        base = sum(width for name, width in layout)
+        if att_sel:
+            layout.append(("att_en", n))
+        if io_update_seq:
+            layout.append(("upd_dly", 4*n))
+        self.data = Record(layout)
+        self.ext = (base, len(self.data)) if len(self.data) > base else None
+        self.fields = []
+        offset = 0
+        for name, width in layout:
+            if name != "dummy":
+                self.fields.append((offset, offset + width))
+            offset += width
         dds_common = platform.lookup_request("dds_common")
         dds_sync = platform.lookup_request("dds_sync")
         att = platform.lookup_request("att")
         clk = platform.lookup_request("clk")
         self.en_9910 = Signal()
+        self.en_profile = Signal()
+        self.profile = Signal(3)
 
         self.comb += [
                 clk.in_sel.eq(self.data.clk_sel0),
@@ -132,21 +247,113 @@ class CFG(Module):
         ]
 
         for i in range(n):
-            sw = platform.request("eem", 12 + i)
             dds = platform.lookup_request("dds", i)
+            if eem1:
+                sw = platform.request("eem", 12 + i)
+                self.comb += sw.oe.eq(0)
+                sw = sw.io
+            else:
+                sw = 0
             self.comb += [
-                    sw.oe.eq(0),
-                    dds.rf_sw.eq(sw.io | self.data.rf_sw[i]),
+                    dds.rf_sw.eq(sw | self.data.rf_sw[i]),
                     dds.led[0].eq(dds.rf_sw),  # green
                     dds.led[1].eq(self.data.led[i] | (self.en_9910 & (
                         dds.smp_err | ~dds.pll_lock))),  # red
-                    dds.profile.eq(self.data.profile),
+                    dds.profile.eq(Mux(self.en_profile, self.profile,
+                        self.data.profile)),
                     dds.osk.eq(1),
                     dds.drhold.eq(0),
                     dds.drctl.eq(0),
             ]
 
 
+class IOUpdate(Module):
+    """IO_UPDATE sequencer
+
+    * runs on rising SYNC_CLK edges (``sync_clk`` domain)
+    * TRIGGER is registered, the sequence starts on its rising edge
+    * IO_UPDATE[i] is asserted for one cycle, DELAY[i] cycles after the
+      start
+    * IO_UPDATE[i] is asserted (DELAY[i] + 2) SYNC_CLK cycles after the
+      first edge sampling TRIGGER high
+    * triggers during a running sequence are ignored
+    """
+    def __init__(self, n=4, width=4):
+        self.trigger = Signal()
+        self.delay = [Signal(width) for i in range(n)]
+        self.io_update = Signal(n)
+
+        # # #
+
+        trigger = Signal(2)
+        t = Signal(width)
+        busy = Signal()
+        self.sync.sync_clk += [
+                trigger.eq(Cat(self.trigger, trigger[0])),
+                If(busy,
+                    t.eq(t + 1),
+                    If(t == 2**width - 1,
+                        busy.eq(0)
+                    )
+                ).Elif(trigger[0] & ~trigger[1],
+                    busy.eq(1),
+                    t.eq(0)
+                ),
+                [self.io_update[i].eq(busy & (t == self.delay[i]))
+                    for i in range(n)]
+        ]
+
+
+class EventCounter(Module):
+    """Sticky saturating event counter
+
+    Counts rising edges of EVENT (the clock of the ``event`` domain) in a Gray
+    code counter. COUNT is the number of events since the last completed
+    read, saturating at ``2**width - 1``.
+
+    * LOAD (SCK1 domain) takes a snapshot of the counter when COUNT is read
+    * ACK (LE domain) completes the read: the snapshot events are cleared,
+      later events are kept
+    * an event coincident with the LOAD edge may be counted in either read
+    """
+    def __init__(self, width=2):
+        self.event = Signal()
+        self.load = Signal()
+        self.ack = Signal()
+        self.count = Signal(width)
+
+        # # #
+
+        self.clock_domains.cd_event = ClockDomain("event", reset_less=True)
+        self.comb += self.cd_event.clk.eq(self.event)
+
+        gray = Signal(width)
+        binary = Signal(width)
+        nxt = Signal(width)
+        snap = Signal(width)
+        seen = Signal(width)
+        self.comb += [
+                [binary[i].eq(reduce(xor, gray[i:])) for i in range(width)],
+                nxt.eq(binary + 1),
+                self.count.eq(binary - seen),
+        ]
+        self.sync.event += [
+                If(self.count != 2**width - 1,
+                    gray.eq(nxt ^ nxt[1:])
+                )
+        ]
+        self.sync.sck1 += [
+                If(self.load,
+                    snap.eq(binary)
+                )
+        ]
+        self.sync.le += [
+                If(self.ack,
+                    seen.eq(snap)
+                )
+        ]
+
+
 class Status(Module):
     """Status register.
 
@@ -163,19 +370,59 @@ class Status(Module):
     | IFC_MODE  | 4     | IFC_MODE[0:3]                             |
     | PROTO_REV | 7     | Protocol revision (see __proto_rev__)     |
     | DUMMY     | 1     | Not used, not usable, undefined           |
+
+    With ``poll``, ``poll`` is the status with the time critical bits moved
+    to the MSBs (shifted out first). Its bits from LSB to MSB are:
+
+    | Name      | Width | Function                                  |
+    |-----------+-------+-------------------------------------------|
+    | IFC_MODE  | 4     | IFC_MODE[0:3]                             |
+    | PROTO_REV | 7     | Protocol revision (see __proto_rev__)     |
+    | DUMMY     | 1     | Not used, reads as 0                      |
+    | RF_SW     | 4     | Actual RF switch and green LED activation |
+    | SMP_ERR   | 4     | DDS[0:3].SMP_ERR                          |
+    | PLL_LOCK  | 4     | DDS[0:3].PLL_LOCK                         |
+
+    With ``events``, the status is extended by sticky per channel event
+    counters in the LSBs (the above bits are shifted out first). The bits
+    from LSB to MSB are:
+
+    | Name         | Width | Function                                  |
+    |--------------+-------+-------------------------------------------|
+    | SMP_ERR_CNT  | 8     | DDS[0:3].SMP_ERR rising edges             |
+    | UNLOCK_CNT   | 8     | DDS[0:3].PLL_LOCK falling edges           |
+    | ...          | 24    | as above                                  |
+
+    Each counter is two bits wide (channel i at bits 2*i and 2*i + 1) and
+    saturates at 3. The counters are cleared on read by a full width
+    transfer (see :class:`EventCounter`), shorter transfers do not clear
+    them. ``event_domains`` maps the event clock domains to their clocks.
+
+    ``n`` is the number of channels, ``proto_rev`` the reported protocol
+    revision.
     """
-    def __init__(self, platform, n=4):
-        self.data = Record([
+    def __init__(self, platform, n=4, poll=False, events=False,
+            proto_rev=__proto_rev__):
+        layout = [
             ("rf_sw", n),
             ("smp_err", n),
             ("pll_lock", n),
             ("ifc_mode", 4),
             ("proto_rev", 7),
             ("dummy", 1)
-        ])
+        ]
+        if events:
+            layout = [("smp_err_cnt", 2*n), ("unlock_cnt", 2*n)] + layout
+        self.data = Record(layout)
+        if poll:
+            fields = [getattr(self.data, name) for name, _ in layout]
+            self.poll = Cat(*(fields[:-6] + fields[-3:] + fields[-6:-3]))
+        self.load = Signal()
+        self.ack = Signal()
+        self.event_domains = dict()
         self.comb += [
                 self.data.ifc_mode.eq(platform.lookup_request("ifc_mode")),
-                self.data.proto_rev.eq(__proto_rev__),
+                self.data.proto_rev.eq(proto_rev),
                 # self.data.hw_rev.eq(platform.request("hw_rev")),
         ]
         for i in range(n):
@@ -185,6 +432,22 @@ class Status(Module):
                     self.data.smp_err[i].eq(dds.smp_err),
                     self.data.pll_lock[i].eq(dds.pll_lock),
             ]
+            if not events:
+                continue
+            for field, event in [("smp_err_cnt", dds.smp_err),
+                                 ("unlock_cnt", ~dds.pll_lock)]:
+                domain = "{}{}".format(field[:-4], i)
+                counter = ClockDomainsRenamer({"event": domain})(
+                        EventCounter())
+                self.submodules += counter
+                self.event_domains[domain] = counter.event
+                self.comb += [
+                        counter.event.eq(event),
+                        counter.load.eq(self.load),
+                        counter.ack.eq(self.ack),
+                        getattr(self.data, field)[2*i:2*i + 2].eq(
+                            counter.count),
+                ]
 
 
 class Urukul(Module):
@@ -214,24 +477,24 @@ class Urukul(Module):
     high resolution RF switching and synchronization signals. NU-Servo mode
     always requires two EEM connectors.
 
-    | EEM  | LVDS pair | PCB net | Function                |
-    |------+-----------+---------+-------------------------|
-    | EEM0 | 0         | A0      | SCLK                    |
-    | EEM0 | 1         | A1      | MOSI                    |
-    | EEM0 | 2         | A2      | MISO, NU_CLK            |
-    | EEM0 | 3         | A3      | CS0                     |
-    | EEM0 | 4         | A4      | CS1                     |
-    | EEM0 | 5         | A5      | CS2, NU_CS              |
-    | EEM0 | 6         | A6      | IO_UPDATE               |
-    | EEM0 | 7         | A7      | DDS_RESET, SYNC_OUT     |
-    | EEM1 | 0         | B8      | SYNC_CLK, NU_MOSI0      |
-    | EEM1 | 1         | B9      | SYNC_IN, NU_MOSI1       |
-    | EEM1 | 2         | B10     | IO_UPDATE_RET, NU_MOSI2 |
-    | EEM1 | 3         | B11     | NU_MOSI3                |
-    | EEM1 | 4         | B12     | SW0                     |
-    | EEM1 | 5         | B13     | SW1                     |
-    | EEM1 | 6         | B14     | SW3                     |
-    | EEM1 | 7         | B15     | SW4                     |
+    | EEM  | LVDS pair | PCB net | Function                          |
+    |------+-----------+---------+-----------------------------------|
+    | EEM0 | 0         | A0      | SCLK                              |
+    | EEM0 | 1         | A1      | MOSI                              |
+    | EEM0 | 2         | A2      | MISO, NU_CLK                      |
+    | EEM0 | 3         | A3      | CS0                               |
+    | EEM0 | 4         | A4      | CS1                               |
+    | EEM0 | 5         | A5      | CS2, NU_CS                        |
+    | EEM0 | 6         | A6      | IO_UPDATE                         |
+    | EEM0 | 7         | A7      | DDS_RESET, SYNC_OUT               |
+    | EEM1 | 0         | B8      | SYNC_CLK, NU_MOSI0                |
+    | EEM1 | 1         | B9      | SYNC_IN, NU_MOSI1, PROFILE0       |
+    | EEM1 | 2         | B10     | IO_UPDATE_RET, NU_MOSI2, PROFILE1 |
+    | EEM1 | 3         | B11     | NU_MOSI3, PROFILE2                |
+    | EEM1 | 4         | B12     | SW0                               |
+    | EEM1 | 5         | B13     | SW1                               |
+    | EEM1 | 6         | B14     | SW3                               |
+    | EEM1 | 7         | B15     | SW4                               |
 
     IFC_MODE
     --------
@@ -239,12 +502,13 @@ class Urukul(Module):
     DIP switches are used to configure the operation of the Urukul CPLD. The
     four IFC mode switches are assigned as:
 
-    | IFC_MODE | Name    | Function                                        |
-    |----------+---------+-------------------------------------------------|
-    | 0        | EN_9910 | On if AD9910 is populated (OR VARIANT)          |
-    | 1        | EN_NU   | On if NU-Servo mode is used                     |
-    | 2        | EN_EEM1 | On if the SYNC signals on EEM1 should be driven |
-    | 3        | UNUSED  | Unusable on Urukul/v1.0                         |
+    | IFC_MODE | Name       | Function                                        |
+    |----------+------------+-------------------------------------------------|
+    | 0        | EN_9910    | On if AD9910 is populated (OR VARIANT)          |
+    | 1        | EN_NU      | On if NU-Servo mode is used                     |
+    | 2        | EN_EEM1    | On if the SYNC signals on EEM1 should be driven |
+    | 3        | EN_PROFILE | On if DDS PROFILE is driven from EEM1 (unusable |
+    |          |            | on Urukul/v1.0)                                 |
 
     On Urukul/v1.0, IFC_MODE[0] | IFC_MODE[3] drive EN_9910.
     On Urukul/v1.1, IFC_MODE[0] | VARIANT (board population) drive EN_9910.
@@ -329,6 +593,15 @@ class Urukul(Module):
     data from the attenuator shift register is transferred to the active
     attenuation register on the de-selection of the attenuators after shifting.
 
+    With ``att_sel``, CFG is extended by ATT_EN (CFG and the CFG/Status shift
+    register become 28 bits wide, the status is MSB aligned). ATT_EN is only
+    written by 28 bit CFG transfers, a standard 24 bit transfer reads the
+    standard status and leaves it unchanged. Shorter transfers write the
+    standard fields as without the option. Only the attenuators enabled in
+    ATT_EN see LE asserted and are part of the chain, the others are bypassed
+    and keep their attenuation. A single channel update is an 8 bit transfer.
+    ATT_EN = 0 enables all four (the 32 bit chain).
+
     Clocking
     --------
 
@@ -349,6 +622,17 @@ class Urukul(Module):
 
     If CFG.DIV is 1, 2, or 3 it determines the clock divisor (1, 2, 4).
 
+    The divider is configured through the tri-state CLK_DIV pin (Z: divide
+    by 1, 0: divide by 2, 1: divide by 4):
+
+    | CFG.DIV | EN_9910 | Divisor | CLK_DIV |
+    |---------+---------+---------+---------|
+    | 0       | 0       | 1       | Z       |
+    | 0       | 1       | 4       | 1       |
+    | 1       | X       | 1       | Z       |
+    | 2       | X       | 2       | 0       |
+    | 3       | X       | 4       | 1       |
+
     Synchronization
     ---------------
 
@@ -368,6 +652,14 @@ class Urukul(Module):
     IO_UPDATE_RET would need to be performed. SYNC_IN is an output from Urukul,
     an input to the controlling upstream FPGA, and an input to all DDS.
 
+    Profile
+    -------
+
+    With EN_PROFILE (and not EN_NU), DDS[0:3].PROFILE[0:2] are driven
+    directly (combinatorially) from EEM1 PROFILE[0:2] instead of CFG.PROFILE.
+    This allows profile switching without an SPI transaction. SYNC_IN and
+    IO_UPDATE_RET are unavailable then (their EEM1 pairs are inputs).
+
     RF switches
     -----------
 
@@ -383,13 +675,134 @@ class Urukul(Module):
     ~DDS[0:3].PLL_LOCK))``. I.e. they are lit by the register or (logic OR) an
     synchronization/PLL error on that channel's DDS.
 
+    Registered MISO
+    ---------------
+
+    With ``registered_miso``, MISO is driven from a register that samples the
+    selected device's serial output on each falling SCK edge. MISO then only
+    changes a register clock-to-out after the falling SCK edge and the device
+    SDO is sampled a full SCK cycle after the edge that shifted it out.
+
+    This shortens the path the SPI master sees within the half SCK cycle
+    between shifting and sampling. Without the option it is the combinatorial
+    MISO multiplexer (6 gate levels, see ``urukul_timing.py --compare
+    registered_miso``) and, for DDS readback, the device round trip (SCK pad
+    to DDS SCK, DDS SDO, DDS SDO pad to MISO, 6.2 ns + 6.9 ns pad to pad in
+    the reference fit). With the option it is the clock-to-out of a single
+    macrocell: the build constrains MISO to 11 ns after SCK (``OFFSET =
+    OUT``, the single level SCK0 clock-to-out of the reference fit is
+    10.9 ns), and the device round trip is moved into the full SCK cycle
+    before the MISO register. The fitter timing report of the build shows
+    whether the constraint is met.
+
+    All readback data is delayed by one SCK cycle: the first bit sampled by
+    the master is stale and the readback of an n bit transfer takes n + 1
+    clock cycles (the extra bit is shifted in first and falls off the
+    CFG/ATT shift registers).
+
+    Status poll
+    -----------
+
+    With ``status_poll``, a CFG transfer (CS = 1) shorter than the standard
+    CFG fields (24 bits) is a read-only status poll: CFG is only updated by
+    transfers of at least 24 bits. CFG.POLL (the DUMMY bit) selects the order
+    of the status: clear (as written by hosts unaware of the option), the
+    status is read in the standard order with PROTO_REV in place. Set, it is
+    read in the poll order (see :class:`Status`). The first MISO bit is
+    defined. In the poll order, an 8 bit poll returns PLL_LOCK[3:0] and
+    SMP_ERR[3:0] (in that order, MSB first), a 12 bit poll additionally
+    RF_SW[3:0].
+
+    IO_UPDATE sequencer
+    -------------------
+
+    With ``io_update_seq``, a rising edge of the IO_UPDATE EEM signal starts a
+    sequencer clocked by DDS_SYNC_CLK0 (the AD9910 SYNC_CLK, SYSCLK/4). It
+    pulses DDS[i].IO_UPDATE for one SYNC_CLK cycle, CFG.UPD_DLY[i] cycles
+    after the start, for those DDS not masked by CFG.MASK_NU (see
+    :class:`IOUpdate` for the latency). CFG is extended by UPD_DLY (16 bits,
+    a 40 bit CFG transfer). A standard 24 bit transfer leaves UPD_DLY
+    unchanged and reads the standard status, shorter transfers write the
+    standard fields as without the option.
+    Without EN_9910 (no SYNC_CLK), IO_UPDATE is passed through as before.
+
+    Status events
+    -------------
+
+    With ``status_events``, the status is extended by 16 bits of sticky
+    SMP_ERR and PLL unlock event counters (see :class:`Status`), shifted out
+    after the standard 24 status bits. The CFG/Status shift register becomes
+    40 bits wide. A 40 bit CFG transfer reads and clears the counters, a
+    standard 24 bit transfer reads the standard status and leaves them.
+
+    CFG masked write
+    ----------------
+
+    With ``cfg_mask``, a CFG transfer of the CFG bits followed by one mask
+    bit per CFG field (see :class:`CFG`, 11 bits for the standard CFG, a 35
+    bit transfer) is a masked write: only the fields with their mask bit set
+    are updated. Mask bit 0 (RF_SW) is the last bit transferred. Shorter
+    transfers are plain writes of all fields. The status is MSB aligned in
+    the shift register (a 24 bit transfer reads the standard status). With
+    ``status_poll`` the POLL bit is a field as well (12 mask bits). With
+    ``status_events`` the 40 bit event read is a masked write (an all zero
+    mask leaves CFG unchanged).
+
+    Protocol revision
+    -----------------
+
+    The default build reports ``__proto_rev__`` in Status.PROTO_REV. Builds
+    with any of the protocol options in :data:`OPTIONS` report
+    ``PROTO_REV_OPTIONS`` (bit 6 set) with bit ``i`` set for option
+    ``OPTIONS[i]`` instead (see :func:`protocol_revision`), so hosts that
+    only know the default layout reject them and option aware hosts can
+    detect the options from a standard 24 bit status read:
+
+    | PROTO_REV bit | Option          |
+    |---------------+-----------------|
+    | 0             | registered_miso |
+    | 1             | att_sel         |
+    | 2             | status_poll     |
+    | 3             | status_events   |
+    | 4             | io_update_seq   |
+    | 5             | cfg_mask        |
+    | 6             | any option      |
+
     Test points
     -----------
 
     The test points expose miscellaneous signals for debugging and are not part
-    of the protocol revision.
+    of the protocol revision. ``tp`` assigns them (see :data:`TP`).
+
+    Variants
+    --------
+
+    Board and fork variants are generator parameters:
+
+    * ``n``: number of populated channels (DDS, attenuators, RF switches).
+      The per channel CFG and Status fields are ``n`` bits wide, CS for
+      absent DDS selects nothing and reads 0, the attenuator chain is ``n``
+      chips long.
+    * ``proto_rev``: protocol revision reported in the status (default:
+      :func:`protocol_revision` of the options)
+    * ``eem1``: EEM1 connected. Without it, EN_NU, EN_EEM1 and EN_PROFILE
+      are off (IFC_MODE[1:3] are ignored but still reported) and
+      EEM1.SW[0:3] are not used.
+    * ``tp``: test point assignment, one name (``ddsI.FIELD``,
+      ``att.FIELD`` or ``eemI``, single bit signals) or ``None`` (driven
+      low) per test point
     """
-    def __init__(self, platform):
+    def __init__(self, platform, registered_miso=False, att_sel=False,
+            status_poll=False, status_events=False, io_update_seq=False,
+            cfg_mask=False, n=4, proto_rev=None, eem1=True,
+            tp=None):
+        if proto_rev is None:
+            proto_rev = protocol_revision(registered_miso=registered_miso,
+                    att_sel=att_sel, status_poll=status_poll,
+                    status_events=status_events, io_update_seq=io_update_seq,
+                    cfg_mask=cfg_mask)
+        self.proto_rev = proto_rev
+
         clk = platform.request("clk")
         dds_sync = platform.request("dds_sync")
         dds_common = platform.request("dds_common")
@@ -397,7 +810,7 @@ class Urukul(Module):
         variant = platform.request("variant")
         att = platform.request("att")
         fsen = platform.request("fsen")
-        dds = [platform.request("dds", i) for i in range(4)]
+        dds = [platform.request("dds", i) for i in range(n)]
 
         ts_clk_div = TSTriple()
         self.specials += [
@@ -405,13 +818,16 @@ class Urukul(Module):
         ]
 
         self.eem = eem = []
-        for i in range(12):
+        for i in range(12 if eem1 else 8):
             tsi = TSTriple()
             eemi = platform.request("eem", i)
             tsi._pin = eemi.io
             self.specials += tsi.get_tristate(eemi.io)
             self.comb += eemi.oe.eq(tsi.oe)
             eem.append(tsi)
+        if not eem1:
+            # not connected, inputs read as 0
+            eem += [TSTriple() for i in range(4)]
 
         # AD9910 only
         self.clock_domains.cd_sys = ClockDomain("sys", reset_less=True)
@@ -428,53 +844,94 @@ class Urukul(Module):
         en_9910 = Signal()  # AD9910 populated (instead of AD9912)
         en_nu = Signal()  # NU-Servo operation with quad SPI
         en_eem1 = Signal()  # EEM1 connected and sync outputs used
+        en_profile = Signal()  # DDS profile from EEM1
 
         self.comb += [
                 fsen.eq(1),
                 en_9910.eq(ifc_mode[0] | variant),
-                en_nu.eq(ifc_mode[1]),
-                en_eem1.eq(ifc_mode[2]),
+                # NU-Servo, SYNC and PROFILE need EEM1
+                en_nu.eq(ifc_mode[1] if eem1 else 0),
+                en_eem1.eq(ifc_mode[2] if eem1 else 0),
+                en_profile.eq(~en_nu & ifc_mode[3] if eem1 else 0),
                 [eem[i].oe.eq(0) for i in range(12) if i not in (2, 10)],
                 eem[2].oe.eq(~en_nu),
-                eem[10].oe.eq(~en_nu & en_eem1),
+                eem[10].oe.eq(~en_nu & en_eem1 & ~en_profile),
                 eem[10].o.eq(eem[6].i),
                 self.cd_sck0.clk.eq(~self.cd_sck1.clk),
                 dds_sync.clk_out_en.eq(~en_nu & en_eem1 & en_9910),
-                dds_sync.sync_out_en.eq(~en_nu & en_eem1 & en_9910),
+                dds_sync.sync_out_en.eq(~en_nu & en_eem1 & en_9910 &
+                    ~en_profile),
         ]
 
-        cfg = CFG(platform)
-        stat = Status(platform)
-        sr = SR(24)
-        assert len(cfg.data) <= len(sr.di)
-        assert len(stat.data) <= len(sr.do)
+        cfg = CFG(platform, n, att_sel=att_sel, io_update_seq=io_update_seq,
+                eem1=eem1, poll=status_poll)
+        stat = Status(platform, n, poll=status_poll, events=status_events,
+                proto_rev=proto_rev)
+        mask = cfg.fields if cfg_mask else []
+        sr = SR(max(len(cfg.data) + len(mask), len(stat.data)),
+                short=(cfg.ext[0] if cfg.ext else len(cfg.data))
+                if status_poll else 0, count=status_events, mask=mask,
+                ext=cfg.ext)
         self.submodules += cfg, stat, sr
+        self.cfg, self.stat, self.sr = cfg, stat, sr
 
         sel = Signal(8)
         cs = Signal(3)
         miso = Signal(8)
         mosi = eem[1].i
 
+        status = stat.data.raw_bits()
+        if status_poll:
+            status = Mux(cfg.data.poll, stat.poll, status)
+        if len(sr.do) > len(stat.data):
+            # MSB aligned, the status is shifted out first
+            self.comb += sr.do[len(sr.do) - len(stat.data):].eq(status)
+        else:
+            self.comb += sr.do.eq(status)
+
+        # attenuators in the chain
+        if att_sel:
+            att_en = Signal(n, reset=2**n - 1)
+            sel_att = [sel[2] & att_en[i] for i in range(n)]
+            self.comb += [
+                    If(cfg.data.att_en != 0,
+                        att_en.eq(cfg.data.att_en)
+                    ),
+                    att.s_in[0].eq(mosi),
+                    [att.s_in[i].eq(Mux(att_en[i - 1], att.s_out[i - 1],
+                        att.s_in[i - 1])) for i in range(1, n)],
+                    miso[2].eq(Mux(att_en[n - 1], att.s_out[n - 1],
+                        att.s_in[n - 1])),
+            ]
+        else:
+            sel_att = [sel[2]]*n
+            s_in, s_out = att.s_in, att.s_out
+            if n < len(s_in):
+                s_in, s_out = s_in[:n], s_out[:n]
+            self.comb += Cat(s_in, miso[2]).eq(Cat(mosi, s_out))
+
         self.specials += [Instance("FDPE", p_INIT=1,
-                i_D=0, i_C=ClockSignal("sck1"), i_CE=sel[2], i_PRE=~sel[2],
-                o_Q=att.le[i]) for i in range(4)]
+                i_D=0, i_C=ClockSignal("sck1"), i_CE=sel_att[i],
+                i_PRE=~sel_att[i], o_Q=att.le[i]) for i in range(n)]
+        self.comb += [att.le[i].eq(1) for i in range(n, len(att.le))]
 
         self.comb += [
                 cfg.en_9910.eq(en_9910),
+                cfg.en_profile.eq(en_profile),
+                cfg.profile.eq(Cat(eem[9].i, eem[10].i, eem[11].i)),
                 cs.eq(Cat(eem[3].i, eem[4].i, ~en_nu & eem[5].i)),
                 Array(sel)[cs].eq(1),  # one-hot
-                eem[2].o.eq(Array(miso)[cs]),
                 miso[3].eq(miso[4]),  # for all-DDS take DDS0:MISO
 
                 att.clk.eq(sel[2] & self.cd_sck1.clk),
-                Cat(att.s_in, miso[2]).eq(Cat(mosi, att.s_out)),
 
                 sr.sel.eq(sel[1]),
                 sr.sdi.eq(mosi),
                 miso[1].eq(sr.sdo),
 
                 cfg.data.raw_bits().eq(sr.di),
-                sr.do.eq(stat.data.raw_bits()),
+                stat.load.eq(sr.sel & sr.cd_le.clk),
+                stat.ack.eq(sr.full),
 
                 # dividers: z: 1, 0: 2, 1: 4
                 # 1: div-by-4 for AD9910
@@ -482,6 +939,35 @@ class Urukul(Module):
                 ts_clk_div.oe.eq(Array([en_9910, 0, 1, 1])[cfg.data.div]),
                 ts_clk_div.o.eq(Array([1, 1, 0, 1])[cfg.data.div]),
         ]
+        if registered_miso:
+            miso_q = Signal()
+            self.sync.sck0 += miso_q.eq(Array(miso)[cs])
+            self.comb += eem[2].o.eq(miso_q)
+            # MISO is a single register clock-to-out after SCK
+            platform.add_platform_command(
+                    'NET "{miso}" OFFSET = OUT 11 ns AFTER "{sck}";',
+                    miso=eem[2]._pin, sck=eem[0]._pin)
+        else:
+            self.comb += eem[2].o.eq(Array(miso)[cs])
+
+        if io_update_seq:
+            self.clock_domains.cd_sync_clk = ClockDomain("sync_clk",
+                    reset_less=True)
+            self.specials += Instance("BUFG", i_I=dds_sync.clk0,
+                    o_O=self.cd_sync_clk.clk)
+            platform.add_period_constraint(dds_sync.clk0, 4.)
+            io_update = IOUpdate(n)
+            self.submodules += io_update
+            self.comb += [
+                    io_update.trigger.eq(eem[6].i),
+                    [io_update.delay[i].eq(cfg.data.upd_dly[4*i:4*i + 4])
+                        for i in range(n)],
+            ]
+            io_update_eem = [Mux(en_9910, io_update.io_update[i], eem[6].i)
+                             for i in range(n)]
+        else:
+            io_update_eem = [eem[6].i]*n
+
         for i, ddsi in enumerate(dds):
             sel_spi = Signal()
             sel_nu = Signal()
@@ -493,15 +979,21 @@ class Urukul(Module):
                     ddsi.sdi.eq(Mux(sel_nu, eem[i + 8].i, mosi)),
                     miso[i + 4].eq(ddsi.sdo),
                     ddsi.io_update.eq(Mux(cfg.data.mask_nu[i],
-                        cfg.data.io_update, eem[6].i)),
+                        cfg.data.io_update, io_update_eem[i])),
                     ddsi.reset.eq(cfg.data.rst | (~en_9910 & eem[7].i)),
             ]
 
-        tp = [platform.request("tp", i) for i in range(5)]
-        self.comb += [
-                tp[0].eq(dds[0].cs_n),
-                tp[1].eq(dds[0].sck),
-                tp[2].eq(dds[0].sdi),
-                tp[3].eq(dds[0].sdo),
-                tp[4].eq(dds[0].drover),
-        ]
+        for i, name in enumerate(TP if tp is None else tp):
+            pad = platform.request("tp", i)
+            if name is None:
+                self.comb += pad.eq(0)
+                continue
+            if name.startswith("eem"):
+                signal = eem[int(name[3:])].i
+            else:
+                resource, field = name.split(".")
+                signal = getattr(dds[int(resource[3:])] if
+                        resource.startswith("dds") else att, field)
+            if len(signal) != 1:
+                raise ValueError("test point signal not single bit", name)
+            self.comb += pad.eq(signal)
@@ -0,0 +1,818 @@
+from collections import namedtuple
+import argparse
+import random
+import time
+
+from migen import *
+from migen.fhdl.structure import (_Operator, _Slice, _Part, _ArrayProxy,
+                                  _Assign)
+from migen.fhdl.bitcontainer import value_bits_sign
+from migen.fhdl.tools import list_targets
+from migen.fhdl.specials import Tristate
+from migen.sim.core import Simulator
+
+
+class BitGraph:
+    """Hash-consed single-bit logic graph
+
+    Nodes are tuples ``(op, *args)`` identified by their index. ``op`` is one
+    of ``const``, ``var``, ``not``, ``and``, ``or``, ``xor``, ``mux``
+    (``("mux", c, a, b)`` is ``a`` if ``c`` else ``b``). Constants are
+    folded and trivial identities simplified on construction.
+    """
+    ZERO = 0
+    ONE = 1
+
+    def __init__(self):
+        self.nodes = [("const", 0), ("const", 1)]
+        self.index = {n: i for i, n in enumerate(self.nodes)}
+
+    def node(self, *n):
+        try:
+            return self.index[n]
+        except KeyError:
+            i = self.index[n] = len(self.nodes)
+            self.nodes.append(n)
+            return i
+
+    def var(self, key):
+        return self.node("var", key)
+
+    def const(self, value):
+        return self.ONE if value else self.ZERO
+
+    def not_(self, a):
+        if a <= self.ONE:
+            return self.ONE - a
+        n = self.nodes[a]
+        if n[0] == "not":
+            return n[1]
+        return self.node("not", a)
+
+    def and_(self, a, b):
+        if a == self.ZERO or b == self.ZERO:
+            return self.ZERO
+        if a == self.ONE or a == b:
+            return b
+        if b == self.ONE:
+            return a
+        if self.not_(a) == b:
+            return self.ZERO
+        return self.node("and", min(a, b), max(a, b))
+
+    def or_(self, a, b):
+        if a == self.ONE or b == self.ONE:
+            return self.ONE
+        if a == self.ZERO or a == b:
+            return b
+        if b == self.ZERO:
+            return a
+        if self.not_(a) == b:
+            return self.ONE
+        return self.node("or", min(a, b), max(a, b))
+
+    def xor_(self, a, b):
+        if a == b:
+            return self.ZERO
+        if a == self.ZERO:
+            return b
+        if b == self.ZERO:
+            return a
+        if a == self.ONE:
+            return self.not_(b)
+        if b == self.ONE:
+            return self.not_(a)
+        return self.node("xor", min(a, b), max(a, b))
+
+    def mux(self, c, a, b):
+        if a == b or c == self.ONE:
+            return a
+        if c == self.ZERO:
+            return b
+        if a == self.ONE and b == self.ZERO:
+            return c
+        if a == self.ZERO and b == self.ONE:
+            return self.not_(c)
+        return self.node("mux", c, a, b)
+
+    def any(self, bits):
+        r = self.ZERO
+        for b in bits:
+            r = self.or_(r, b)
+        return r
+
+    def all(self, bits):
+        r = self.ONE
+        for b in bits:
+            r = self.and_(r, b)
+        return r
+
+    def support(self, a, _memo=None):
+        """Set of ``var`` keys in the cone of node ``a``"""
+        memo = dict() if _memo is None else _memo
+        stack = [a]
+        while stack:
+            i = stack[-1]
+            if i in memo:
+                stack.pop()
+                continue
+            n = self.nodes[i]
+            if n[0] == "const":
+                memo[i] = frozenset()
+            elif n[0] == "var":
+                memo[i] = frozenset([n[1]])
+            else:
+                pending = [j for j in n[1:] if j not in memo]
+                if pending:
+                    stack.extend(pending)
+                    continue
+                memo[i] = frozenset().union(*(memo[j] for j in n[1:]))
+            stack.pop()
+        return memo[a]
+
+    def evaluate(self, bits, var, mask, _memo=None):
+        """Lane planes of the nodes ``bits``
+
+        ``var(key)`` is the plane of a ``var`` node, ``mask`` the plane with
+        all lanes set. Shared subexpressions are evaluated once (pass a
+        ``_memo`` dict to share them across calls).
+        """
+        memo = dict() if _memo is None else _memo
+        ops = {
+            "not": lambda x: x ^ mask,
+            "and": lambda x, y: x & y,
+            "or": lambda x, y: x | y,
+            "xor": lambda x, y: x ^ y,
+            "mux": lambda c, x, y: y ^ (c & (x ^ y)),
+        }
+        stack = list(bits)
+        while stack:
+            i = stack[-1]
+            if i in memo:
+                stack.pop()
+                continue
+            n = self.nodes[i]
+            if n[0] == "const":
+                memo[i] = mask if n[1] else 0
+            elif n[0] == "var":
+                memo[i] = var(n[1])
+            else:
+                pending = [j for j in n[1:] if j not in memo]
+                if pending:
+                    stack.extend(pending)
+                    continue
+                memo[i] = ops[n[0]](*(memo[j] for j in n[1:]))
+            stack.pop()
+        return [memo[b] for b in bits]
+
+    def substitute(self, a, mapping, _memo=None):
+        """Node ``a`` with ``var`` keys in ``mapping`` replaced by nodes"""
+        memo = dict() if _memo is None else _memo
+        ops = {"not": self.not_, "and": self.and_, "or": self.or_,
+               "xor": self.xor_, "mux": self.mux}
+        stack = [a]
+        while stack:
+            i = stack[-1]
+            if i in memo:
+                stack.pop()
+                continue
+            n = self.nodes[i]
+            if n[0] == "const":
+                memo[i] = i
+            elif n[0] == "var":
+                memo[i] = mapping.get(n[1], i)
+            else:
+                pending = [j for j in n[1:] if j not in memo]
+                if pending:
+                    stack.extend(pending)
+                    continue
+                memo[i] = ops[n[0]](*(memo[j] for j in n[1:]))
+            stack.pop()
+        return memo[a]
+
+
+class BitLowering:
+    """Lowers migen expressions and statements to :class:`BitGraph` bits
+
+    Every bit of every signal is a ``var`` keyed by its storage slot.
+    Values are unsigned, results are truncated/zero-extended to the natural
+    width (:func:`value_bits_sign`).
+    """
+    def __init__(self, clock_domains, graph=None):
+        self.clock_domains = clock_domains
+        self.graph = BitGraph() if graph is None else graph
+        self.slots = dict()
+        self.signals = []
+        self.nslots = 0
+
+    def slot(self, signal):
+        try:
+            return self.slots[signal]
+        except KeyError:
+            if signal.signed:
+                raise NotImplementedError("signed signal", signal)
+            n = self.slots[signal] = self.nslots
+            self.signals.append(signal)
+            self.nslots += len(signal)
+            return n
+
+    def signal(self, signal):
+        n = self.slot(signal)
+        return [self.graph.var(n + i) for i in range(len(signal))]
+
+    @staticmethod
+    def fit(bits, n):
+        return (bits + [BitGraph.ZERO]*n)[:n]
+
+    def add(self, a, b, carry):
+        g = self.graph
+        n = max(len(a), len(b)) + 1
+        a, b = self.fit(a, n), self.fit(b, n)
+        r = []
+        for ai, bi in zip(a, b):
+            s = g.xor_(ai, bi)
+            r.append(g.xor_(s, carry))
+            carry = g.or_(g.and_(ai, bi), g.and_(s, carry))
+        return r, carry
+
+    def eq(self, a, b):
+        g = self.graph
+        n = max(len(a), len(b))
+        return g.all(g.not_(g.xor_(ai, bi))
+                for ai, bi in zip(self.fit(a, n), self.fit(b, n)))
+
+    def select(self, key, choices, width):
+        """``choices[min(len(choices) - 1, key)]`` as a mux tree"""
+        g = self.graph
+        cands = [self.fit(choices[min(len(choices) - 1, k)], width)
+                 for k in range(2**len(key))]
+        for kb in key:
+            cands = [[g.mux(kb, hi, lo) for lo, hi in zip(cands[i],
+                cands[i + 1])] for i in range(0, len(cands), 2)]
+        return cands[0]
+
+    def expr(self, node):
+        g = self.graph
+        if isinstance(node, Constant):
+            return [g.const((node.value >> i) & 1)
+                    for i in range(len(node))]
+        elif isinstance(node, Signal):
+            return self.signal(node)
+        elif isinstance(node, _Operator):
+            ops = [self.expr(o) for o in node.operands]
+            width = value_bits_sign(node)[0]
+            if node.op == "~":
+                return [g.not_(b) for b in ops[0]]
+            elif node.op in ("&", "|", "^"):
+                f = {"&": g.and_, "|": g.or_, "^": g.xor_}[node.op]
+                a, b = self.fit(ops[0], width), self.fit(ops[1], width)
+                return [f(ai, bi) for ai, bi in zip(a, b)]
+            elif node.op == "+":
+                return self.fit(self.add(ops[0], ops[1], g.ZERO)[0], width)
+            elif node.op == "-":
+                if len(ops) == 1:
+                    ops = [[], ops[0]]
+                n = max(len(o) for o in ops) + 1
+                b = [g.not_(bi) for bi in self.fit(ops[1], n)]
+                return self.fit(self.add(self.fit(ops[0], n), b, g.ONE)[0],
+                        width)
+            elif node.op in ("==", "!="):
+                e = self.eq(ops[0], ops[1])
+                return [e if node.op == "==" else g.not_(e)]
+            elif node.op in ("<", ">=", ">", "<="):
+                a, b = ops if node.op in ("<", ">=") else ops[::-1]
+                n = max(len(a), len(b))
+                nb = [g.not_(bi) for bi in self.fit(b, n)]
+                # a - b borrows iff a < b
+                carry = self.add(self.fit(a, n), nb, g.ONE)[0][n]
+                return [g.not_(carry) if node.op in ("<", ">") else carry]
+            elif node.op in (">>>", "<<<") and isinstance(
+                    node.operands[1], Constant):
+                k = node.operands[1].value
+                if node.op == ">>>":
+                    return self.fit(ops[0][k:], width)
+                return self.fit([g.ZERO]*k + ops[0], width)
+            elif node.op == "m":
+                c = g.any(ops[0])
+                a, b = self.fit(ops[1], width), self.fit(ops[2], width)
+                return [g.mux(c, ai, bi) for ai, bi in zip(a, b)]
+            raise NotImplementedError(node.op)
+        elif isinstance(node, _Slice):
+            return self.expr(node.value)[node.start:node.stop]
+        elif isinstance(node, _Part):
+            v = self.expr(node.value)
+            choices = [v[o:o + node.width] for o in range(len(v))]
+            return self.select(self.expr(node.offset), choices, node.width)
+        elif isinstance(node, Cat):
+            r = []
+            for e in node.l:
+                r += self.fit(self.expr(e), len(e))
+            return r
+        elif isinstance(node, Replicate):
+            return self.fit(self.expr(node.v), len(node.v))*node.n
+        elif isinstance(node, _ArrayProxy):
+            width = max(len(c) for c in node.choices)
+            return self.select(self.expr(node.key),
+                    [self.expr(c) for c in node.choices], width)
+        elif isinstance(node, ClockSignal):
+            return self.signal(self.clock_domains[node.cd].clk)
+        elif isinstance(node, ResetSignal):
+            rst = self.clock_domains[node.cd].rst
+            if rst is None:
+                if node.allow_reset_less:
+                    return [g.ZERO]
+                raise ValueError("Attempted to get reset signal of resetless"
+                                 " domain '{}'".format(node.cd))
+            return self.signal(rst)
+        raise NotImplementedError(node)
+
+    def lvalue(self, node):
+        """Target slots of a static lvalue (Signal, Cat, Slice)"""
+        if isinstance(node, Signal):
+            n = self.slot(node)
+            return list(range(n, n + len(node)))
+        elif isinstance(node, Cat):
+            r = []
+            for e in node.l:
+                r += self.lvalue(e)
+            return r
+        elif isinstance(node, _Slice):
+            return self.lvalue(node.value)[node.start:node.stop]
+        raise NotImplementedError(node)
+
+    def merge(self, c, env, t, f, init):
+        for k in set(t) | set(f):
+            old = env.get(k, None)
+            if old is None:
+                old = init(k)
+            env[k] = self.graph.mux(c, t.get(k, old), f.get(k, old))
+
+    def assign(self, node, bits, env, init):
+        g = self.graph
+        if isinstance(node, _ArrayProxy):
+            key = self.expr(node.key)
+            for k, choice in enumerate(node.choices):
+                if k == len(node.choices) - 1 < 2**len(key) - 1:
+                    # index is clamped to the last choice
+                    c = g.not_(g.any(self.eq(key, self.fit(
+                        [g.const((j >> i) & 1) for i in range(len(key))],
+                        len(key))) for j in range(k)))
+                else:
+                    c = self.eq(key, [g.const((k >> i) & 1)
+                        for i in range(len(key))])
+                t = dict()
+                self.assign(choice, bits, t, lambda s: env.get(s, init(s)))
+                self.merge(c, env, t, {}, init)
+        elif isinstance(node, _Part):
+            offset = self.expr(node.offset)
+            for o in range(len(node.value)):
+                c = self.eq(offset, [g.const((o >> i) & 1)
+                    for i in range(len(offset))])
+                t = dict()
+                self.assign(node.value[o:o + node.width], bits, t,
+                        lambda s: env.get(s, init(s)))
+                self.merge(c, env, t, {}, init)
+        else:
+            slots = self.lvalue(node)
+            for s, b in zip(slots, self.fit(bits, len(slots))):
+                env[s] = b
+
+    def execute(self, stmts, env, init):
+        """Symbolically execute ``stmts``, updating ``env`` (slot: node)
+
+        ``init(slot)`` is the value of a target bit before any assignment
+        (its reset value for comb, its current value for sync).
+        """
+        g = self.graph
+        for s in stmts:
+            if isinstance(s, _Assign):
+                self.assign(s.l, self.expr(s.r), env, init)
+            elif isinstance(s, If):
+                c = g.any(self.expr(s.cond))
+                t, f = dict(), dict()
+                sub = lambda k: env.get(k, init(k))
+                self.execute(s.t, t, sub)
+                self.execute(s.f, f, sub)
+                self.merge(c, env, t, f, init)
+            elif isinstance(s, Case):
+                test = self.expr(s.test)
+                cases = [(k, v) for k, v in s.cases.items()
+                         if isinstance(k, Constant)]
+                chain = s.cases.get("default", [])
+                for k, v in reversed(cases):
+                    chain = [If(s.test == k, *v).Else(*chain)]
+                self.execute(chain, env, init)
+            elif isinstance(s, (list, tuple)):
+                self.execute(s, env, init)
+            elif isinstance(s, Display):
+                pass
+            else:
+                raise NotImplementedError(s)
+
+    def comb(self, stmts, cut=()):
+        """Settled comb function: target slot -> node of non-comb vars
+
+        Slots in ``cut`` are not inlined: they remain free ``var`` nodes
+        even if they are driven combinatorially.
+        """
+        g = self.graph
+        env = dict()
+        reset = dict()
+        for t in list_targets(stmts):
+            for i, s in enumerate(self.lvalue(t)):
+                reset[s] = g.const((t.reset.value >> i) & 1)
+        self.execute(stmts, env, reset.__getitem__)
+
+        done = dict()
+        active = set()
+
+        def inline(a):
+            # iterative post-order substitution of comb vars
+            stack = [(a, False)]
+            while stack:
+                i, expanded = stack.pop()
+                if i in done:
+                    continue
+                n = g.nodes[i]
+                if n[0] == "const":
+                    done[i] = i
+                elif n[0] == "var" and (n[1] not in env or n[1] in cut):
+                    done[i] = i
+                elif n[0] == "var":
+                    d = env[n[1]]
+                    if not expanded:
+                        if i in active:
+                            raise ValueError("combinatorial loop",
+                                    self.name(n[1]))
+                        active.add(i)
+                        stack.append((i, True))
+                        stack.append((d, False))
+                    else:
+                        active.discard(i)
+                        done[i] = done[d]
+                elif not expanded:
+                    stack.append((i, True))
+                    stack.extend((j, False) for j in n[1:])
+                else:
+                    args = [done[j] for j in n[1:]]
+                    done[i] = {
+                        "not": g.not_, "and": g.and_, "or": g.or_,
+                        "xor": g.xor_, "mux": g.mux}[n[0]](*args)
+            return done[a]
+
+        return {s: inline(d) for s, d in env.items()}
+
+    def name(self, slot):
+        for signal in self.signals:
+            n = self.slots[signal]
+            if n <= slot < n + len(signal):
+                return "{}[{}]".format(signal.backtrace[-1][0], slot - n)
+
+
+def to_planes(values, width):
+    """Transpose per-lane integers into per-bit lane planes"""
+    planes = [0]*width
+    for k, x in enumerate(values):
+        for i in range(width):
+            if (x >> i) & 1:
+                planes[i] |= 1 << k
+    return planes
+
+
+def from_planes(planes, lanes):
+    """Transpose per-bit lane planes into per-lane integers"""
+    values = [0]*lanes
+    for i, p in enumerate(planes):
+        k = 0
+        while p:
+            if p & 1:
+                values[k] |= 1 << i
+            p >>= 1
+            k += 1
+    return values
+
+
+PerLane = namedtuple("PerLane", "signal values")
+PerLane.__doc__ = """Generator request: assign one value per lane"""
+
+
+class _Codegen:
+    def __init__(self, graph):
+        self.graph = graph
+        self.names = dict()
+
+    def name(self, i, out):
+        """Emit node ``i`` (and its cone) and return its Python expression"""
+        g = self.graph
+        stack = [i]
+        while stack:
+            j = stack[-1]
+            if j in self.names:
+                stack.pop()
+                continue
+            n = g.nodes[j]
+            if n[0] == "const":
+                self.names[j] = "M" if n[1] else "0"
+            elif n[0] == "var":
+                self.names[j] = "v[{}]".format(n[1])
+            else:
+                pending = [k for k in n[1:] if k not in self.names]
+                if pending:
+                    stack.extend(pending)
+                    continue
+                a = [self.names[k] for k in n[1:]]
+                e = {
+                    "not": "{0} ^ M",
+                    "and": "{0} & {1}",
+                    "or": "{0} | {1}",
+                    "xor": "{0} ^ {1}",
+                    "mux": "{2} ^ ({0} & ({1} ^ {2}))",
+                }[n[0]].format(*a)
+                self.names[j] = "n{}".format(j)
+                out.append("    n{} = {}".format(j, e))
+            stack.pop()
+        return self.names[i]
+
+
+class BatchSimulator(Simulator):
+    """Bit-sliced multi-lane simulator
+
+    Every signal bit is stored as a Python integer holding that bit for
+    ``lanes`` independent simulations (lane ``k`` in bit ``k``). Comb and
+    sync logic are lowered to bitwise operations on these planes, so all
+    lanes advance together at roughly the cost of one.
+
+    Clocks are shared by all lanes. Generators use the pysim protocol:
+    statements assign the same value to all lanes, :class:`PerLane`
+    requests assign per lane, and expressions read back as a list with
+    one integer per lane.
+    """
+    def __init__(self, fragment_or_module, generators, clocks={"sys": 10},
+            lanes=64, special_overrides={}):
+        Simulator.__init__(self, fragment_or_module, generators,
+                clocks=clocks, special_overrides=special_overrides)
+        self.lanes = lanes
+        self.mask = (1 << lanes) - 1
+        self.lowering = lw = BitLowering(self.fragment.clock_domains)
+        self.clk = {cd.name: lw.lvalue(cd.clk)[0]
+                    for cd in self.fragment.clock_domains}
+
+        source = ["def comb(v):", "    M = {}".format(self.mask)]
+        cg = _Codegen(lw.graph)
+        for s, n in sorted(lw.comb(self.fragment.comb).items()):
+            source.append("    v[{}] = {}".format(s, cg.name(n, source)))
+        source.append("")
+        self.sync_names = dict()
+        for cd, stmts in sorted(self.fragment.sync.items()):
+            name = "sync_{}".format(len(self.sync_names))
+            self.sync_names[cd] = name
+            env = dict()
+            lw.execute(stmts, env, lw.graph.var)
+            source += ["def {}(v, m):".format(name),
+                    "    M = {}".format(self.mask), "    pass"]
+            cg = _Codegen(lw.graph)
+            for s, n in sorted(env.items()):
+                if n != lw.graph.var(s):
+                    source.append("    m[{}] = {}".format(s,
+                        cg.name(n, source)))
+            source.append("")
+        self.source = "\n".join(source) + "\n"
+        namespace = dict()
+        exec(compile(self.source, "<urukul_batch>", "exec"), namespace)
+        self.comb = namespace["comb"]
+        self.sync = {cd: namespace[n] for cd, n in self.sync_names.items()}
+
+        self.v = [0]*lw.nslots
+        for signal in lw.signals:
+            self.v[lw.slots[signal]:lw.slots[signal] + len(signal)] = [
+                self.mask if (signal.reset.value >> i) & 1 else 0
+                for i in range(len(signal))]
+        self.m = dict()
+        self.t = 0
+
+    def _grow(self):
+        if len(self.v) < self.lowering.nslots:
+            for signal in self.lowering.signals[:]:
+                n = self.lowering.slots[signal]
+                if n >= len(self.v):
+                    self.v += [self.mask if (signal.reset.value >> i) & 1
+                               else 0 for i in range(len(signal))]
+
+    def _eval_bits(self, bits):
+        return self.lowering.graph.evaluate(bits, self.v.__getitem__,
+                self.mask)
+
+    def read(self, expr):
+        """Per-lane values of ``expr``"""
+        lw = self.lowering
+        if isinstance(expr, Signal):
+            n = lw.slot(expr)
+            self._grow()
+            planes = self.v[n:n + len(expr)]
+        else:
+            bits = lw.expr(expr)
+            self._grow()
+            planes = self._eval_bits(bits)
+        return from_planes(planes, self.lanes)
+
+    def write(self, target, values):
+        """Assign per-lane values to ``target`` (pending until commit)"""
+        slots = self.lowering.lvalue(target)
+        self._grow()
+        for n, p in zip(slots, to_planes(values, len(slots))):
+            self.m[n] = p
+
+    def _execute(self, stmt):
+        lw = self.lowering
+        env = dict()
+        lw.execute([stmt], env, lw.graph.var)
+        self._grow()
+        slots = sorted(env)
+        for s, p in zip(slots, self._eval_bits([env[s] for s in slots])):
+            self.m[s] = p
+
+    def _evalexec_nested_lists(self, x):
+        if isinstance(x, list):
+            return [self._evalexec_nested_lists(e) for e in x]
+        elif isinstance(x, PerLane):
+            self.write(x.signal, x.values)
+            return None
+        elif isinstance(x, (_Assign, If, Case)):
+            self._execute(x)
+            return None
+        else:
+            return self.read(x)
+
+    def _commit_and_comb_propagate(self):
+        v = self.v
+        changed = False
+        for n, p in self.m.items():
+            if v[n] != p:
+                v[n] = p
+                changed = True
+        self.m.clear()
+        if changed:
+            self.comb(v)
+
+    def run(self):
+        self.comb(self.v)
+        while True:
+            dt, rising, falling = self.time.tick()
+            self.t += dt
+            for cd in rising:
+                self.m[self.clk[cd]] = self.mask
+                if cd in self.sync:
+                    self.sync[cd](self.v, self.m)
+                if cd in self.generators:
+                    self._process_generators(cd)
+            for cd in falling:
+                self.m[self.clk[cd]] = 0
+            self._commit_and_comb_propagate()
+
+            if not self._continue_simulation():
+                break
+
+
+def scalar(generator):
+    """Run a lane-aware generator on a scalar (single lane) simulator
+
+    :class:`PerLane` requests take the first value, replies are wrapped
+    into one-element lists.
+    """
+    reply = None
+    while True:
+        try:
+            request = generator.send(reply)
+        except StopIteration as e:
+            return e.value
+        if isinstance(request, PerLane):
+            reply = yield request.signal.eq(request.values[0])
+            continue
+        reply = yield request
+        if reply is not None:
+            reply = [reply]
+
+
+def spi(tb, cs, n, mosi):
+    """Per-lane :meth:`urukul_sim.TB.spi`
+
+    ``cs`` and ``mosi`` are lists with one value per lane, the transfer
+    length ``n`` is shared. Returns the per-lane MISO words.
+    """
+    while not (yield tb.dut.cd_sck1.clk)[0]:
+        yield
+    yield PerLane(tb.cs, cs)
+    miso = [0]*len(cs)
+    for i in range(n - 1, -1, -1):
+        yield PerLane(tb.eem[1].io, [(m >> i) & 1 for m in mosi])
+        yield tb.eem[0].io.eq(0)
+        yield
+        yield tb.eem[0].io.eq(1)
+        bit = yield tb.dut.eem[2].o
+        miso = [(m << 1) | b for m, b in zip(miso, bit)]
+        yield
+        yield tb.eem[0].io.eq(0)
+    le = yield tb.dut.sr.cd_le.clk
+    yield tb.cs.eq(0)
+    yield PerLane(tb.dut.ce_le, [int(not x) for x in le])
+    yield
+    yield tb.dut.ce_le.eq(0)
+    yield
+    yield
+    yield
+    return miso
+
+
+Config = namedtuple("Config", "ifc_mode variant cfg cs mosi")
+
+
+def configs(lanes, seed=None):
+    """Random CFG/IFC_MODE/CS stimulus, one :class:`Config` per lane"""
+    rng = random.Random(seed)
+    return [Config(rng.randrange(16), rng.randrange(2),
+                   rng.randrange(1 << 24), rng.randrange(8),
+                   rng.randrange(1 << 32))
+            for _ in range(lanes)]
+
+
+def sweep(tb, configs, result):
+    """Configure each lane, write CFG, run one transaction, sample outputs
+
+    ``result`` is filled with the per-lane samples: status readback,
+    MISO of the transaction, and DDS CS_N/SDI/IO_UPDATE/PROFILE plus
+    RF_SW/LED while the transaction is active.
+    """
+    ifc = [c.ifc_mode for c in configs]
+    for i in range(4):
+        yield PerLane(tb.ifc_mode[i], [(m >> i) & 1 for m in ifc])
+    yield PerLane(tb.platform.lookup_request("variant"),
+            [c.variant for c in configs])
+    yield
+    yield from spi(tb, [1]*len(configs), 24, [c.cfg for c in configs])
+    result["status"] = yield from spi(tb, [1]*len(configs), 24,
+            [c.cfg for c in configs])
+    # sample outputs in the middle of a transaction
+    cs = [c.cs for c in configs]
+    yield PerLane(tb.cs, cs)
+    yield PerLane(tb.eem[1].io, [c.mosi & 1 for c in configs])
+    yield
+    yield
+    for k, s in [("cs_n", "cs_n"), ("sdi", "sdi"),
+            ("io_update", "io_update"), ("profile", "profile"),
+            ("rf_sw", "rf_sw"), ("led", "led")]:
+        result[k] = yield Cat(*[getattr(d, s) for d in tb.dds])
+    result["att_le"] = yield tb.att.le
+    yield tb.cs.eq(0)
+    yield
+    yield
+    result["miso"] = yield from spi(tb, cs, 32, [c.mosi for c in configs])
+
+
+def _tb():
+    from urukul import Urukul
+    from urukul_cpld import Platform
+    from urukul_sim import TB
+    p = Platform()
+    return TB(p, Urukul(p))
+
+
+def main():
+    from urukul_sim import SimTristate, SimInstance
+    import urukul_fastsim as fastsim
+
+    parser = argparse.ArgumentParser(
+            description="Bit-sliced Urukul configuration sweep")
+    parser.add_argument("-n", "--lanes", type=int, default=64)
+    parser.add_argument("-s", "--seed", type=int, default=None)
+    parser.add_argument("-c", "--check", type=int, default=4,
+            help="number of lanes to check against the scalar simulator")
+    args = parser.parse_args()
+
+    kwargs = dict(
+            clocks={"sys": 8, "sck1": (16, 4), "sck0": (16, 12), "le": 8},
+            special_overrides={Tristate: SimTristate, Instance: SimInstance})
+    cfg = configs(args.lanes, args.seed)
+    tb = _tb()
+    result = dict()
+    t0 = time.monotonic()
+    sim = BatchSimulator(tb, [sweep(tb, cfg, result)], lanes=args.lanes,
+            **kwargs)
+    sim.run()
+    t = time.monotonic() - t0
+    print("{} lanes: {:.3f} s".format(args.lanes, t))
+
+    for k in random.Random(args.seed).sample(range(args.lanes),
+            min(args.check, args.lanes)):
+        tb = _tb()
+        ref = dict()
+        fastsim.run_simulation(tb, [scalar(sweep(tb, cfg[k:k + 1], ref))],
+                **kwargs)
+        for key, values in result.items():
+            assert values[k] == ref[key][0], (k, cfg[k], key,
+                    values[k], ref[key][0])
+    print("checked {} lanes against scalar simulation".format(
+        min(args.check, args.lanes)))
+
+
+if __name__ == "__main__":
+    main()
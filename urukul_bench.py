@@ -0,0 +1,271 @@
+"""Elaboration, Verilog generation and simulation benchmarks
+
+Each benchmark has an untimed setup and a timed run that is repeated
+(after a warm-up run) to give min/median/mean/stdev statistics:
+
+  - ``elaborate``: ``Urukul(Platform())``
+  - ``verilog``: ``Platform.build(..., run=False)`` of an elaborated design
+    (Verilog, UCF and XST sources, no ISE)
+  - ``compile``: compiled simulator construction for the testbench
+  - ``sim_cfg``, ``sim_att``, ``sim_multicast``, ``sim_qspi``: simulated
+    SPI bits per second on the compiled simulator for 24 bit CFG, 32 bit
+    ATT, 72 bit CS=3 multicast transfers and EN_NU QSPI bursts (4 lanes)
+
+Results are written as JSON with the revision and environment and compared
+against a baseline (median time per run, ``--tolerance``). The baseline is
+machine specific and not part of the repository (``--update``).
+"""
+
+import argparse
+import gc
+import json
+import os
+import platform
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+
+def _tb(**options):
+    from urukul import Urukul
+    from urukul_cpld import Platform
+    from urukul_sim import TB
+
+    p = Platform()
+    dut = Urukul(p, **options)
+    return dut, TB(p, dut)
+
+
+def elaborate():
+    from urukul import Urukul
+    from urukul_cpld import Platform
+
+    def run():
+        Urukul(Platform())
+    return run
+
+
+def verilog():
+    from urukul import Urukul
+    from urukul_cpld import Platform
+    build_dir = tempfile.TemporaryDirectory(prefix="urukul_bench")
+
+    def run():
+        # the build finalizes the design: elaborate untimed per run
+        p = Platform()
+        dut = Urukul(p)
+        t0 = time.perf_counter()
+        p.build(dut, build_dir=build_dir.name, build_name="urukul",
+                mode="cpld", run=False)
+        return None, time.perf_counter() - t0
+    return run
+
+
+def simulator():
+    from urukul_fastsim import FastSimulator
+    from urukul_sim import sim_kwargs
+
+    def run():
+        dut, tb = _tb()
+        t0 = time.perf_counter()
+        FastSimulator(tb, [], **sim_kwargs(dut))
+        return None, time.perf_counter() - t0
+    return run
+
+
+def _sim(transfers):
+    """Simulation benchmark: ``transfers(tb, rng)`` is a generator returning
+    the number of bits transferred"""
+    from urukul_fastsim import FastSimulator
+    from urukul_sim import sim_kwargs
+
+    dut, tb = _tb()
+    sim = FastSimulator(tb, [], **sim_kwargs(dut))
+
+    # bound as defaults: the migen name tracer fails on closure cells
+    def run(sim=sim, tb=tb):
+        bits = []
+
+        def gen():
+            bits.append((yield from transfers(tb, random.Random(0))))
+        sim.reset([gen()])
+        sim.run()
+        return bits[0]
+    return run
+
+
+def sim_cfg(count=32):
+    def transfers(tb, rng):
+        for i in range(count):
+            yield from tb.spi(1, 24, rng.randrange(1 << 24))
+        return 24*count
+    return _sim(transfers)
+
+
+def sim_att(count=32):
+    def transfers(tb, rng):
+        for i in range(count):
+            yield from tb.spi(2, 32, rng.randrange(1 << 32))
+        return 32*count
+    return _sim(transfers)
+
+
+def sim_multicast(count=16):
+    def transfers(tb, rng):
+        yield from tb.spi(1, 24, 0xf << 13)  # MASK_NU
+        for i in range(count):
+            yield from tb.spi(3, 72, rng.randrange(1 << 72))
+        return 72*count
+    return _sim(transfers)
+
+
+def sim_qspi(count=16, n=32):
+    def transfers(tb, rng):
+        yield tb.ifc_mode[1].eq(1)  # en_nu
+        yield
+        for i in range(count):
+            yield from tb.qspi(n, [rng.randrange(1 << n) for j in range(4)])
+        return 4*n*count
+    return _sim(transfers)
+
+
+BENCHMARKS = dict(
+    elaborate=elaborate,
+    verilog=verilog,
+    compile=simulator,
+    sim_cfg=sim_cfg,
+    sim_att=sim_att,
+    sim_multicast=sim_multicast,
+    sim_qspi=sim_qspi,
+)
+
+
+def measure(setup, repeat=5):
+    """Run a benchmark ``repeat`` times after one warm-up run
+
+    The run returns the number of bits (or ``None``), optionally with its own
+    time measurement. Returns the statistics dict.
+    """
+    run = setup()
+    times = []
+    units = None
+    for i in range(repeat + 1):
+        gc.collect()
+        t0 = time.perf_counter()
+        r = run()
+        dt = time.perf_counter() - t0
+        if isinstance(r, tuple):
+            r, dt = r
+        if i:
+            times.append(dt)
+            units = r
+    r = dict(
+        repeat=repeat,
+        min=min(times),
+        median=statistics.median(times),
+        mean=statistics.mean(times),
+        stdev=statistics.stdev(times) if len(times) > 1 else 0.,
+    )
+    if units is not None:
+        r["bits"] = units
+        r["bits_per_s"] = units/r["median"]
+    return r
+
+
+def environment():
+    from importlib import metadata
+    from urukul_reports import revision
+
+    try:
+        rev = revision()
+    except Exception:
+        rev = None
+    try:
+        migen = metadata.version("migen")
+    except metadata.PackageNotFoundError:
+        migen = None
+    return dict(
+        revision=rev,
+        python=sys.version.split()[0],
+        implementation=platform.python_implementation(),
+        machine=platform.machine(),
+        node=platform.node(),
+        migen=migen,
+    )
+
+
+def compare(results, baseline, tolerance):
+    """Benchmarks whose median changed by more than ``tolerance`` (relative)
+
+    Returns ``[(name, baseline, current, ratio)]``.
+    """
+    r = []
+    for name, stats in results.items():
+        base = baseline.get(name)
+        if base is None:
+            continue
+        ratio = stats["median"]/base["median"]
+        if abs(ratio - 1) > tolerance:
+            r.append((name, base["median"], stats["median"], ratio))
+    return r
+
+
+def main():
+    parser = argparse.ArgumentParser(
+            description="Urukul elaboration/build/simulation benchmarks")
+    parser.add_argument("benchmark", nargs="*",
+            help="benchmarks to run (default: all of {})".format(
+                ", ".join(BENCHMARKS)))
+    parser.add_argument("-r", "--repeat", type=int, default=5,
+            help="timed runs per benchmark (default: %(default)s)")
+    parser.add_argument("-o", "--output", default=None,
+            help="write the results as JSON")
+    parser.add_argument("-b", "--baseline", default=os.path.join("reports",
+            "bench.json"), help="baseline (default: %(default)s)")
+    parser.add_argument("-u", "--update", action="store_true",
+            help="write the results as the new baseline")
+    parser.add_argument("--tolerance", type=float, default=.1,
+            help="relative median change to flag (default: %(default)s)")
+    args = parser.parse_args()
+
+    names = args.benchmark or list(BENCHMARKS)
+    for name in names:
+        if name not in BENCHMARKS:
+            parser.error("unknown benchmark {}".format(name))
+
+    results = dict()
+    for name in names:
+        s = results[name] = measure(BENCHMARKS[name], args.repeat)
+        line = "{:14s} median {:8.4f} s  min {:8.4f} s  stdev {:7.4f} s"
+        line = line.format(name, s["median"], s["min"], s["stdev"])
+        if "bits_per_s" in s:
+            line += "  {:8.0f} bit/s".format(s["bits_per_s"])
+        print(line, flush=True)
+    report = dict(environment=environment(), results=results)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=1, sort_keys=True)
+    if args.update:
+        os.makedirs(os.path.dirname(args.baseline) or ".", exist_ok=True)
+        with open(args.baseline, "w") as f:
+            json.dump(report, f, indent=1, sort_keys=True)
+        return
+    if not os.path.exists(args.baseline):
+        return
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    print("baseline: {}".format(baseline["environment"]["revision"]))
+    changes = compare(results, baseline["results"], args.tolerance)
+    for name, base, current, ratio in changes:
+        print("{} {}: {:.4g} s -> {:.4g} s ({:+.0%})".format(
+            "REGRESSION" if ratio > 1 else "IMPROVEMENT", name, base,
+            current, ratio - 1))
+    if any(ratio > 1 for name, base, current, ratio in changes):
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,208 @@
+"""CFG/Status word codec
+
+Packs CFG words and unpacks Status words with the field tables in
+:mod:`urukul_layout`, which are generated from the :class:`urukul.CFG` and
+:class:`urukul.Status` records of the default gateware (``--update``). Neither
+module imports migen. NumPy is only needed for the batch functions.
+
+Without arguments, the tables (and ``PROTO_REV`` and the protocol options)
+are checked against the records and the codec round trips are tested. Run
+it whenever the layouts, ``__proto_rev__`` or the options change.
+"""
+
+import argparse
+import json
+import os
+import random
+
+import urukul_layout as layout
+
+
+class Codec:
+    """Codec for a register layout
+
+    :param fields: ``{name: (offset, width)}``
+    """
+    def __init__(self, fields):
+        self.fields = dict(fields)
+        self.width = max(o + w for o, w in self.fields.values())
+        self._table = [(k, o, (1 << w) - 1)
+                       for k, (o, w) in sorted(self.fields.items(),
+                           key=lambda kv: kv[1])]
+        self._index = {k: (o, m) for k, o, m in self._table}
+
+    def _field(self, name):
+        try:
+            return self._index[name]
+        except KeyError:
+            raise ValueError("unknown field", name) from None
+
+    def encode(self, word=0, **values):
+        """Replace the given fields in ``word``"""
+        for k, v in values.items():
+            o, m = self._field(k)
+            if v & ~m:
+                raise ValueError("field overflow", k, v)
+            word = (word & ~(m << o)) | (v << o)
+        return word
+
+    def decode(self, word):
+        """``{name: value}`` of all fields in ``word``"""
+        return {k: (word >> o) & m for k, o, m in self._table}
+
+    def get(self, word, name):
+        """Value of a single field"""
+        o, m = self._field(name)
+        return (word >> o) & m
+
+    def encode_batch(self, words=0, **columns):
+        """Vectorized :meth:`encode`
+
+        ``words`` and the field values are scalars or arrays (broadcast).
+        Returns a ``uint64`` NumPy array.
+        """
+        import numpy as np
+        words = np.array(words, dtype=np.uint64)
+        for k, v in columns.items():
+            o, m = self._field(k)
+            v = np.asarray(v, dtype=np.uint64)
+            if np.any(v & np.uint64(~m & (2**64 - 1))):
+                raise ValueError("field overflow", k)
+            words = (words & np.uint64(~(m << o) & (2**64 - 1))) | (
+                    v << np.uint64(o))
+        return words
+
+    def decode_batch(self, words):
+        """Vectorized :meth:`decode`: ``{name: uint64 array}``"""
+        import numpy as np
+        words = np.asarray(words, dtype=np.uint64)
+        return {k: (words >> np.uint64(o)) & np.uint64(m)
+                for k, o, m in self._table}
+
+
+CFG = Codec(layout.CFG)
+STATUS = Codec(layout.STATUS)
+PROTO_REV = layout.PROTO_REV
+
+
+def options(proto_rev):
+    """Names of the protocol options reported by ``proto_rev`` (none for a
+    default build, see :func:`urukul.protocol_revision`)"""
+    if not proto_rev & layout.PROTO_REV_OPTIONS:
+        return []
+    return [k for i, k in enumerate(layout.OPTIONS) if (proto_rev >> i) & 1]
+
+
+def generate():
+    """Field tables and protocol revision of the default gateware"""
+    from urukul import Urukul, __proto_rev__, PROTO_REV_OPTIONS, OPTIONS
+    from urukul_cpld import Platform
+
+    dut = Urukul(Platform())
+    return dict(PROTO_REV=__proto_rev__, PROTO_REV_OPTIONS=PROTO_REV_OPTIONS,
+                OPTIONS=list(OPTIONS), CFG=layout.fields(dut.cfg.data),
+                STATUS=layout.fields(dut.stat.data))
+
+
+def check():
+    """Differences between :mod:`urukul_layout` and the gateware
+
+    Returns ``[(name, table, gateware)]``.
+    """
+    r = []
+    for k, v in sorted(generate().items()):
+        if getattr(layout, k, None) != v:
+            r.append((k, getattr(layout, k, None), v))
+    return r
+
+
+def selftest(seed=None):
+    """Round trips of random field values through :meth:`Codec.encode`,
+    :meth:`Codec.decode`, :meth:`Codec.get` and the batch functions"""
+    import numpy as np
+
+    rng = random.Random(seed)
+    for codec in CFG, STATUS:
+        rows = [{k: rng.randrange(1 << w) for k, (o, w) in
+                 codec.fields.items()} for i in range(64)]
+        words = [codec.encode(**r) for r in rows]
+        for w, r in zip(words, rows):
+            assert 0 <= w < 1 << codec.width, w
+            assert codec.decode(w) == r, (w, r)
+            assert all(codec.get(w, k) == v for k, v in r.items())
+        # a field at a non-zero offset, replaced in place
+        k, (o, n) = max(codec.fields.items(), key=lambda kv: kv[1])
+        assert o > 0
+        assert codec.encode(**{k: 1}) == 1 << o
+        assert codec.encode(words[0], **{k: 0}) == words[0] & ~(
+                ((1 << n) - 1) << o)
+        try:
+            codec.encode(**{k: 1 << n})
+        except ValueError:
+            pass
+        else:
+            raise AssertionError("no overflow error")
+
+        columns = {k: np.array([r[k] for r in rows], dtype=np.uint64)
+                   for k in codec.fields}
+        batch = codec.encode_batch(**columns)
+        assert [int(w) for w in batch] == words
+        assert [int(w) for w in codec.encode_batch(batch, **{k: 0})] == [
+                codec.encode(w, **{k: 0}) for w in words]
+        decoded = codec.decode_batch(batch)
+        assert set(decoded) == set(codec.fields)
+        for k, v in decoded.items():
+            assert np.array_equal(v, columns[k]), k
+        try:
+            codec.encode_batch(**{k: [0, 1 << n]})
+        except ValueError:
+            pass
+        else:
+            raise AssertionError("no batch overflow error")
+
+
+# start of the generated part of urukul_layout.py
+MARKER = ("# Generated by `python urukul_codec.py --update`. Do not edit "
+          "below.\n")
+
+
+def write(filename, tables):
+    """Replace the generated part of ``filename``"""
+    with open(filename) as f:
+        head = f.read().split(MARKER)[0]
+    with open(filename, "w") as f:
+        f.write(head + MARKER + "\n")
+        f.write("PROTO_REV = {}\n".format(tables["PROTO_REV"]))
+        f.write("PROTO_REV_OPTIONS = {:#x}\n".format(
+            tables["PROTO_REV_OPTIONS"]))
+        f.write("\n# PROTO_REV bit i: OPTIONS[i]\nOPTIONS = {}\n".format(
+            json.dumps(tables["OPTIONS"])))
+        for k in "CFG", "STATUS":
+            f.write("\n# name: (offset, width)\n{} = {{\n".format(k))
+            for name, (o, w) in sorted(tables[k].items(),
+                    key=lambda kv: kv[1]):
+                f.write("    \"{}\": ({}, {}),\n".format(name, o, w))
+            f.write("}\n")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+            description="Urukul CFG/Status codec table check")
+    parser.add_argument("-u", "--update", action="store_true",
+            help="regenerate urukul_layout.py from the gateware")
+    args = parser.parse_args()
+
+    if args.update:
+        write(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+            "urukul_layout.py"), generate())
+        return
+    diff = check()
+    for k, table, gateware in diff:
+        print("MISMATCH {}: table {} gateware {}".format(k, table, gateware))
+    if diff:
+        raise SystemExit(1)
+    selftest()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,242 @@
+"""Toggle and functional coverage for the compiled simulation
+
+:class:`Coverage` samples the complete signal state of a
+:class:`urukul_fastsim.FastSimulator` once per sys cycle from a single
+passive generator that reads the compiled signal storage in bulk (no per
+signal requests or callbacks):
+
+  - toggle coverage: rising and falling transitions per signal bit,
+    accumulated with NumPy only on cycles where any signal changed
+  - functional bins, derived from the CS and IFC_MODE tables in the
+    :class:`urukul.Urukul` docstring: every CS selection (with and without
+    EN_NU), every IFC_MODE bit in both states, DDS[i].CS_N asserted for each
+    EN_NU/CFG.MASK_NU[i] combination, ATT[i].LE fired, and every CFG bit
+    toggled
+
+Coverage data is a JSON-able dict (:meth:`Coverage.data`). :func:`merge`
+combines data from several runs or parallel shards.
+"""
+
+from collections import Counter
+import argparse
+import json
+import operator
+
+import numpy as np
+from migen.fhdl.namer import build_namespace
+
+
+def doc_table(doc, first):
+    """Rows (lists of cells) of the table in ``doc`` whose first header cell
+    is ``first``. Continuation rows (empty first cell) are joined."""
+    rows = None
+    for line in doc.splitlines():
+        line = line.strip()
+        if not line.startswith("|"):
+            if rows:
+                break
+            continue
+        cells = [c.strip() for c in line.strip("|").split("|")]
+        if rows is None:
+            if cells[0] == first:
+                rows = []
+        elif set(line) <= set("|-+ "):
+            continue
+        elif not cells[0] and rows:
+            rows[-1] = [" ".join(filter(None, (a, b)))
+                        for a, b in zip(rows[-1], cells)]
+        else:
+            rows.append(cells)
+    if rows is None:
+        raise ValueError("no table", first)
+    return rows
+
+
+def cs_table():
+    """``[(cs, chip)]`` from the CS table of :class:`urukul.Urukul`"""
+    from urukul import Urukul
+    return [(int(cs.split("=")[0]), chip)
+            for cs, chip in doc_table(Urukul.__doc__, "CS")]
+
+
+def ifc_mode_table():
+    """``[(bit, name)]`` from the IFC_MODE table of :class:`urukul.Urukul`"""
+    from urukul import Urukul
+    return [(int(bit), name)
+            for bit, name, *_ in doc_table(Urukul.__doc__, "IFC_MODE")]
+
+
+class Coverage:
+    """Coverage collector for a TB (:class:`urukul_sim.TB`) simulation
+
+    Add :meth:`sampler` to the sys generators of every run (after
+    ``FastSimulator.reset()`` as well).
+    """
+    def __init__(self, sim, tb):
+        self.sim = sim
+        program = sim.program
+        ev = sim.evaluator
+        ns = build_namespace(program.signals)
+        slots = [n for n, s in enumerate(program.signals)
+                 if s.nbits <= 63 and not s.signed]
+        self.names = [ns.get_name(program.signals[n]) for n in slots]
+        self.widths = [program.signals[n].nbits for n in slots]
+        self._state = operator.itemgetter(*slots)
+        self.rose = np.zeros(len(slots), np.int64)
+        self.fell = np.zeros(len(slots), np.int64)
+        cfg = tb.dut.cfg.data
+        self.cfg = {name: ns.get_name(getattr(cfg, name))
+                    for name, *_ in cfg.layout if name != "dummy"}
+        # cs, ifc_mode, mask_nu, dds cs_n, att le
+        self._probe = operator.itemgetter(*(ev.slot(s) for s in
+            [tb.cs, tb.ifc_mode, cfg.mask_nu] + [d.cs_n for d in tb.dds] +
+            [tb.att.le]))
+        self.states = Counter()
+        self.transitions = Counter()
+
+    def sampler(self):
+        """Passive generator sampling once per sys cycle"""
+        yield "passive"
+        v = self.sim.evaluator.v
+        state = self._state
+        probe = self._probe
+        states = self.states
+        prev = state(v)
+        prev_a = np.array(prev, np.int64)
+        last = probe(v)
+        while True:
+            yield
+            s = state(v)
+            if s != prev:
+                a = np.array(s, np.int64)
+                self.rose |= a & ~prev_a
+                self.fell |= prev_a & ~a
+                prev, prev_a = s, a
+            p = probe(v)
+            states[p] += 1
+            if p != last:
+                self.transitions[last, p] += 1
+                last = p
+
+    def bins(self):
+        """Functional bin hit counts (cycles, or events for ATT LE)"""
+        b = Counter()
+        cs_names = dict(cs_table())
+        for cs, chip in cs_names.items():
+            if cs:
+                b["CS={} {}".format(cs, chip)] += 0
+                if cs < 4:
+                    b["EN_NU CS={} {}".format(cs, chip)] += 0
+        b["EN_NU NU_CS"] += 0
+        ifc = ifc_mode_table()
+        for bit, name in ifc:
+            for x in range(2):
+                b["{}={}".format(name, x)] += 0
+        for i in range(4):
+            for en_nu in range(2):
+                for mask in range(2):
+                    b["DDS{} CS_N EN_NU={} MASK_NU={}".format(
+                        i, en_nu, mask)] += 0
+            b["ATT{} LE".format(i)] += 0
+
+        for (cs, ifc_mode, mask_nu, *cs_n, le), n in self.states.items():
+            en_nu = (ifc_mode >> 1) & 1
+            if en_nu:
+                if cs & 3:
+                    b["EN_NU CS={} {}".format(cs & 3, cs_names[cs & 3])] += n
+                if cs & 4:
+                    b["EN_NU NU_CS"] += n
+            elif cs:
+                b["CS={} {}".format(cs, cs_names[cs])] += n
+            for bit, name in ifc:
+                b["{}={}".format(name, (ifc_mode >> bit) & 1)] += n
+            for i in range(4):
+                if not cs_n[i]:
+                    b["DDS{} CS_N EN_NU={} MASK_NU={}".format(
+                        i, en_nu, (mask_nu >> i) & 1)] += n
+        for (a, c), n in self.transitions.items():
+            for i in range(4):
+                if (c[-1] >> i) & 1 and not (a[-1] >> i) & 1:
+                    b["ATT{} LE".format(i)] += n
+        return dict(b)
+
+    def data(self):
+        """JSON-able coverage data (see :func:`merge`)"""
+        toggle = {name: [w, int(r) & ((1 << w) - 1), int(f) & ((1 << w) - 1)]
+                  for name, w, r, f in zip(self.names, self.widths,
+                      self.rose.tolist(), self.fell.tolist())}
+        return dict(toggle=toggle, bins=self.bins(), cfg=dict(self.cfg))
+
+    def clear(self):
+        self.rose[:] = 0
+        self.fell[:] = 0
+        self.states.clear()
+        self.transitions.clear()
+
+
+def merge(*data):
+    """Merge coverage data: toggles are OR-ed, bin hits added"""
+    r = dict(toggle=dict(), bins=Counter(), cfg=dict())
+    for d in data:
+        for name, (w, rose, fell) in d["toggle"].items():
+            w0, r0, f0 = r["toggle"].get(name, (w, 0, 0))
+            r["toggle"][name] = [max(w, w0), rose | r0, fell | f0]
+        r["bins"].update(d["bins"])
+        r["cfg"].update(d["cfg"])
+    r["bins"] = dict(r["bins"])
+    return r
+
+
+def summary(data):
+    """``(toggled bits, total bits, [uncovered bins])``
+
+    The CFG bit bins are derived from the toggle data.
+    """
+    toggled = total = 0
+    for w, rose, fell in data["toggle"].values():
+        toggled += bin(rose & fell).count("1")
+        total += w
+    missing = sorted(k for k, n in data["bins"].items() if not n)
+    for field, name in sorted(data["cfg"].items()):
+        w, rose, fell = data["toggle"].get(name, (1, 0, 0))
+        for i in range(w):
+            if not ((rose & fell) >> i) & 1:
+                missing.append("CFG.{}[{}] toggle".format(field.upper(), i))
+    return toggled, total, missing
+
+
+def report(data):
+    toggled, total, missing = summary(data)
+    hit = sum(1 for n in data["bins"].values() if n)
+    lines = ["toggle coverage: {}/{} bits ({:.1f}%)".format(
+                toggled, total, 100*toggled/total if total else 0),
+             "functional bins: {}/{} hit".format(hit, len(data["bins"]))]
+    lines += ["  not covered: " + m for m in missing]
+    return "\n".join(lines)
+
+
+def load(filename):
+    with open(filename) as f:
+        return json.load(f)
+
+
+def save(data, filename):
+    with open(filename, "w") as f:
+        json.dump(data, f, indent=1, sort_keys=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+            description="Urukul coverage merge and report")
+    parser.add_argument("coverage", nargs="+", help="coverage JSON files")
+    parser.add_argument("-o", "--output", help="write the merged coverage")
+    args = parser.parse_args()
+
+    data = merge(*(load(f) for f in args.coverage))
+    if args.output:
+        save(data, args.output)
+    print(report(data))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,907 @@
+from collections import defaultdict
+import collections
+import heapq
+import inspect
+import math
+import operator
+import time
+
+from migen import *
+from migen.fhdl.structure import (_Operator, _Slice, _Part, _ArrayProxy,
+                                  _Assign)
+from migen.fhdl.bitcontainer import value_bits_sign
+from migen.fhdl.tools import list_targets
+from migen.fhdl.visit import NodeVisitor
+from migen.fhdl.namer import build_namespace
+from migen.sim.core import Simulator, Evaluator, TimeManager, _truncate
+from migen.sim.vcd import DummyVCDWriter
+
+
+class SimulationMismatch(Exception):
+    """Compiled and reference (pysim) simulation diverged"""
+
+
+class _Reads(NodeVisitor):
+    def __init__(self, clock_domains):
+        self.clock_domains = clock_domains
+        self.signals = set()
+
+    def visit_Signal(self, node):
+        self.signals.add(node)
+
+    def visit_ClockSignal(self, node):
+        self.signals.add(self.clock_domains[node.cd].clk)
+
+    def visit_ResetSignal(self, node):
+        rst = self.clock_domains[node.cd].rst
+        if rst is not None:
+            self.signals.add(rst)
+
+
+_binops = {
+    "+": "+", "-": "-", "*": "*",
+    ">>>": ">>", "<<<": "<<",
+    "&": "&", "^": "^", "|": "|",
+    "<": "<", "<=": "<=", "==": "==", "!=": "!=", ">": ">", ">=": ">=",
+}
+
+
+class _Compiler:
+    """Lowers a prepared fragment into straight-line Python
+
+    All signal values live in one list indexed by a per-signal slot. The
+    semantics match :class:`migen.sim.core.Evaluator` exactly:
+
+    * sync statements read committed values and write pending
+      modifications (dict ``m``) that are committed at the end of the tick
+    * comb statements are grouped into blocks by their targets, ordered
+      topologically and evaluated in place until they settle
+
+    With ``profile``, the comb function accumulates the time and evaluation
+    count per comb block (``block_time``, ``block_count``, source lines in
+    ``block_lines``) and the number of changes per comb driven signal
+    (``changes``).
+    """
+    def __init__(self, fragment, profile=False):
+        self.fragment = fragment
+        self.profile = profile
+        self.clock_domains = fragment.clock_domains
+        self.slots = dict()
+        self.signals = []
+        self.tmp = 0
+        self.cyclic = False
+
+        for stmts in [fragment.comb] + list(fragment.sync.values()):
+            for signal in self.reads(stmts) | list_targets(stmts):
+                self.slot(signal)
+        for cd in self.clock_domains:
+            self.slot(cd.clk)
+            if cd.rst is not None:
+                self.slot(cd.rst)
+
+        self.source = []
+        self.comb_blocks = self.order(self.group(fragment.comb))
+        self.emit_comb()
+        self.sync = dict()
+        for cd, stmts in sorted(fragment.sync.items()):
+            self.emit_sync(cd, stmts)
+        self.source = "\n".join(self.source) + "\n"
+        namespace = {"_truncate": _truncate}
+        if profile:
+            self.block_time = [0.]*len(self.comb_blocks)
+            self.block_count = [0]*len(self.comb_blocks)
+            self.changes = [0]*len(self.signals)
+            namespace.update(_clock=time.perf_counter, _bt=self.block_time,
+                    _bn=self.block_count, _ch=self.changes)
+        exec(compile(self.source, "<urukul_fastsim>", "exec"), namespace)
+        self.comb = namespace["comb"]
+        self.sync = {cd: namespace[name] for cd, name in self.sync.items()}
+
+    def slot(self, signal):
+        try:
+            return self.slots[signal]
+        except KeyError:
+            n = self.slots[signal] = len(self.signals)
+            self.signals.append(signal)
+            return n
+
+    def reads(self, node):
+        v = _Reads(self.clock_domains)
+        v.visit(node)
+        return v.signals
+
+    def new_tmp(self):
+        self.tmp += 1
+        return "_x{}".format(self.tmp)
+
+    # expressions
+
+    def signal(self, node, pc):
+        n = self.slot(node)
+        if pc is not None and n in pc:
+            return pc[n]
+        return "v[{}]".format(n)
+
+    def expr(self, node, pc=None):
+        if isinstance(node, Constant):
+            return repr(node.value)
+        elif isinstance(node, Signal):
+            return self.signal(node, pc)
+        elif isinstance(node, _Operator):
+            ops = [self.expr(o, pc) for o in node.operands]
+            if node.op == "m":
+                return "({} if {} else {})".format(ops[1], ops[0], ops[2])
+            elif node.op == "~":
+                return "(~{})".format(ops[0])
+            elif node.op == "-" and len(ops) == 1:
+                return "(-{})".format(ops[0])
+            else:
+                return "({} {} {})".format(ops[0], _binops[node.op], ops[1])
+        elif isinstance(node, _Slice):
+            return "(({} >> {}) & {})".format(self.expr(node.value, pc),
+                    node.start, 2**(node.stop - node.start) - 1)
+        elif isinstance(node, _Part):
+            return "(({} >> {}) & {})".format(self.expr(node.value, pc),
+                    self.expr(node.offset, pc), 2**node.width - 1)
+        elif isinstance(node, Cat):
+            terms = []
+            shift = 0
+            for element in node.l:
+                nbits = len(element)
+                term = "({} & {})".format(self.expr(element, pc),
+                        2**nbits - 1)
+                if shift:
+                    term = "({} << {})".format(term, shift)
+                terms.append(term)
+                shift += nbits
+            if not terms:
+                return "0"
+            return "({})".format(" | ".join(terms))
+        elif isinstance(node, Replicate):
+            nbits = len(node.v)
+            k = sum(1 << i*nbits for i in range(node.n))
+            return "(({} & {}) * {})".format(self.expr(node.v, pc),
+                    2**nbits - 1, k)
+        elif isinstance(node, _ArrayProxy):
+            return "({},)[min({}, {})]".format(
+                    ", ".join(self.expr(c, pc) for c in node.choices),
+                    len(node.choices) - 1, self.expr(node.key, pc))
+        elif isinstance(node, ClockSignal):
+            return self.expr(self.clock_domains[node.cd].clk, pc)
+        elif isinstance(node, ResetSignal):
+            rst = self.clock_domains[node.cd].rst
+            if rst is None:
+                if node.allow_reset_less:
+                    return "0"
+                raise ValueError("Attempted to get reset signal of resetless"
+                                 " domain '{}'".format(node.cd))
+            return self.expr(rst, pc)
+        else:
+            raise NotImplementedError(node)
+
+    def truncate(self, node, value):
+        if node.signed:
+            return "_truncate({}, {}, True)".format(value, node.nbits)
+        return "({} & {})".format(value, 2**node.nbits - 1)
+
+    # statements
+
+    def assign(self, node, value, ctx, out, ind):
+        write, pc = ctx
+        if isinstance(node, Signal):
+            out.append(ind + write(self.slot(node), self.truncate(node, value)))
+        elif isinstance(node, Cat):
+            x = self.new_tmp()
+            out.append("{}{} = {}".format(ind, x, value))
+            shift = 0
+            for element in node.l:
+                nbits = len(element)
+                self.assign(element, "(({} >> {}) & {})".format(
+                    x, shift, 2**nbits - 1), ctx, out, ind)
+                shift += nbits
+        elif isinstance(node, (_Slice, _Part)):
+            x = self.new_tmp()
+            if isinstance(node, _Slice):
+                start = repr(node.start)
+                width = node.stop - node.start
+            else:
+                start = self.new_tmp()
+                width = node.width
+                out.append("{}{} = {}".format(ind, start,
+                    self.expr(node.offset, pc)))
+            out.append("{}{} = ({} & ~({} << {})) | (({} & {}) << {})".format(
+                ind, x, self.expr(node.value, pc), 2**width - 1, start,
+                value, 2**width - 1, start))
+            self.assign(node.value, x, ctx, out, ind)
+        elif isinstance(node, _ArrayProxy):
+            x = self.new_tmp()
+            k = self.new_tmp()
+            out.append("{}{} = {}".format(ind, x, value))
+            out.append("{}{} = min({}, {})".format(ind, k,
+                len(node.choices) - 1, self.expr(node.key)))
+            for i, choice in enumerate(node.choices):
+                out.append("{}{} {} == {}:".format(ind,
+                    "if" if i == 0 else "elif", k, i))
+                self.assign(choice, x, ctx, out, ind + "    ")
+        else:
+            raise NotImplementedError(node)
+
+    def statements(self, stmts, ctx, out, ind):
+        n = len(out)
+        for s in stmts:
+            if isinstance(s, _Assign):
+                self.assign(s.l, self.expr(s.r), ctx, out, ind)
+            elif isinstance(s, If):
+                out.append("{}if {} & {}:".format(ind, self.expr(s.cond),
+                    2**len(s.cond) - 1))
+                self.statements(s.t, ctx, out, ind + "    ")
+                if s.f:
+                    out.append(ind + "else:")
+                    self.statements(s.f, ctx, out, ind + "    ")
+            elif isinstance(s, Case):
+                nbits, signed = value_bits_sign(s.test)
+                x = self.new_tmp()
+                out.append("{}{} = _truncate({}, {}, {})".format(ind, x,
+                    self.expr(s.test), nbits, signed))
+                first = True
+                for k, v in s.cases.items():
+                    if isinstance(k, Constant):
+                        out.append("{}{} {} == {}:".format(ind,
+                            "if" if first else "elif", x, k.value))
+                        self.statements(v, ctx, out, ind + "    ")
+                        first = False
+                if "default" in s.cases:
+                    if first:
+                        self.statements(s.cases["default"], ctx, out, ind)
+                    else:
+                        out.append(ind + "else:")
+                        self.statements(s.cases["default"], ctx, out,
+                                ind + "    ")
+            elif isinstance(s, Display):
+                out.append("{}print({!r} % ({}{}))".format(ind, s.s,
+                    ", ".join(self.expr(a) for a in s.args),
+                    "," if s.args else ""))
+            elif isinstance(s, (list, tuple)):
+                self.statements(s, ctx, out, ind)
+            else:
+                raise NotImplementedError(s)
+        if len(out) == n:
+            out.append(ind + "pass")
+
+    # comb
+
+    def group(self, stmts):
+        """Merge statements sharing targets into blocks"""
+        owner = dict()
+        blocks = []
+        for s in stmts:
+            targets = list_targets(s)
+            merge = {owner[t] for t in targets if t in owner}
+            if merge:
+                keep = min(merge)
+                for b in sorted(merge - {keep}):
+                    blocks[keep][0].update(blocks[b][0])
+                    blocks[keep][1].extend(blocks[b][1])
+                    for t in blocks[b][0]:
+                        owner[t] = keep
+                    blocks[b] = None
+            else:
+                keep = len(blocks)
+                blocks.append((set(), []))
+            blocks[keep][0].update(targets)
+            blocks[keep][1].append(s)
+            for t in targets:
+                owner[t] = keep
+        return [b for b in blocks if b is not None]
+
+    def order(self, blocks):
+        """Topological order of comb blocks, original order among ties"""
+        owner = dict()
+        for i, (targets, stmts) in enumerate(blocks):
+            for t in targets:
+                owner[t] = i
+        deps = []
+        users = defaultdict(set)
+        for i, (targets, stmts) in enumerate(blocks):
+            d = {owner[s] for s in self.reads(stmts) if s in owner}
+            deps.append(d - {i})
+            for j in d - {i}:
+                users[j].add(i)
+        pending = [len(d) for d in deps]
+        ready = [i for i, n in enumerate(pending) if not n]
+        heapq.heapify(ready)
+        order = []
+        while ready:
+            i = heapq.heappop(ready)
+            order.append(i)
+            for j in users[i]:
+                pending[j] -= 1
+                if not pending[j]:
+                    heapq.heappush(ready, j)
+        if len(order) < len(blocks):
+            self.cyclic = True
+            done = set(order)
+            order.extend(i for i in range(len(blocks)) if i not in done)
+        # blocks reading their own targets are iterated locally
+        return [(targets, stmts, bool(self.reads(stmts) & targets))
+                for targets, stmts in (blocks[i] for i in order)]
+
+    def emit_comb(self):
+        out = self.source
+        out.append("def comb(v):")
+        out.append("    ch = False")
+        if self.profile:
+            self.block_lines = []
+            out.append("    _s = _clock()")
+        for i, (targets, stmts, loop) in enumerate(self.comb_blocks):
+            start = len(out) + 1
+            slots = sorted(self.slot(t) for t in targets)
+            pc = {n: "t{}".format(n) for n in slots}
+            ind = "    "
+            if loop:
+                out.append(ind + "while True:")
+                ind += "    "
+            for n in slots:
+                out.append("{}t{} = {}".format(ind, n,
+                    self.signals[n].reset.value))
+            body = [s for s in stmts if not (isinstance(s, _Assign)
+                and isinstance(s.l, Signal) and isinstance(s.r, Constant)
+                and s.r.value == s.l.reset.value)]
+            self.statements(body,
+                    (lambda n, x: "t{} = {}".format(n, x), pc), out, ind)
+            if loop:
+                out.append("{}if {}:".format(ind, " and ".join(
+                    "t{0} == v[{0}]".format(n) for n in slots)))
+                out.append(ind + "    break")
+                for n in slots:
+                    out.append("{}v[{}] = t{}".format(ind, n, n))
+                    if self.profile:
+                        out.append("{}_ch[{}] += 1".format(ind, n))
+                out.append(ind + "ch = True")
+            else:
+                for n in slots:
+                    out.append("{0}if t{1} != v[{1}]:".format(ind, n))
+                    out.append("{}    v[{}] = t{}".format(ind, n, n))
+                    out.append("{}    ch = True".format(ind))
+                    if self.profile:
+                        out.append("{}    _ch[{}] += 1".format(ind, n))
+            if self.profile:
+                self.block_lines.append((start, len(out)))
+                out.append("    _t = _clock()")
+                out.append("    _bt[{0}] += _t - _s; _bn[{0}] += 1".format(i))
+                out.append("    _s = _t")
+        out.append("    return ch")
+        out.append("")
+
+    # sync
+
+    def emit_sync(self, cd, stmts):
+        name = "sync_{}".format(len(self.sync))
+        self.sync[cd] = name
+        out = self.source
+        out.append("def {}(v, m):".format(name))
+        pc = {n: "m.get({0}, v[{0}])".format(n)
+              for n in (self.slot(t) for t in list_targets(stmts))}
+        self.statements(stmts,
+                (lambda n, x: "m[{}] = {}".format(n, x), pc), out, "    ")
+        out.append("")
+
+
+class _ListEvaluator(Evaluator):
+    """Generator request evaluator on the compiled signal storage
+
+    With a profiling ``program``, commits are counted per slot in ``writes``
+    and ``changes``.
+    """
+    def __init__(self, clock_domains, replaced_memories, program):
+        Evaluator.__init__(self, clock_domains, replaced_memories)
+        self.program = program
+        self.v = [s.reset.value for s in program.signals]
+        self.dirty = False
+        if program.profile:
+            self.writes = collections.Counter()
+            self.changes = collections.Counter()
+            self.commit = self._commit_counted
+
+    def slot(self, signal):
+        n = self.program.slot(signal)
+        if n == len(self.v):
+            self.v.append(signal.reset.value)
+        return n
+
+    @property
+    def signal_values(self):
+        return {s: self.v[n] for s, n in self.program.slots.items()}
+
+    @signal_values.setter
+    def signal_values(self, value):
+        pass
+
+    def commit(self):
+        v = self.v
+        changed = False
+        for n, x in self.modifications.items():
+            if v[n] != x:
+                v[n] = x
+                changed = True
+        self.modifications.clear()
+        return changed
+
+    def _commit_counted(self):
+        v = self.v
+        self.writes.update(self.modifications.keys())
+        changed = False
+        for n, x in self.modifications.items():
+            if v[n] != x:
+                v[n] = x
+                self.changes[n] += 1
+                changed = True
+        self.modifications.clear()
+        return changed
+
+    def eval(self, node, postcommit=False):
+        if isinstance(node, Signal):
+            n = self.slot(node)
+            if postcommit:
+                try:
+                    return self.modifications[n]
+                except KeyError:
+                    pass
+            return self.v[n]
+        return Evaluator.eval(self, node, postcommit)
+
+    def assign(self, node, value):
+        if isinstance(node, Signal):
+            assert not node.variable
+            n = self.slot(node)
+            value = _truncate(value, node.nbits, node.signed)
+            self.modifications[n] = value
+            if self.v[n] != value:
+                self.dirty = True
+        else:
+            Evaluator.assign(self, node, value)
+
+
+class Wait:
+    """Generator request: suspend for ``cycles`` cycles of the generator's
+    clock domain (see :class:`FastSimulator`)"""
+    def __init__(self, cycles):
+        if cycles < 0:
+            raise ValueError("negative wait", cycles)
+        self.cycles = cycles
+
+    def __repr__(self):
+        return "Wait({})".format(self.cycles)
+
+
+def expand_waits(generator):
+    """Generator wrapper expanding :class:`Wait` requests into bare
+    ``yield`` (for :class:`migen.sim.Simulator`)"""
+    reply = None
+    while True:
+        try:
+            request = generator.send(reply)
+        except StopIteration as e:
+            return e.value
+        reply = None
+        if isinstance(request, Wait):
+            for i in range(request.cycles):
+                yield
+        else:
+            reply = yield request
+
+
+class FastSimulator(Simulator):
+    """Compiled drop-in replacement for :class:`migen.sim.Simulator`
+
+    The fragment is prepared by the pysim constructor (specials lowering,
+    reset insertion, memory replacement) and then compiled once into Python
+    functions for the comb logic and each clock domain.
+
+    With ``check``, the pysim evaluator is run in lockstep and every signal
+    as well as every value returned to a generator is compared after each
+    clock transition. :class:`SimulationMismatch` is raised on the first
+    divergence.
+
+    ``wave`` takes a :class:`urukul_wave.WaveWriter` instead of
+    ``vcd_name``; only the signals it traces are diffed for output.
+
+    Generators can request ``yield Wait(n)``, equivalent to ``n`` bare
+    ``yield`` but without resuming the generator in between.
+
+    With ``idle`` (a list of signals, e.g. chip selects), quiescent periods
+    are skipped: when all ``idle`` signals are zero, every active generator
+    is in a :class:`Wait`, no generator changed a signal for a whole clock
+    hyperperiod (the LCM of the clock periods) and the complete state equals
+    that of one hyperperiod earlier, the simulation is periodic. If all
+    generators (passive ones included) are waiting, simulated time jumps
+    forward by whole hyperperiods up to the first wakeup; the waveform
+    changes recorded over one hyperperiod are repeated for the jumped
+    transitions. Otherwise (a passive generator samples every cycle) the
+    recorded state is replayed per transition instead of evaluating the
+    logic. Nothing is recorded while an active generator is not waiting, so
+    transfers run at full speed. ``ticks``, ``skipped`` (jumped or replayed
+    transitions), ``jumped`` (simulated time) and :meth:`speedup` report the
+    effect.
+
+    With ``profile``, the program is compiled with comb block timing and
+    signal activity counters (see :class:`urukul_sim.Profile`).
+    """
+    def __init__(self, fragment_or_module, generators, clocks={"sys": 10},
+            vcd_name=None, special_overrides={}, check=False, wave=None,
+            idle=None, profile=False):
+        if wave is not None and vcd_name is not None:
+            raise ValueError("either vcd_name or wave")
+        if check and idle is not None:
+            raise ValueError("either check or idle")
+        Simulator.__init__(self, fragment_or_module, generators,
+                clocks=clocks, vcd_name=vcd_name,
+                special_overrides=special_overrides)
+        self.reference = self.evaluator if check else None
+        self.program = _Compiler(self.fragment, profile)
+        self.evaluator = _ListEvaluator(self.fragment.clock_domains,
+                self.evaluator.replaced_memories, self.program)
+        if wave is not None:
+            self.vcd = wave
+            traced = wave.select(self.program.signals)
+            self.vcd_slots = [self.evaluator.slot(s) for s in traced]
+        else:
+            self.vcd_slots = range(len(self.program.signals))
+        self.vcd_changes = not isinstance(self.vcd, DummyVCDWriter)
+        self.clocks = clocks
+        self.t = 0
+        self.idle = None
+        if idle is not None:
+            self.idle = [self.evaluator.slot(s) for s in idle]
+            self.hyperperiod = math.lcm(*(c[0] if isinstance(c, tuple)
+                else c for c in clocks.values()))
+        self._reset_idle()
+
+    def _reset_idle(self):
+        self._waiting = dict()  # generator: remaining cycles
+        self.ticks = 0
+        self.skipped = 0
+        self.jumped = 0
+        self.idle_time = 0.  # in periodic (replayed or jumped) transitions
+        self.wall = 0.
+        self._snapshots = dict()  # phase: (t, v, waveform changes)
+        self._since = None  # start of the quiescent streak
+        self._periodic = False
+        self._changes = []
+
+    def reset(self, generators):
+        """Warm restart: restore the reset state and load new generators
+
+        The compiled program is reused. Not supported with VCD output.
+        """
+        if self.vcd_changes:
+            raise ValueError("reset() with VCD output")
+        ev = self.evaluator
+        ev.v = [s.reset.value for s in self.program.signals]
+        ev.modifications.clear()
+        if self.reference is not None:
+            self.reference.signal_values.clear()
+            self.reference.modifications.clear()
+        self.time = TimeManager(collections.OrderedDict(
+            sorted(self.clocks.items(), key=operator.itemgetter(0))))
+        self.t = 0
+        self._reset_idle()
+        if not isinstance(generators, dict):
+            generators = {"sys": generators}
+        self.generators = dict()
+        self.passive_generators = set()
+        for k, v in generators.items():
+            if (isinstance(v, collections.abc.Iterable)
+                    and not inspect.isgenerator(v)):
+                self.generators[k] = list(v)
+            else:
+                self.generators[k] = [v]
+
+    def _commit_and_comb_propagate(self):
+        ev = self.evaluator
+        if self.vcd_changes:
+            v = ev.v
+            before = [v[n] for n in self.vcd_slots]
+        if ev.commit():
+            comb = self.program.comb
+            if self.program.cyclic:
+                while comb(ev.v):
+                    pass
+            else:
+                comb(ev.v)
+            if self.vcd_changes:
+                signals = self.program.signals
+                for n, a in zip(self.vcd_slots, before):
+                    if a != v[n]:
+                        self.vcd.set(signals[n], v[n])
+                        if self.idle is not None:
+                            self._changes.append((signals[n], v[n]))
+        if self.reference is not None:
+            self._reference_propagate()
+            self._compare()
+
+    def _reference_propagate(self):
+        ref = self.reference
+        modified = ref.commit()
+        while modified:
+            ref.execute(self.fragment.comb)
+            modified = ref.commit()
+
+    def _compare(self):
+        values = self.reference.signal_values
+        v = self.evaluator.v
+        for n, s in enumerate(self.program.signals):
+            if values.get(s, s.reset.value) != v[n]:
+                self._mismatch("signal", s, values.get(s, s.reset.value),
+                        v[n])
+
+    def _mismatch(self, kind, what, ref, fast):
+        if isinstance(what, Signal):
+            ns = build_namespace(self.program.signals)
+            what = ns.get_name(what)
+        raise SimulationMismatch("t={}: {} {}: pysim={} fast={}".format(
+            self.t, kind, what, ref, fast))
+
+    def _process_generators(self, cd):
+        waiting = self._waiting
+        exhausted = []
+        for generator in self.generators[cd]:
+            n = waiting.get(generator)
+            if n is not None:
+                if n > 1:
+                    waiting[generator] = n - 1
+                    continue
+                del waiting[generator]
+            reply = None
+            while True:
+                try:
+                    request = generator.send(reply)
+                    reply = None
+                    if request is None:
+                        break  # next cycle
+                    elif isinstance(request, Wait):
+                        if request.cycles:
+                            waiting[generator] = request.cycles
+                            break
+                    elif isinstance(request, str):
+                        if request == "passive":
+                            self.passive_generators.add(generator)
+                        elif request == "active":
+                            self.passive_generators.discard(generator)
+                        else:
+                            raise ValueError("Unknown simulator command: "
+                                    "'{}'".format(request))
+                    else:
+                        try:
+                            reply = self._evalexec_nested_lists(request)
+                        except Exception:
+                            tb = inspect.getframeinfo(generator.gi_frame)
+                            print("While evaluating the following "
+                                    "generator, an error occurred:")
+                            print("  File {}, line {}, in {}".format(
+                                tb.filename, tb.lineno, tb.function))
+                            for c in tb.code_context:
+                                print("    ", c.lstrip())
+                            raise
+                except StopIteration:
+                    exhausted.append(generator)
+                    break
+        for generator in exhausted:
+            self.generators[cd].remove(generator)
+
+    def _evalexec_nested_lists(self, x):
+        r = Simulator._evalexec_nested_lists(self, x)
+        if self.reference is not None:
+            fast, self.evaluator = self.evaluator, self.reference
+            try:
+                ref = Simulator._evalexec_nested_lists(self, x)
+            finally:
+                self.evaluator = fast
+            if ref != r:
+                self._mismatch("reply", x, ref, r)
+        return r
+
+    def run(self):
+        ev = self.evaluator
+        ref = self.reference
+        sync = self.program.sync
+        clk = {cd.name: cd.clk for cd in self.fragment.clock_domains}
+
+        program = self.program
+        ev.modifications.clear()
+        if program.cyclic:
+            while program.comb(ev.v):
+                pass
+        else:
+            program.comb(ev.v)
+        if self.vcd_changes:
+            for n in self.vcd_slots:
+                self.vcd.set(program.signals[n], ev.v[n])
+        if ref is not None:
+            ref.execute(self.fragment.comb)
+            self._reference_propagate()
+            self._compare()
+
+        idle = self.idle is not None
+        t0 = time.perf_counter()
+        while True:
+            if idle and self._waiting:
+                if not self._run_idle(clk):
+                    break
+                continue
+            dt, rising, falling = self.time.tick()
+            self.t += dt
+            self.vcd.delay(dt)
+            self.ticks += 1
+            for cd in rising:
+                ev.assign(clk[cd], 1)
+                if ref is not None:
+                    ref.assign(clk[cd], 1)
+                if cd in sync:
+                    sync[cd](ev.v, ev.modifications)
+                    if ref is not None:
+                        ref.execute(self.fragment.sync[cd])
+                if cd in self.generators:
+                    self._process_generators(cd)
+            for cd in falling:
+                ev.assign(clk[cd], 0)
+                if ref is not None:
+                    ref.assign(clk[cd], 0)
+            self._commit_and_comb_propagate()
+
+            if not self._continue_simulation():
+                break
+        self.wall = time.perf_counter() - t0
+
+    def _tick(self, clk, rising, falling, done):
+        """Evaluate one clock transition, returns whether a generator changed
+        a signal. ``done`` maps clock domains whose generators already ran to
+        their modifications."""
+        ev = self.evaluator
+        sync = self.program.sync
+        dirty = False
+        for cd in rising:
+            ev.assign(clk[cd], 1)
+            if cd in sync:
+                sync[cd](ev.v, ev.modifications)
+            if cd in done:
+                ev.modifications.update(done[cd])
+                dirty = True
+            elif cd in self.generators:
+                ev.dirty = False
+                self._process_generators(cd)
+                dirty |= ev.dirty
+        for cd in falling:
+            ev.assign(clk[cd], 0)
+        self._changes = []
+        self._commit_and_comb_propagate()
+        return dirty
+
+    def _replay(self, rising):
+        """Replay a periodic transition, returns the generator modifications
+        per clock domain if a generator changed a signal instead"""
+        ev = self.evaluator
+        done = dict()
+        for cd in rising:
+            if cd in self.generators:
+                ev.dirty = False
+                self._process_generators(cd)
+                done[cd] = dict(ev.modifications)
+                ev.modifications.clear()
+                if ev.dirty:
+                    return done
+        t, v, changes = self._snapshots[self.t % self.hyperperiod]
+        ev.v[:] = v
+        for signal, value in changes:
+            self.vcd.set(signal, value)
+        return None
+
+    def _record(self, dirty):
+        """Snapshot the state after an evaluated transition, returns whether
+        the simulation became periodic"""
+        v = self.evaluator.v
+        if (dirty or not self._waiting or any(v[n] for n in self.idle)
+                or not self._waiting_all(self.passive_generators)):
+            self._since = None
+            return False
+        if self._since is None:
+            self._since = self.t
+        t0 = self.t - self.hyperperiod
+        phase = self.t % self.hyperperiod
+        s = self._snapshots.get(phase)
+        if (s is not None and s[0] == t0 and self._since <= t0
+                and s[1] == v):
+            return True
+        self._snapshots[phase] = self.t, list(v), self._changes
+        return False
+
+    def _waiting_all(self, exclude=()):
+        """Whether all generators not in ``exclude`` are in a
+        :class:`Wait`"""
+        waiting = self._waiting
+        return all(g in waiting or g in exclude
+                   for generators in self.generators.values()
+                   for g in generators)
+
+    def _jump(self):
+        """Jump over whole hyperperiods while all generators wait, returns
+        the number of skipped transitions"""
+        if not self._waiting_all():
+            return 0
+        clocks = self.time.clocks
+        wakeup = None
+        for cd, generators in self.generators.items():
+            c = clocks[cd]
+            rising = c.time_before_trans + (c.half_period if c.high else 0)
+            for g in generators:
+                t = rising + (self._waiting[g] - 1)*2*c.half_period
+                if wakeup is None or t < wakeup:
+                    wakeup = t
+        if wakeup is None:
+            return 0
+        m = (wakeup - 1)//self.hyperperiod
+        if m < 1:
+            return 0
+        n = m*len(self._snapshots)
+        if self.vcd_changes:
+            snapshots = self._snapshots
+            for i in range(n):
+                dt, rising, falling = self.time.tick()
+                self.t += dt
+                self.vcd.delay(dt)
+                for signal, value in snapshots[self.t % self.hyperperiod][2]:
+                    self.vcd.set(signal, value)
+        else:
+            # the clocks are periodic in the hyperperiod
+            self.t += m*self.hyperperiod
+        for cd, generators in self.generators.items():
+            cycles = m*self.hyperperiod//(2*clocks[cd].half_period)
+            for g in generators:
+                self._waiting[g] -= cycles
+        self.jumped += m*self.hyperperiod
+        return n
+
+    def _run_idle(self, clk):
+        """Simulate while a generator waits or the state is periodic,
+        returns whether the simulation continues"""
+        running = True
+        t0 = time.perf_counter()
+        while self._waiting or self._periodic:
+            dt, rising, falling = self.time.tick()
+            self.t += dt
+            self.vcd.delay(dt)
+            self.ticks += 1
+            done = {}
+            if self._periodic:
+                done = self._replay(rising)
+                if done is None:
+                    self.skipped += 1
+                else:
+                    self.idle_time += time.perf_counter() - t0
+                    self._periodic = False
+                    self._since = None
+            if not self._periodic:
+                dirty = self._tick(clk, rising, falling, done)
+                if self._record(dirty):
+                    t0 = time.perf_counter()
+                    self._periodic = True
+            if self._periodic:
+                n = self._jump()
+                self.ticks += n
+                self.skipped += n
+            if not self._continue_simulation():
+                running = False
+                break
+        if self._periodic:
+            self.idle_time += time.perf_counter() - t0
+        return running
+
+    def speedup(self):
+        """Estimated speedup of idle skipping over evaluating every
+        transition (at the measured cost per evaluated transition)"""
+        busy = self.ticks - self.skipped
+        if not busy or not self.skipped:
+            return 1.
+        return (self.wall - self.idle_time)/busy*self.ticks/self.wall
+
+
@@ -0,0 +1,476 @@
+"""Randomized SPI fuzzing with invariant checks
+
+Every seed generates a random interleaving of transactions: SPI transfers
+to random CS with random (also truncated) lengths, CS glitches (selected
+without an SCK edge), EEM1.SW toggles, IFC_MODE and DDS status changes, and
+QSPI bursts. The RTL (compiled simulation) is checked against invariants:
+
+  - ``cfg``: CFG only changes after a CFG selection with at least one SCK
+    rising edge (the FDPE glitch filter of the LE domain)
+  - ``att.le``: ATT[0:3].LE are high while ATT is not selected and low after
+    the first SCK rising edge while selected
+  - ``status``: the CFG readback matches the Status layout
+    (:data:`urukul_codec.STATUS`) of the current inputs and CFG.RF_SW
+
+Seeds are sharded across a process pool; every worker elaborates and
+compiles the gateware once and restarts the simulation for each seed.
+Failing seeds are shrunk to a minimal transaction sequence (removing
+transactions, then simplifying the remaining ones) and recorded (JSON) for
+replay.
+"""
+
+from collections import namedtuple
+import argparse
+import json
+import multiprocessing
+import operator
+import os
+import random
+import time
+
+import urukul_tlm as tlm
+from urukul_codec import CFG, STATUS, PROTO_REV
+
+
+Glitch = namedtuple("Glitch", "cs")
+Glitch.__doc__ = """CS asserted for one sys cycle, without an SCK edge"""
+
+Violation = namedtuple("Violation", "index transaction invariant detail")
+
+TRANSACTIONS = {t.__name__: t for t in (tlm.SPI, tlm.QSPI, tlm.Set, Glitch)}
+
+
+def encode(t):
+    """JSON-able transaction: ``[type, *fields]``"""
+    return [type(t).__name__] + list(t)
+
+
+def decode(t):
+    kind, *args = t
+    return TRANSACTIONS[kind](*args)
+
+
+def transactions(seed, count):
+    """Random transaction sequence of a seed"""
+    rng = random.Random(seed)
+    r = []
+    sw = 0
+    for i in range(count):
+        k = rng.random()
+        if k < .05:
+            r.append(tlm.Set("ifc_mode", rng.randrange(16)))
+        elif k < .15:
+            sw ^= 1 << rng.randrange(4)
+            r.append(tlm.Set("sw", sw))
+        elif k < .2:
+            r.append(tlm.Set(rng.choice(["smp_err", "pll_lock"]),
+                rng.randrange(16)))
+        elif k < .28:
+            r.append(Glitch(rng.randrange(8)))
+        elif k < .36:
+            n = rng.randrange(1, 33)
+            r.append(tlm.QSPI(n, [rng.randrange(1 << n) for j in range(4)]))
+        else:
+            n = rng.choice([1, 2, 7, 8, 23, 24, 25, 32, 40, 72,
+                rng.randrange(1, 81)])
+            r.append(tlm.SPI(rng.randrange(8), n, rng.randrange(1 << n)))
+    return r
+
+
+def _chip(cs, ifc_mode):
+    """Effective CS (CS2 is NU_CS with EN_NU)"""
+    return cs & 3 if (ifc_mode >> 1) & 1 else cs
+
+
+def _glitch(tb, cs, fault=False):
+    """Select ``cs`` for one sys cycle between two SCK rising edges
+
+    With ``fault``, the CFG latch is corrupted during the glitch (a broken
+    glitch filter, for checking the ``cfg`` invariant).
+    """
+    # assert CS while SCK is high, release it before the next rising edge
+    while not (yield tb.dut.cd_sck1.clk):
+        yield
+    yield tb.eem[0].io.eq(0)
+    yield tb.cs.eq(cs)
+    yield
+    if fault and (yield tb.dut.sr.sel):
+        yield tb.dut.sr.di.eq(~(yield tb.dut.sr.di))
+    yield tb.cs.eq(0)
+    yield
+    yield
+
+
+def _stimulus(tb, transactions, index, violations, fault=False):
+    inputs = tlm.rtl_inputs(tb)
+    state = dict.fromkeys(tlm.Urukul.inputs, 0)
+    width = len(tb.dut.sr.do)
+    for i, t in enumerate(transactions):
+        index[0] = i
+        if violations:
+            return
+        if isinstance(t, Glitch):
+            yield from _glitch(tb, t.cs, fault)
+            continue
+        cfg = yield tb.dut.cfg.data.raw_bits()
+        miso = yield from tlm.rtl_apply(tb, t, inputs)
+        if isinstance(t, tlm.Set):
+            state[t.pin] = t.value
+        elif (isinstance(t, tlm.SPI) and
+                _chip(t.cs, state["ifc_mode"]) == 1):
+            status = STATUS.encode(
+                    rf_sw=(state["sw"] | CFG.get(cfg, "rf_sw")) & 0xf,
+                    smp_err=state["smp_err"], pll_lock=state["pll_lock"],
+                    ifc_mode=state["ifc_mode"], proto_rev=PROTO_REV)
+            mask = (1 << t.n) - 1
+            expect = (((status << t.n) | (t.mosi & mask)) >> width) & mask
+            # the first bit is undefined
+            if (expect ^ miso) & (mask >> 1):
+                violations.append(Violation(i, t, "status",
+                    "readback {:#x} expected {:#x}".format(
+                        miso & (mask >> 1), expect & (mask >> 1))))
+
+
+def _monitor(sim, tb, index, violations):
+    """Check the per cycle invariants (``cfg``, ``att.le``)
+
+    Reads the compiled signal storage directly (one bulk read per cycle).
+    """
+    yield "passive"
+    dut = tb.dut
+    ev = sim.evaluator
+    fields = dut.cfg.data.flatten()
+    probe = operator.itemgetter(*(ev.slot(s) for s in [tb.cs, tb.ifc_mode,
+        dut.cd_sck1.clk, dut.sr.sel, tb.att.le] + fields))
+    v = ev.v
+    last = probe(v)[5:]
+    sck_q = sel_q = 0
+    armed = False  # SCK edge during the last CFG selection
+    edge = False  # SCK edge during the current ATT selection
+    while True:
+        cs, ifc_mode, sck, sel, le, *cfg = probe(v)
+        cfg = tuple(cfg)
+        rising = sck and not sck_q
+        if sel and not sel_q:
+            armed = False
+        if sel and rising:
+            armed = True
+        if cfg != last and not violations:
+            if not armed:
+                violations.append(Violation(index[0], None, "cfg",
+                    "CFG {:#x} -> {:#x} without an SCK edge".format(
+                        _pack(fields, last), _pack(fields, cfg))))
+            armed = False
+        last = cfg
+        if _chip(cs, ifc_mode) == 2:
+            if edge and le and not violations:
+                violations.append(Violation(index[0], None, "att.le",
+                    "LE {:#x} while selected".format(le)))
+            edge = edge or rising
+        else:
+            edge = False
+            if le != 0xf and not violations:
+                violations.append(Violation(index[0], None, "att.le",
+                    "LE {:#x} while not selected".format(le)))
+        sck_q, sel_q = sck, sel
+        yield
+
+
+def _pack(signals, values):
+    word = 0
+    for s, x in reversed(list(zip(signals, values))):
+        word = (word << len(s)) | x
+    return word
+
+
+class Fuzzer:
+    """Warm RTL simulation for repeated fuzz runs
+
+    The gateware is elaborated and compiled once; every :meth:`run` restarts
+    the simulation from reset.
+    """
+    def __init__(self):
+        from urukul import Urukul
+        from urukul_cpld import Platform
+        from urukul_sim import TB, sim_kwargs
+        from urukul_fastsim import FastSimulator
+
+        p = Platform()
+        dut = Urukul(p)
+        self.tb = TB(p, dut)
+        self.sim = FastSimulator(self.tb, [], **sim_kwargs(dut))
+
+    def run(self, transactions, fault=False, probes=()):
+        """Returns the first :class:`Violation` or ``None``
+
+        ``fault`` corrupts CFG on CFG glitches (see :func:`selftest`),
+        ``probes`` are additional generators.
+        """
+        index = [0]
+        violations = []
+        self.sim.reset([
+            _stimulus(self.tb, transactions, index, violations, fault),
+            _monitor(self.sim, self.tb, index, violations)] + list(probes))
+        self.sim.run()
+        if not violations:
+            return None
+        v = violations[0]
+        return v._replace(transaction=transactions[v.index])
+
+    def shrink(self, transactions, violation, budget=2000):
+        """Minimal sequence still violating ``violation.invariant``
+
+        Removes chunks of transactions (delta debugging on the prefix up to
+        the violation), then simplifies the remaining transactions (shorter
+        transfers, zero data). At most ``budget`` runs. Returns the sequence
+        and its violation.
+        """
+        runs = [0]
+
+        def fails(t):
+            if runs[0] >= budget:
+                return None
+            runs[0] += 1
+            v = self.run(t)
+            if v is not None and v.invariant == violation.invariant:
+                return v
+            return None
+
+        t = list(transactions[:violation.index + 1])
+        n = 2
+        while len(t) > 1 and runs[0] < budget:
+            chunk = -(-len(t)//n)
+            for i in range(0, len(t), chunk):
+                c = t[:i] + t[i + chunk:]
+                if fails(c):
+                    t = c
+                    n = max(n - 1, 2)
+                    break
+            else:
+                if n >= len(t):
+                    break
+                n = min(2*n, len(t))
+
+        changed = True
+        while changed and runs[0] < budget:
+            changed = False
+            for i in range(len(t)):
+                for c in _simpler(t[i]):
+                    u = t[:i] + [c] + t[i + 1:]
+                    if fails(u):
+                        t = u
+                        changed = True
+                        break
+        return t, self.run(t)
+
+
+def _simpler(t):
+    """Strictly simpler variants of a transaction"""
+    if isinstance(t, tlm.SPI):
+        if t.mosi:
+            yield t._replace(mosi=0)
+        for n in sorted({1, t.n//2, t.n - 1}):
+            if 1 <= n < t.n:
+                yield t._replace(n=n, mosi=t.mosi & ((1 << n) - 1))
+    elif isinstance(t, tlm.QSPI):
+        if any(t.mosi):
+            yield t._replace(mosi=[0]*4)
+        for n in sorted({1, t.n//2, t.n - 1}):
+            if 1 <= n < t.n:
+                yield t._replace(n=n, mosi=[m & ((1 << n) - 1)
+                    for m in t.mosi])
+    elif isinstance(t, tlm.Set):
+        for i in range(t.value.bit_length()):
+            if (t.value >> i) & 1:
+                yield t._replace(value=t.value & ~(1 << i))
+
+
+def report(seed, count, violation, shrunk):
+    """JSON-able failure record"""
+    r = dict(seed=seed, count=count, index=violation.index,
+             invariant=violation.invariant, detail=violation.detail,
+             transaction=encode(violation.transaction))
+    if shrunk is not None:
+        r["shrunk"] = [encode(t) for t in shrunk]
+    return r
+
+
+_worker = None
+
+
+def _init(count, shrink):
+    global _worker
+    _worker = Fuzzer(), count, shrink
+
+
+def _run(seed):
+    fuzzer, count, shrink = _worker
+    c0 = time.process_time()
+    t = transactions(seed, count)
+    v = fuzzer.run(t)
+    cpu = time.process_time() - c0
+    r = None
+    if v is not None:
+        shrunk = None
+        if shrink:
+            shrunk, sv = fuzzer.shrink(t, v)
+        r = report(seed, count, v, shrunk)
+    return seed, cpu, r, os.getpid()
+
+
+def run(seeds, count, jobs=None, shrink=True, chunksize=4, progress=None):
+    """Run ``seeds`` on ``jobs`` worker processes
+
+    Returns ``(summary, failures)``.
+    """
+    t0 = time.monotonic()
+    results = []
+    with multiprocessing.Pool(jobs, initializer=_init,
+            initargs=(count, shrink)) as pool:
+        for r in pool.imap_unordered(_run, seeds, chunksize):
+            results.append(r)
+            if progress is not None:
+                progress(len(results), len(seeds))
+    results.sort(key=lambda r: r[0])
+    failures = [f for seed, cpu, f, pid in results if f is not None]
+    return dict(
+        seeds=len(results),
+        transactions=count*len(results),
+        failed=len(failures),
+        workers=len(set(pid for seed, cpu, f, pid in results)),
+        wall=time.monotonic() - t0,
+        cpu=sum(cpu for seed, cpu, f, pid in results),
+    ), failures
+
+
+def selftest(fuzzer=None):
+    """Check the glitch stimulus and that the monitor catches a broken glitch
+    filter"""
+    if fuzzer is None:
+        fuzzer = Fuzzer()
+    tb = fuzzer.tb
+    t = [tlm.SPI(1, 24, 0x5a5a5a), Glitch(1), tlm.SPI(2, 8, 0x33), Glitch(2),
+         Glitch(1)]
+    glitches = []
+
+    def probe():
+        # selections released without an SCK edge (FDPE still preset)
+        yield "passive"
+        cs_q = le_q = 0
+        while True:
+            cs = yield tb.cs
+            if cs_q and not cs and le_q:
+                glitches.append(cs_q)
+            cs_q = cs
+            le_q = yield tb.dut.sr.cd_le.clk if cs == 1 else tb.att.le[0]
+            yield
+
+    v = fuzzer.run(t, probes=[probe()])
+    assert v is None, v
+    assert glitches == [1, 2, 1], glitches
+    v = fuzzer.run(t, fault=True)
+    assert v is not None and v.invariant == "cfg" and v.index == 1, v
+
+
+def load(filename):
+    """Recorded failures ``{seed: record}``"""
+    try:
+        with open(filename) as f:
+            return {r["seed"]: r for r in json.load(f)}
+    except FileNotFoundError:
+        return dict()
+
+
+def save(failures, filename):
+    with open(filename, "w") as f:
+        json.dump(sorted(failures.values(), key=lambda r: r["seed"]), f,
+                indent=1)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+            description="Urukul randomized SPI fuzzing")
+    parser.add_argument("-n", "--seeds", type=int, default=256,
+            help="number of seeds (default: %(default)s)")
+    parser.add_argument("-s", "--start", type=int, default=None,
+            help="first seed (default: random)")
+    parser.add_argument("-c", "--count", type=int, default=64,
+            help="transactions per seed (default: %(default)s)")
+    parser.add_argument("-j", "--jobs", type=int, default=None,
+            help="worker processes (default: CPU count)")
+    parser.add_argument("-f", "--failures", default="fuzz_failures.json",
+            help="failure record (default: %(default)s)")
+    parser.add_argument("--no-shrink", action="store_true",
+            help="do not shrink failing seeds")
+    parser.add_argument("--replay", type=int, action="append",
+            metavar="SEED", help="replay (and shrink) a seed in-process "
+            "(repeatable)")
+    parser.add_argument("--check", action="store_true",
+            help="re-run the shrunk sequences in the failure record")
+    parser.add_argument("--selftest", action="store_true",
+            help="check the glitch stimulus and the invariant monitor")
+    args = parser.parse_args()
+
+    if args.selftest:
+        selftest()
+        print("ok")
+        return
+
+    if args.replay or args.check:
+        fuzzer = Fuzzer()
+        failed = False
+        recorded = load(args.failures)
+        for seed in args.replay or []:
+            # the transaction count the seed was recorded with
+            count = recorded.get(seed, {}).get("count", args.count)
+            t = transactions(seed, count)
+            v = fuzzer.run(t)
+            print("seed {}: {}".format(seed, v))
+            if v is None:
+                continue
+            failed = True
+            if not args.no_shrink:
+                shrunk, sv = fuzzer.shrink(t, v)
+                print("shrunk to {} transactions: {}".format(
+                    len(shrunk), sv))
+                for ti in shrunk:
+                    print("  ", ti)
+        if args.check:
+            for seed, r in sorted(recorded.items()):
+                t = [decode(ti) for ti in r.get("shrunk", [])]
+                v = fuzzer.run(t) if t else None
+                print("seed {}: {}".format(seed, "FAIL {}".format(v)
+                    if v else "pass"))
+                failed = failed or v is not None
+        if failed:
+            raise SystemExit(1)
+        return
+
+    start = args.start
+    if start is None:
+        start = random.randrange(1 << 32)
+    seeds = list(range(start, start + args.seeds))
+    print("seeds {}..{}".format(seeds[0], seeds[-1]), flush=True)
+
+    def progress(i, total):
+        if i % 64 == 0 or i == total:
+            print("{}/{}".format(i, total), flush=True)
+
+    s, failures = run(seeds, args.count, args.jobs,
+            shrink=not args.no_shrink, progress=progress)
+    print("{} seeds ({} transactions) on {} workers: {:.3g} s wall, "
+          "{:.3g} s cpu".format(s["seeds"], s["transactions"], s["workers"],
+              s["wall"], s["cpu"]))
+    if not failures:
+        return
+    recorded = load(args.failures)
+    for r in failures:
+        recorded[r["seed"]] = r
+        print("FAIL seed {seed}: {invariant} at {index}: {detail}".format(**r))
+    save(recorded, args.failures)
+    print("recorded in {}, replay with --replay SEED".format(args.failures))
+    raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
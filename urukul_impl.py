@@ -1,10 +1,366 @@
-def main():
+"""CPLD implementation of gateware variants with a fit artifact cache
+
+A variant is a build name and a set of :class:`urukul.Urukul` generator
+parameters (:data:`VARIANTS` or a JSON file of the same form). Variants are
+built in parallel, each in a fresh worker process (the migen name tracer
+keeps global state), into ``BUILD_DIR/NAME.*``:
+
+  - The variant key hashes the parameters, the gateware sources and the
+    migen version. If it matches the key recorded by the last fit or cache
+    restore (``NAME.key``) and the outputs exist, the variant is skipped.
+    Dry runs do not record the key.
+  - The Verilog, UCF and XST files are generated (without ISE) and hashed
+    after normalization (comments and whitespace removed, toolchain
+    options included). If the hash is in the cache, the fit artifacts are
+    restored into the build directory instead of running ISE. The cache
+    keeps the ``--cache-size`` most recently used fits.
+
+``--dry-run`` only generates the sources and reports the decision.
+``--selftest`` checks the cache decisions with fake fit artifacts.
+"""
+
+import argparse
+import hashlib
+import json
+import multiprocessing
+import os
+import re
+import shutil
+import time
+
+
+ARTIFACTS = (".vm6", ".jed", ".isc", ".rpt", ".tim", ".pad", "_pad.csv")
+SOURCES = (".v", ".ucf", ".xst", ".prj")
+
+
+def _normalize(text, ext=".v"):
+    if ext == ".v":
+        text = re.sub(r"/\*.*?\*/", "", text, flags=re.S)
+        text = re.sub(r"//.*", "", text)
+    elif ext == ".ucf":
+        text = re.sub(r"#.*", "", text)
+    return " ".join(text.split())
+
+
+def digest(build_dir, build_name, platform):
+    """Normalized content hash of the generated sources"""
+    h = hashlib.sha256()
+    h.update(_normalize(" ".join((platform.device,
+        platform.toolchain.xst_opt, platform.toolchain.par_opt,
+        platform.toolchain.ngdbuild_opt)), None).encode())
+    for ext in SOURCES:
+        with open(os.path.join(build_dir, build_name + ext)) as f:
+            h.update(ext.encode())
+            h.update(_normalize(f.read(), ext).encode())
+    return h.hexdigest()
+
+
+class Cache:
+    """Directory of fit artifacts keyed by source hash, LRU evicted
+
+    Every entry is a subdirectory named by the hash. Its modification time
+    is the last use.
+    """
+    def __init__(self, path, size=8):
+        self.path = path
+        self.size = size
+
+    def entry(self, key):
+        return os.path.join(self.path, key)
+
+    def lookup(self, key, build_name):
+        """Whether all artifacts for ``key`` are cached"""
+        return all(os.path.exists(os.path.join(self.entry(key),
+            build_name + ext)) for ext in ARTIFACTS)
+
+    def restore(self, key, build_dir, build_name):
+        """Copy the cached artifacts into ``build_dir`` and mark the entry
+        as used"""
+        for ext in ARTIFACTS:
+            dst = os.path.join(build_dir, build_name + ext)
+            shutil.copyfile(os.path.join(self.entry(key), build_name + ext),
+                    dst)
+            os.utime(dst)
+        os.utime(self.entry(key))
+
+    def store(self, key, build_dir, build_name):
+        """Add the artifacts in ``build_dir`` and evict old entries
+
+        Safe against concurrent stores and evictions (parallel builds): the
+        entry is assembled in a per-process directory and renamed into
+        place.
+        """
+        tmp = "{}.{}.tmp".format(self.entry(key), os.getpid())
+        os.makedirs(tmp, exist_ok=True)
+        for ext in ARTIFACTS:
+            shutil.copyfile(os.path.join(build_dir, build_name + ext),
+                    os.path.join(tmp, build_name + ext))
+        shutil.rmtree(self.entry(key), ignore_errors=True)
+        try:
+            os.rename(tmp, self.entry(key))
+        except OSError:
+            # another process stored the same key (same content)
+            shutil.rmtree(tmp, ignore_errors=True)
+        self.evict()
+
+    def entries(self):
+        """Cached keys, most recently used first"""
+        try:
+            keys = os.listdir(self.path)
+        except FileNotFoundError:
+            return []
+        mtime = dict()
+        for k in keys:
+            if k.endswith(".tmp"):
+                continue
+            try:
+                mtime[k] = os.stat(self.entry(k)).st_mtime
+            except FileNotFoundError:
+                pass  # evicted concurrently
+        return sorted(mtime, key=mtime.get, reverse=True)
+
+    def evict(self):
+        for key in self.entries()[self.size:]:
+            shutil.rmtree(self.entry(key), ignore_errors=True)
+
+
+VARIANTS = {
+    "urukul": {},
+    "urukul_registered_miso": dict(registered_miso=True),
+    "urukul_eem0": dict(eem1=False),
+}
+
+# gateware sources (relative to this file) covered by the variant key
+GATEWARE = ("urukul.py", "urukul_cpld.py")
+
+
+def variant_key(params):
+    """Hash of the generator parameters, gateware sources and migen
+    version"""
+    from importlib import metadata
+
+    h = hashlib.sha256()
+    h.update(json.dumps(params, sort_keys=True).encode())
+    for name in GATEWARE:
+        with open(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                name), "rb") as f:
+            h.update(f.read())
+    try:
+        h.update(metadata.version("migen").encode())
+    except metadata.PackageNotFoundError:
+        pass
+    return h.hexdigest()
+
+
+def _read(filename):
+    try:
+        with open(filename) as f:
+            return f.read().strip()
+    except FileNotFoundError:
+        return None
+
+
+def _restore(cache, key, build_dir, build_name):
+    """Restore from the cache, ``False`` if the entry was evicted
+    concurrently"""
+    try:
+        cache.restore(key, build_dir, build_name)
+    except FileNotFoundError:
+        return False
+    return True
+
+
+def build(name, params, build_dir, cache=None, fit=True, force=False):
+    """Build one variant
+
+    Returns ``(name, status, source digest, time)`` with status one of
+    ``up to date`` (skipped), ``cached``, ``fit`` or, without ``fit``,
+    ``fit required``.
+    """
     from urukul_cpld import Platform
     from urukul import Urukul
 
+    key = variant_key(params)
+    stamp = os.path.join(build_dir, name + ".key")
+    outputs = SOURCES + (ARTIFACTS if fit else ())
+    if not force and _read(stamp) == key and all(os.path.exists(
+            os.path.join(build_dir, name + ext)) for ext in outputs):
+        return name, "up to date", None, 0.
+
+    t0 = time.monotonic()
+    # the stamp only describes fitted outputs
+    if os.path.exists(stamp):
+        os.remove(stamp)
     p = Platform()
-    urukul = Urukul(p)
-    p.build(urukul, build_name="urukul", mode="cpld")
+    p.build(Urukul(p, **params), build_dir=build_dir, build_name=name,
+            mode="cpld", run=False)
+    src = digest(build_dir, name, p)
+    hit = cache is not None and cache.lookup(src, name)
+    if not fit:
+        status = "cached" if hit else "fit required"
+    elif hit and _restore(cache, src, build_dir, name):
+        status = "cached"
+    else:
+        p = Platform()
+        p.build(Urukul(p, **params), build_dir=build_dir, build_name=name,
+                mode="cpld")
+        if cache is not None:
+            cache.store(src, build_dir, name)
+        status = "fit"
+    if fit:
+        with open(stamp, "w") as f:
+            f.write(key + "\n")
+    return name, status, src, time.monotonic() - t0
+
+
+def _build(args):
+    return build(*args)
+
+
+def build_all(variants, build_dir, cache=None, fit=True, force=False,
+        jobs=None):
+    """Build ``{name: params}`` on ``jobs`` worker processes (one per
+    variant), yields the :func:`build` results as they complete"""
+    os.makedirs(build_dir, exist_ok=True)
+    tasks = [(name, params, build_dir, cache, fit, force)
+             for name, params in sorted(variants.items())]
+    with multiprocessing.Pool(jobs, maxtasksperchild=1) as pool:
+        yield from pool.imap_unordered(_build, tasks)
+
+
+def _fake_fit(build_dir, name, text):
+    for ext in ARTIFACTS:
+        with open(os.path.join(build_dir, name + ext), "w") as f:
+            f.write(text)
+
+
+def _store(args):
+    cache, key, build_dir, name = args
+    cache.store(key, build_dir, name)
+
+
+def selftest():
+    """Cache decisions without ISE (fake fit artifacts in a temporary
+    directory)"""
+    import tempfile
+    from urukul_cpld import Platform
+
+    with tempfile.TemporaryDirectory() as tmp:
+        build_dir = os.path.join(tmp, "build")
+        cache = Cache(os.path.join(tmp, "cache"), size=2)
+
+        name, status, src, dt = build("urukul", {}, build_dir, cache,
+                fit=False)
+        assert status == "fit required", status
+        # the dry run does not record the key
+        assert build("urukul", {}, build_dir, cache,
+                fit=False)[1] == "fit required"
+
+        # comments and whitespace do not change the digest, code does
+        p = Platform()
+        v = os.path.join(build_dir, name + ".v")
+        ucf = os.path.join(build_dir, name + ".ucf")
+        with open(v) as f:
+            verilog = f.read()
+        with open(v, "a") as f:
+            f.write("\n// comment\n/* block\n comment */\n")
+        with open(ucf, "a") as f:
+            f.write("# comment\n\n")
+        assert digest(build_dir, name, p) == src
+        with open(v, "w") as f:
+            f.write(verilog.replace("endmodule", "wire x; endmodule", 1))
+        assert digest(build_dir, name, p) != src
+
+        # hit: restored without a fit, then up to date
+        _fake_fit(build_dir, name, "fit")
+        cache.store(src, build_dir, name)
+        for ext in ARTIFACTS:
+            os.remove(os.path.join(build_dir, name + ext))
+        assert build("urukul", {}, build_dir, cache, fit=False)[1] == \
+                "cached"
+        assert build("urukul", {}, build_dir, cache)[1] == "cached"
+        with open(os.path.join(build_dir, name + ".jed")) as f:
+            assert f.read() == "fit"
+        assert build("urukul", {}, build_dir, cache)[1] == "up to date"
+        assert build("urukul", {}, build_dir, cache,
+                force=True)[1] == "cached"
+
+        # LRU eviction at the cache size, restoring marks as used
+        lru = Cache(os.path.join(tmp, "lru"), size=2)
+        t = time.time()
+        lru.store("a", build_dir, name)
+        os.utime(lru.entry("a"), (t - 30, t - 30))
+        lru.store("b", build_dir, name)
+        os.utime(lru.entry("b"), (t - 20, t - 20))
+        lru.restore("a", build_dir, name)
+        lru.store("c", build_dir, name)
+        assert sorted(lru.entries()) == ["a", "c"], lru.entries()
+        lru.store(src, build_dir, name)
+        assert len(lru.entries()) == 2, lru.entries()
+        shutil.rmtree(cache.entry(src))
+        assert build("urukul", {}, build_dir, cache, fit=False,
+                force=True)[1] == "fit required"
+
+        # concurrent stores and evictions of the same and distinct keys
+        lru.size = 3
+        with multiprocessing.Pool(4) as pool:
+            pool.map(_store, [(lru, "k{}".format(i % 6), build_dir, name)
+                              for i in range(48)])
+        assert len(lru.entries()) == 3, lru.entries()
+        assert not [k for k in os.listdir(lru.path) if k.endswith(".tmp")]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Urukul CPLD build")
+    parser.add_argument("variant", nargs="*",
+            help="variants to build (default: urukul)")
+    parser.add_argument("--all", action="store_true",
+            help="build all variants")
+    parser.add_argument("--variants", metavar="FILE",
+            help="JSON file of variants ({name: {parameter: value}}) "
+            "instead of the built-in ones")
+    parser.add_argument("--build-dir", default="build")
+    parser.add_argument("-j", "--jobs", type=int, default=None,
+            help="worker processes (default: CPU count)")
+    parser.add_argument("--cache", default=os.path.join(
+            os.environ.get("XDG_CACHE_HOME",
+                os.path.expanduser("~/.cache")), "urukul"),
+            help="fit artifact cache directory (default: %(default)s)")
+    parser.add_argument("--cache-size", type=int, default=8,
+            help="number of cached fits (default: %(default)s)")
+    parser.add_argument("--no-cache", action="store_true",
+            help="always run the fit")
+    parser.add_argument("-f", "--force", action="store_true",
+            help="rebuild up to date variants")
+    parser.add_argument("-n", "--dry-run", action="store_true",
+            help="generate sources and report the decision only")
+    parser.add_argument("--selftest", action="store_true",
+            help="check the cache decisions (fake fits, no ISE)")
+    args = parser.parse_args()
+
+    if args.selftest:
+        selftest()
+        print("ok")
+        return
+
+    variants = VARIANTS
+    if args.variants:
+        with open(args.variants) as f:
+            variants = json.load(f)
+    names = list(variants) if args.all else args.variant or ["urukul"]
+    for name in names:
+        if name not in variants:
+            parser.error("unknown variant {}".format(name))
+        if not name.isidentifier():
+            parser.error("variant name is not an identifier: {}".format(
+                name))
+    selected = {name: variants[name] for name in names}
+
+    cache = None if args.no_cache else Cache(args.cache, args.cache_size)
+    for name, status, src, dt in build_all(selected, args.build_dir, cache,
+            fit=not args.dry_run, force=args.force, jobs=args.jobs):
+        print("{}: {}{} ({:.1f} s)".format(name, status,
+            "" if src is None else " " + src[:16], dt), flush=True)
 
 
 if __name__ == "__main__":
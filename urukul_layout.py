@@ -0,0 +1,51 @@
+"""CFG/Status register layouts of the default gateware
+
+Field tables ``{name: (offset, width)}`` and the protocol revision, generated
+from :class:`urukul.CFG` and :class:`urukul.Status` by ``python
+urukul_codec.py --update``. Does not import migen.
+"""
+
+
+def fields(record):
+    """Map field names of a Record to ``(offset, width)``"""
+    r = dict()
+    offset = 0
+    for name, width, *_ in record.layout:
+        r[name] = offset, width
+        offset += width
+    return r
+
+
+# Generated by `python urukul_codec.py --update`. Do not edit below.
+
+PROTO_REV = 9
+PROTO_REV_OPTIONS = 0x40
+
+# PROTO_REV bit i: OPTIONS[i]
+OPTIONS = ["registered_miso", "att_sel", "status_poll", "status_events", "io_update_seq", "cfg_mask"]
+
+# name: (offset, width)
+CFG = {
+    "rf_sw": (0, 4),
+    "led": (4, 4),
+    "profile": (8, 3),
+    "dummy": (11, 1),
+    "io_update": (12, 1),
+    "mask_nu": (13, 4),
+    "clk_sel0": (17, 1),
+    "sync_sel": (18, 1),
+    "rst": (19, 1),
+    "io_rst": (20, 1),
+    "clk_sel1": (21, 1),
+    "div": (22, 2),
+}
+
+# name: (offset, width)
+STATUS = {
+    "rf_sw": (0, 4),
+    "smp_err": (4, 4),
+    "pll_lock": (8, 4),
+    "ifc_mode": (12, 4),
+    "proto_rev": (16, 7),
+    "dummy": (23, 1),
+}
@@ -0,0 +1,196 @@
+"""Configuration space regression
+
+Runs one short scenario for every combination of
+
+  - IFC_MODE (all values of Status.IFC_MODE)
+  - VARIANT
+  - CFG.DIV
+  - CFG.MASK_NU
+  - CS (all values of the TB chip select)
+
+and checks the RTL against the transaction-level model (:mod:`urukul_tlm`).
+The matrix is derived from the CFG and Status record layouts. Scenarios are
+sharded across a process pool; every worker elaborates and compiles the
+gateware once and restarts the simulation for each scenario. With
+``--coverage`` every worker collects coverage (:mod:`urukul_coverage`) and
+the per-chunk data is merged.
+"""
+
+from collections import namedtuple
+import argparse
+import itertools
+import json
+import multiprocessing
+import os
+import time
+
+from urukul_layout import fields
+import urukul_tlm as tlm
+
+
+Scenario = namedtuple("Scenario", "ifc_mode variant div mask_nu cs")
+Scenario.__doc__ = """One point in the configuration space"""
+
+
+def matrix():
+    """Scenario matrix from the CFG/Status layouts and the TB CS width
+
+    Returns ``(cfg_fields, scenarios)``.
+    """
+    from urukul import Urukul
+    from urukul_cpld import Platform
+    from urukul_sim import TB
+
+    p = Platform()
+    tb = TB(p, Urukul(p))
+    cfg = fields(tb.dut.cfg.data)
+    stat = fields(tb.dut.stat.data)
+    space = Scenario(
+        ifc_mode=range(1 << stat["ifc_mode"][1]),
+        variant=range(2),
+        div=range(1 << cfg["div"][1]),
+        mask_nu=range(1 << cfg["mask_nu"][1]),
+        cs=range(1 << len(tb.cs)))
+    return cfg, [Scenario(*s) for s in itertools.product(*space)]
+
+
+def transactions(scenario, cfg):
+    """Stimulus for one scenario
+
+    Writes CFG (DIV, MASK_NU, a per-scenario RF_SW/LED pattern), transfers
+    to the target CS (QSPI as well with EN_NU), then reads back Status.
+    """
+    s = scenario
+    rf_sw = (s.cs * 5 + s.mask_nu) & 0xf
+    word = ((s.div << cfg["div"][0]) | (s.mask_nu << cfg["mask_nu"][0]) |
+            (rf_sw << cfg["rf_sw"][0]) | ((~rf_sw & 0xf) << cfg["led"][0]))
+    n = sum(w for o, w in cfg.values())
+    t = [tlm.SPI(1, n, word), tlm.SPI(s.cs, 24, 0xa5c3f0 ^ s.mask_nu)]
+    if s.ifc_mode & 2:  # EN_NU
+        t.append(tlm.QSPI(8, [0x81, 0x42, 0x24, 0x18]))
+    t.append(tlm.SPI(1, n, word))
+    return t
+
+
+_worker = None
+
+
+def _init(coverage=False):
+    global _worker
+    lockstep = tlm.Lockstep()
+    if coverage:
+        from urukul_coverage import Coverage
+        lockstep.coverage = Coverage(lockstep.sim, lockstep.tb)
+    _worker = lockstep, fields(lockstep.tb.dut.cfg.data)
+
+
+def _run(scenario):
+    lockstep, cfg = _worker
+    t0 = time.monotonic()
+    c0 = time.process_time()
+    d = lockstep.run(transactions(scenario, cfg),
+            ifc_mode=scenario.ifc_mode, variant=scenario.variant)
+    cpu = time.process_time() - c0
+    dt = time.monotonic() - t0
+    if d is not None:
+        d = "{} at {} ({}): model={} rtl={}".format(
+                d.field, d.index, d.transaction, d.model, d.rtl)
+    return scenario, dt, cpu, d, os.getpid()
+
+
+def _run_chunk(scenarios):
+    lockstep, cfg = _worker
+    results = [_run(s) for s in scenarios]
+    coverage = None
+    if lockstep.coverage is not None:
+        coverage = lockstep.coverage.data()
+        lockstep.coverage.clear()
+    return results, coverage
+
+
+def run(scenarios, jobs=None, chunksize=16, progress=None, coverage=False):
+    """Run ``scenarios`` on ``jobs`` worker processes
+
+    Returns the report dictionary and the merged coverage data (``None``
+    without ``coverage``).
+    """
+    from urukul_coverage import merge
+
+    t0 = time.monotonic()
+    results = []
+    cov = []
+    chunks = [scenarios[i:i + chunksize]
+              for i in range(0, len(scenarios), chunksize)]
+    with multiprocessing.Pool(jobs, initializer=_init,
+            initargs=(coverage,)) as pool:
+        for r, c in pool.imap_unordered(_run_chunk, chunks):
+            results.extend(r)
+            if c is not None:
+                cov.append(c)
+            if progress is not None:
+                progress(len(results), len(scenarios))
+    wall = time.monotonic() - t0
+    results.sort(key=lambda r: r[0])
+    times = [dt for s, dt, cpu, d, pid in results]
+    report = dict(
+        summary=dict(
+            scenarios=len(results),
+            failed=sum(d is not None for s, dt, cpu, d, pid in results),
+            workers=len(set(pid for s, dt, cpu, d, pid in results)),
+            wall=wall,
+            cpu=sum(cpu for s, dt, cpu, d, pid in results),
+            min=min(times, default=0.),
+            max=max(times, default=0.),
+        ),
+        scenarios=[dict(s._asdict(), time=dt, cpu=cpu, divergence=d)
+                   for s, dt, cpu, d, pid in results],
+    )
+    return report, merge(*cov) if coverage else None
+
+
+def main():
+    parser = argparse.ArgumentParser(
+            description="Urukul configuration space regression")
+    parser.add_argument("-j", "--jobs", type=int, default=None,
+            help="worker processes (default: CPU count)")
+    parser.add_argument("--shard", default="0/1",
+            help="run only shard K of N (K/N) of the matrix")
+    parser.add_argument("-l", "--limit", type=int, default=None,
+            help="run at most this many scenarios of the shard")
+    parser.add_argument("-r", "--report", default="regress.json",
+            help="JSON report file")
+    parser.add_argument("--coverage", metavar="FILE",
+            help="collect coverage and write it to FILE (JSON)")
+    args = parser.parse_args()
+
+    k, n = map(int, args.shard.split("/"))
+    cfg, scenarios = matrix()
+    scenarios = scenarios[k::n][:args.limit]
+
+    def progress(i, total):
+        if i % 256 == 0 or i == total:
+            print("{}/{}".format(i, total), flush=True)
+
+    report, coverage = run(scenarios, args.jobs, progress=progress,
+            coverage=bool(args.coverage))
+    report["summary"]["shard"] = args.shard
+    with open(args.report, "w") as f:
+        json.dump(report, f, indent=1)
+
+    s = report["summary"]
+    print("{} scenarios on {} workers: {:.3g} s wall, {:.3g} s cpu, "
+          "{:.3g}/{:.3g} s min/max".format(s["scenarios"], s["workers"],
+              s["wall"], s["cpu"], s["min"], s["max"]))
+    if coverage is not None:
+        import urukul_coverage
+        urukul_coverage.save(coverage, args.coverage)
+        print(urukul_coverage.report(coverage))
+    failed = [r for r in report["scenarios"] if r["divergence"]]
+    for r in failed[:10]:
+        print("FAIL", {k: v for k, v in r.items() if k != "time"})
+    if failed:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
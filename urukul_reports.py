@@ -0,0 +1,233 @@
+"""ISE CPLD report parser and trend tracker
+
+Parses the reports shipped with ``make release``:
+
+  - ``urukul.tim`` (taengine): performance summary per clock net,
+    pin-to-pin delay tables (tPD, tCO, tSU, tCYC)
+  - ``urukul.rpt`` (cpldfit): mapped resource summary and per function
+    block usage
+  - ``urukul_pad.csv``: pin assignment, direction and IO standard
+
+:func:`summary` condenses a build to a few figures (maximum frequency per
+clock domain, worst delays, resource use), which are recorded per
+``git describe`` revision in a JSON trend file.
+
+``reports/sample/`` holds reports to run the parser against offline.
+"""
+
+import argparse
+import csv
+import json
+import os
+import re
+import subprocess
+
+
+# clock domain: clock net in the fitted design
+DOMAINS = {"sck1": "sck1_clk", "sck0": "sck0_clk", "le": "le_clk"}
+
+
+def parse_tim(text):
+    """Parse a taengine timing report
+
+    Returns a dict with ``summary`` (worst delays before the first clock
+    net), ``clocks`` (``{net: {"tco", "tcyc", "tsu", "period", "fmax"}}``)
+    and ``paths`` (``{"tPD"/"tCO"/"tSU"/"tCYC": [(source, destination,
+    delay)]}``).
+    """
+    r = dict(summary=dict(), clocks=dict(), paths=dict())
+    section = r["summary"]
+    table = None
+    lines = iter(text.splitlines())
+    for line in lines:
+        m = re.match(r"Clock net '(.+)' path delays:", line)
+        if m:
+            section = r["clocks"].setdefault(m.group(1), dict())
+            continue
+        m = re.match(r".*\((t[A-Z]+)[^)]*\)\s+:\s+([\d.]+)ns", line)
+        if m and table is None:
+            section[m.group(1).lower()] = float(m.group(2))
+            continue
+        m = re.match(r"Minimum Clock Period:\s+([\d.]+)ns", line)
+        if m:
+            section["period"] = float(m.group(1))
+            continue
+        m = re.match(r"Maximum Internal Clock Speed:\s+([\d.]+)Mhz", line)
+        if m:
+            section["fmax"] = float(m.group(1))
+            continue
+        m = re.match(r"\s+.*\((t[A-Z]+)[^)]*\) \(nsec\)\s*$", line)
+        if m:
+            table = r["paths"].setdefault(m.group(1), [])
+            next(lines)  # header
+            next(lines)  # rule
+            continue
+        if table is not None:
+            m = re.match(r"(\S+)\s+(\S+)\s+([\d.]+)$", line)
+            if m:
+                table.append((m.group(1), m.group(2), float(m.group(3))))
+            elif line.strip() and not line.startswith("-"):
+                table = None
+    return r
+
+
+def _used(s):
+    used, total = s.rstrip("*").split("/")
+    return int(used), int(total)
+
+
+def parse_rpt(text):
+    """Parse a cpldfit fitter report
+
+    Returns a dict with ``device``, ``status``, ``resources``
+    (``{name: (used, total)}``) and ``function_blocks``
+    (``{"FB1": {name: (used, total)}}``).
+    """
+    r = dict(device=None, status=None, resources=dict(),
+            function_blocks=dict())
+    lines = text.splitlines()
+    for i, line in enumerate(lines):
+        m = re.match(r"Device Used:\s+(\S+)", line)
+        if m:
+            r["device"] = m.group(1)
+        m = re.match(r"Fitting Status:\s+(.+)", line)
+        if m:
+            r["status"] = m.group(1).strip()
+        if line.startswith("Macrocells") and "Product Terms" in line:
+            used = re.findall(r"(\d+)\s*/\s*(\d+)\s*\(\s*\d+%\)",
+                    lines[i + 2])
+            names = ("macrocells", "pterms", "fb_inputs", "registers",
+                     "pins")
+            r["resources"] = {k: (int(u), int(t))
+                              for k, (u, t) in zip(names, used)}
+        m = re.match(r"(FB\d+)\s+(.*)", line)
+        if m:
+            names = ("mcells", "fb_inputs", "pterms", "io", "ctc", "ctr",
+                     "cts", "cte")
+            r["function_blocks"][m.group(1)] = {k: _used(v)
+                    for k, v in zip(names, m.group(2).split())}
+    return r
+
+
+def parse_pad(text):
+    """Parse a ``_pad.csv`` pin report
+
+    Returns ``{signal: {"pin", "usage", "direction", "iostd", "slew"}}``
+    for the used pins.
+    """
+    lines = text.splitlines()
+    for start, line in enumerate(lines):
+        if line.startswith("Pin Number,"):
+            break
+    else:
+        raise ValueError("no pin table")
+    r = dict()
+    for row in csv.DictReader(lines[start:]):
+        if row["Signal Name"]:
+            r[row["Signal Name"]] = dict(pin=row["Pin Number"],
+                    usage=row["Pin Usage"], direction=row["Direction"],
+                    iostd=row["IO Standard"], slew=row["Slew Rate"])
+    return r
+
+
+def parse(build_dir, build_name="urukul"):
+    """Parse the reports of a build directory"""
+    r = dict()
+    for key, ext, f in [("tim", ".tim", parse_tim),
+                        ("rpt", ".rpt", parse_rpt),
+                        ("pad", "_pad.csv", parse_pad)]:
+        with open(os.path.join(build_dir, build_name + ext)) as fil:
+            r[key] = f(fil.read())
+    return r
+
+
+def summary(reports):
+    """Key figures of parsed reports"""
+    tim, rpt = reports["tim"], reports["rpt"]
+    r = dict()
+    for domain, net in sorted(DOMAINS.items()):
+        r["fmax_" + domain] = tim["clocks"].get(net, {}).get("fmax")
+    for k in "tPD", "tCO", "tSU":
+        delays = [d for s, t, d in tim["paths"].get(k, [])]
+        r[k.lower()] = max(delays, default=None)
+    for k, (used, total) in sorted(rpt["resources"].items()):
+        r[k] = used
+    r["pins_out"] = sum(p["direction"] in ("OUTPUT", "BIDIR")
+                        for p in reports["pad"].values())
+    return r
+
+
+def revision():
+    """``git describe`` of the working tree (as in the Makefile)"""
+    return subprocess.check_output(["git", "describe", "--always",
+        "--abbrev=8", "--dirty"], cwd=os.path.dirname(
+            os.path.abspath(__file__)), universal_newlines=True).strip()
+
+
+def record(trend, rev, figures):
+    """Store ``figures`` for ``rev`` in the ``trend`` JSON file"""
+    data = dict()
+    if os.path.exists(trend):
+        with open(trend) as f:
+            data = json.load(f)
+    data.pop(rev, None)
+    data[rev] = figures
+    with open(trend, "w") as f:
+        json.dump(data, f, indent=1)
+
+
+def history(trend):
+    """Print the recorded figures with changes to the previous revision"""
+    with open(trend) as f:
+        data = json.load(f)
+    keys = sorted(set().union(*(v.keys() for v in data.values())))
+    print("{:24s}".format("revision") + "".join(
+        "{:>16s}".format(k) for k in keys))
+    prev = {}
+    for rev, v in data.items():
+        row = "{:24s}".format(rev)
+        for k in keys:
+            x, p = v.get(k), prev.get(k)
+            if x is None:
+                row += "{:>16s}".format("-")
+            elif p is None or p == x:
+                row += "{:>16g}".format(x)
+            else:
+                row += "{:>16s}".format("{:g} ({:+g})".format(x, x - p))
+        print(row)
+        prev = v
+
+
+def main():
+    parser = argparse.ArgumentParser(
+            description="ISE CPLD report parser and trend tracker")
+    parser.add_argument("-d", "--dir", default="build",
+            help="directory with the reports (default: %(default)s)")
+    parser.add_argument("-t", "--trend", default=os.path.join("reports",
+            "trend.json"), help="trend file (default: %(default)s)")
+    parser.add_argument("-r", "--record", action="store_true",
+            help="record the figures for the current revision")
+    parser.add_argument("--rev", default=None,
+            help="revision to record (default: git describe)")
+    parser.add_argument("--history", action="store_true",
+            help="show the recorded trend")
+    parser.add_argument("--json", action="store_true",
+            help="dump the full parsed reports")
+    args = parser.parse_args()
+
+    if not args.history or args.record:
+        reports = parse(args.dir)
+        figures = summary(reports)
+        if args.json:
+            print(json.dumps(reports, indent=1))
+        else:
+            for k, v in figures.items():
+                print("{:12s} {}".format(k, v))
+        if args.record:
+            record(args.trend, args.rev or revision(), figures)
+    if args.history:
+        history(args.trend)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,11 +1,23 @@
 from collections import namedtuple
+import argparse
+import io
+import json
+import marshal
+import os
+import socket
+import stat
+import time
 
 from migen import *
 from migen.fhdl.specials import Tristate
+from migen.fhdl.namer import build_namespace
 from migen.build.generic_platform import ConstraintError
 
-from urukul import Urukul
+from urukul import Urukul, PROTO_REV_OPTIONS
 from urukul_cpld import Platform
+import urukul_fastsim as fastsim
+import urukul_tlm as tlm
+from urukul_wave import WaveWriter
 
 
 class SimTristate:
@@ -27,16 +39,72 @@ class SimTristateImpl(Module):
         ]
 
 
+class SimFDPEImpl(Module):
+    """FDPE model for free-running simulation clocks
+
+    The asynchronous preset is applied combinatorially to the output. A
+    glitch on PRE between two clock edges that does not span an edge is not
+    modelled. Clocked from the sys domain, rename as needed.
+    """
+    def __init__(self, d, ce, pre, q, init=1):
+        r = Signal(reset=init)
+        self.sync += [
+                If(pre,
+                    r.eq(1)
+                ).Elif(ce,
+                    r.eq(d)
+                )
+        ]
+        self.comb += q.eq(r | pre)
+
+
 class SimInstance:
     @staticmethod
     def lower(dr):
+        if dr.of == "FDPE":
+            items = {item.name: item for item in dr.items}
+            impl = SimFDPEImpl(*(items[k].expr for k in "D CE PRE Q".split()),
+                    init=items["INIT"].value)
+            return ClockDomainsRenamer(items["C"].expr.cd)(impl)
         return Module()
 
 
+class SimAttenuator(Module):
+    """Behavioral model of the daisy-chained step attenuators
+
+    * 8 bit shift register per attenuator, S_OUT is its MSB
+    * shifts S_IN while LE is low on ATT.CLK edges (modelled on the SCK
+      falling edge following the ATT.CLK high phase, S_IN is stable then)
+    * the shift register is latched into ``data`` on the rising edge of LE
+      (detected in the sys domain)
+    """
+    def __init__(self, att, n=4):
+        self.data = [Signal(8) for i in range(n)]
+
+        # # #
+
+        for i in range(n):
+            sr = Signal(8)
+            le = Signal()
+            self.comb += att.s_out[i].eq(sr[-1])
+            self.sync.sck0 += [
+                    If(att.clk & ~att.le[i],
+                        sr.eq(Cat(att.s_in[i], sr[:-1]))
+                    )
+            ]
+            self.sync += [
+                    le.eq(att.le[i]),
+                    If(att.le[i] & ~le,
+                        self.data[i].eq(sr)
+                    )
+            ]
+
+
 class TB(Module):
     def __init__(self, platform, dut):
         self.platform = platform
-        self.submodules.dut = CEInserter(["le"])(dut)
+        events = dut.stat.event_domains
+        self.submodules.dut = CEInserter(["le"] + sorted(events))(dut)
         for k in "tp dds dds_common dds_sync clk ifc_mode att eem".split():
             v = []
             while True:
@@ -52,10 +120,17 @@ class TB(Module):
                 Cat(self.eem[3].io, self.eem[4].io, self.eem[5].io).eq(
                     self.cs)
         ]
+        self.submodules.att_model = SimAttenuator(self.att)
+        # tick the event counter domains on the rising edges of their clocks
+        for domain, clk in sorted(events.items()):
+            clk_q = Signal(reset=1)
+            self.sync += clk_q.eq(clk)
+            self.comb += getattr(self.dut, "ce_" + domain).eq(clk & ~clk_q)
 
     def spi(self, cs, n, mosi):
-        # while (yield self.dut.cd_sck0.clk):
-        #     pass
+        # align to the free running SCK: assert CS while SCK is high
+        while not (yield self.dut.cd_sck1.clk):
+            yield
         yield self.cs.eq(cs)
         miso = 0
         for i in range(n - 1, -1, -1):
@@ -66,15 +141,128 @@ class TB(Module):
             miso = (miso << 1) | (yield self.dut.eem[2].o)
             yield
             yield self.eem[0].io.eq(0)
-        yield self.dut.ce_le.eq(1)
-        yield
+        # deselect after the last falling edge, the le domain ticks if there
+        # was an SCK edge while SR was selected (FDPE output low)
+        le = yield self.dut.sr.cd_le.clk
         yield self.cs.eq(0)
+        yield self.dut.ce_le.eq(int(not le))
+        yield
         yield self.dut.ce_le.eq(0)
         yield
         yield
         yield
         return miso
 
+    def serve(self, rx, tx):
+        """Co-simulation request loop
+
+        Reads request batches from the text file ``rx`` (one JSON array per
+        line) and answers each batch with one line to ``tx`` (a JSON array
+        of the results):
+
+        * ``["spi", cs, n, mosi]``: MISO
+        * ``["qspi", n, [mosi0, mosi1, mosi2, mosi3]]``: null
+        * ``["set", pin, value]``: null (pins: :attr:`urukul_tlm.Urukul.inputs`)
+        * ``["state"]``: output pin states, CFG and latched attenuation
+          (see :func:`urukul_tlm.rtl_state`)
+        * ``["wait", cycles]``: null
+
+        Invalid requests (type, length or range) and failing requests are
+        answered with ``{"error": message}``, the following requests are
+        still served. Batches may be pipelined. Returns at the end of ``rx``.
+        """
+        inputs = tlm.rtl_inputs(self)
+        pins = tlm.rtl_pins(self)
+        for line in rx:
+            results = []
+            try:
+                batch = json.loads(line)
+                if not isinstance(batch, list):
+                    raise ValueError("batch is not an array")
+            except ValueError as e:
+                batch = []
+                results.append({"error": str(e)})
+            for request in batch:
+                try:
+                    t = self._request(request, inputs)
+                    if t is None:
+                        r = yield from tlm.rtl_state(self, pins)
+                    elif isinstance(t, int):
+                        yield fastsim.Wait(t)
+                        r = None
+                    else:
+                        r = yield from tlm.rtl_apply(self, t, inputs)
+                except Exception as e:
+                    r = {"error": "{}: {}".format(type(e).__name__, e)}
+                results.append(r)
+            tx.write(json.dumps(results) + "\n")
+            tx.flush()
+
+    def _request(self, request, inputs):
+        """Validate a :meth:`serve` request
+
+        Returns the transaction, the number of cycles for ``wait`` or
+        ``None`` for ``state``.
+        """
+        def integer(name, v, stop=None):
+            if not isinstance(v, int) or isinstance(v, bool) or v < 0 or (
+                    stop is not None and v >= stop):
+                raise ValueError("{} out of range: {!r}".format(name, v))
+            return v
+
+        def arity(n):
+            if len(args) != n:
+                raise ValueError("{} takes {} arguments, got {}".format(
+                    kind, n, len(args)))
+
+        if not isinstance(request, list) or not request:
+            raise ValueError("request is not a non-empty array")
+        kind, *args = request
+        if kind == "spi":
+            arity(3)
+            cs = integer("cs", args[0], 1 << len(self.cs))
+            n = integer("n", args[1])
+            if not n:
+                raise ValueError("n out of range: 0")
+            return tlm.SPI(cs, n, integer("mosi", args[2], 1 << n))
+        elif kind == "qspi":
+            arity(2)
+            n = integer("n", args[0])
+            if not n:
+                raise ValueError("n out of range: 0")
+            if not isinstance(args[1], list) or len(args[1]) != 4:
+                raise ValueError("mosi is not an array of 4 words")
+            return tlm.QSPI(n, [integer("mosi", v, 1 << n) for v in args[1]])
+        elif kind == "set":
+            arity(2)
+            if not isinstance(args[0], str) or args[0] not in inputs:
+                raise ValueError("unknown input", args[0])
+            width = sum(len(s) for s in inputs[args[0]])
+            return tlm.Set(args[0], integer("value", args[1], 1 << width))
+        elif kind == "state":
+            arity(0)
+            return None
+        elif kind == "wait":
+            arity(1)
+            return integer("cycles", args[0])
+        raise ValueError("unknown request", kind)
+
+    def qspi(self, n, mosi):
+        """QSPI write (EN_NU): NU_CS, NU_CLK and NU_MOSI[0:3]"""
+        yield self.cs.eq(4)  # NU_CS
+        for i in range(n - 1, -1, -1):
+            for j in range(4):
+                yield self.eem[8 + j].io.eq((mosi[j] >> i) & 1)
+            yield self.eem[2].io.eq(0)
+            yield
+            yield self.eem[2].io.eq(1)
+            yield
+        yield self.eem[2].io.eq(0)
+        yield
+        yield self.cs.eq(0)
+        yield
+        yield
+
     def test(self):
         p = self.platform
         dut = self.dut
@@ -94,36 +282,669 @@ class TB(Module):
             led = yield self.dds[i].led[1]
             assert led == ((0x5 | 0xe | 0x2) >> i) & 1, (i, led)
         # check profile
-        profile = yield self.dds_common.profile
+        profile = yield self.dds[0].profile
         assert profile == 0x4
-        # check attenuator latch
+        # check attenuator latch (preset while deselected)
         att_le = yield self.att.le
-        assert att_le == 0
+        assert att_le == 0xf, att_le
 
         ret = yield from self.spi(1, 24, 0x123456)
         # check version
-        assert ret & 0xff0000 == 0x080000, hex(ret)
+        assert ret & 0x7f0000 == self.dut.proto_rev << 16, hex(ret)
         # check switch readback
-        assert ret & 0xf == 1, hex(ret)
+        assert ret & 0xf == 0x6 | 1, hex(ret)
         ret = yield from self.spi(1, 24, 0x123456)
         assert ret & 0xf == 0x6 | 1, hex(ret)
-        assert ret & 0xff0000 == 0x080000, hex(ret)
+        assert ret & 0x7f0000 == self.dut.proto_rev << 16, hex(ret)
 
         yield from self.spi(2, 32, 0xf0f0f0f0)  # ATT
+        for i in range(4):
+            att = yield self.att_model.data[i]
+            assert att == 0xf0, (i, hex(att))
+        ret = yield from self.spi(2, 32, 0x12345678)
+        assert ret == 0xf0f0f0f0, hex(ret)
+        att = yield Cat(self.att_model.data)
+        assert att == 0x12345678, hex(att)
         yield from self.spi(4, 16, 0x1234)
         yield from self.spi(3, 8 + 64, 0x12345678abcdef0123)
         yield
 
+    def test_registered_miso(self):
+        """Readback with ``registered_miso``: one SCK cycle latency"""
+        yield self.ifc_mode[0].eq(1)  # en_9910
+        yield self.ifc_mode[2].eq(1)  # en_eemb
+        yield self.eem[12].io.eq(1)  # rf_sw[0]
+        yield
+        # n + 1 bits, the first bit falls off SR
+        yield from self.spi(1, 25, 0x123456)
+        sw = yield self.dds[1].rf_sw
+        assert sw == 1, sw
+        ret = yield from self.spi(1, 25, 0x123456)
+        assert ret & 0x7f0000 == self.dut.proto_rev << 16, hex(ret)
+        assert self.dut.proto_rev == PROTO_REV_OPTIONS | 1
+        assert ret & 0xf == 0x6 | 1, hex(ret)
+
+        yield from self.spi(2, 33, 0xf0f0f0f0)  # ATT
+        att = yield Cat(self.att_model.data)
+        assert att == 0xf0f0f0f0, hex(att)
+        ret = yield from self.spi(2, 33, 0x12345678)
+        assert ret & 0xffffffff == 0xf0f0f0f0, hex(ret)
 
-def main():
+        # DDS SDO reaches MISO one SCK cycle later
+        yield self.dds[0].sdo.eq(1)
+        ret = yield from self.spi(4, 8, 0)
+        assert ret == 0x7f, hex(ret)
+        ret = yield from self.spi(4, 9, 0)
+        assert ret == 0x0ff, hex(ret)
+
+    def test_att_sel(self):
+        """Per channel attenuator updates with ``att_sel`` (28 bit CFG)"""
+        yield
+        # ATT_EN = 0: full chain
+        yield from self.spi(2, 32, 0x44332211)
+        att = yield Cat(self.att_model.data)
+        assert att == 0x44332211, hex(att)
+        # the status is MSB aligned
+        ret = yield from self.spi(1, 28, 0)
+        assert (ret >> 4) & 0x7f0000 == self.dut.proto_rev << 16, hex(ret)
+        assert self.dut.proto_rev == PROTO_REV_OPTIONS | 2
+
+        # single channel
+        yield from self.spi(1, 28, 0x4 << 24)
+        yield from self.spi(2, 8, 0x5a)
+        att = yield Cat(self.att_model.data)
+        assert att == 0x445a2211, hex(att)
+        ret = yield from self.spi(2, 8, 0xa5)
+        assert ret == 0x5a, hex(ret)
+        att = yield Cat(self.att_model.data)
+        assert att == 0x44a52211, hex(att)
+
+        # channels 0 and 3, the first byte goes to channel 3
+        yield from self.spi(1, 28, 0x9 << 24)
+        ret = yield from self.spi(2, 16, 0xc3e1)
+        assert ret == 0x4411, hex(ret)
+        att = yield Cat(self.att_model.data)
+        assert att == 0xc3a522e1, hex(att)
+
+        # a standard 24 bit CFG write leaves ATT_EN unchanged
+        ret = yield from self.spi(1, 24, 0x5)
+        assert ret & 0x7f0000 == self.dut.proto_rev << 16, hex(ret)
+        cfg = yield self.dut.cfg.data.raw_bits()
+        assert cfg == (0x9 << 24) | 0x5, hex(cfg)
+        yield from self.spi(2, 16, 0x7887)
+        att = yield Cat(self.att_model.data)
+        assert att == 0x78a52287, hex(att)
+        # shorter transfers write CFG (read-only only with status_poll)
+        yield from self.spi(1, 8, 0xa3)
+        cfg = yield self.dut.cfg.data.raw_bits()
+        assert cfg & 0xff == 0xa3 and cfg >> 24 == 0x9, hex(cfg)
+
+    def test_status_poll(self):
+        """Short read-only status polls with ``status_poll``"""
+        for i in 0, 2:
+            yield self.ifc_mode[i].eq(1)
+        yield self.dds[0].pll_lock.eq(1)
+        yield self.dds[3].pll_lock.eq(1)
+        yield self.dds[1].smp_err.eq(1)
+        yield
+        # CFG.POLL clear: standard order, PROTO_REV in place
+        yield from self.spi(1, 24, 0x123456)
+        ret = yield from self.spi(1, 24, 0x123456)
+        assert ret & 0x7fffff == (self.dut.proto_rev << 16) | 0x5926, hex(ret)
+        assert self.dut.proto_rev == PROTO_REV_OPTIONS | 4
+        # CFG.POLL set: the first bit (PLL_LOCK[3]) is defined
+        yield from self.spi(1, 24, 0x123456 | 1 << 11)
+        ret = yield from self.spi(1, 8, 0xff)
+        assert ret == 0x92, hex(ret)
+        cfg = yield self.dut.cfg.data.raw_bits()
+        assert cfg == 0x123c56, hex(cfg)
+        ret = yield from self.spi(1, 12, 0xfff)
+        assert ret == 0x926, hex(ret)
+        cfg = yield self.dut.cfg.data.raw_bits()
+        assert cfg == 0x123c56, hex(cfg)
+        ret = yield from self.spi(1, 24, 0x654321)
+        assert ret == (0x926 << 12) | (self.dut.proto_rev << 4) | 0x5, hex(ret)
+        cfg = yield self.dut.cfg.data.raw_bits()
+        assert cfg == 0x654321, hex(cfg)
+        ret = yield from self.spi(1, 24, 0x654321)
+        assert ret & 0x7fffff == (self.dut.proto_rev << 16) | 0x5921, hex(ret)
+
+    def test_status_events(self):
+        """Sticky event counters with ``status_events`` (40 bit status)"""
+        for i in range(4):
+            yield self.dds[i].pll_lock.eq(1)
+        yield
+        ret = yield from self.spi(1, 40, 0)
+        assert ret & 0xffff == 0, hex(ret)
+        assert (ret >> 16) & 0x7f0000 == self.dut.proto_rev << 16, hex(ret)
+        assert self.dut.proto_rev == PROTO_REV_OPTIONS | 8
+        # glitches: one unlock on 1, two sample errors on 2, five unlocks
+        # on 3 (saturating)
+        for dds, field, n in [(1, "pll_lock", 1), (2, "smp_err", 2),
+                              (3, "pll_lock", 5)]:
+            pin = getattr(self.dds[dds], field)
+            for i in range(n):
+                yield pin.eq(field == "smp_err")
+                yield
+                yield pin.eq(field != "smp_err")
+                yield
+        # standard reads and writes do not clear the counters
+        ret = yield from self.spi(1, 24, 0x123456)
+        assert ret & 0xf00 == 0xf00, hex(ret)
+        cfg = yield self.dut.cfg.data.raw_bits()
+        assert cfg == 0x123456, hex(cfg)
+        ret = yield from self.spi(1, 40, 0x123456)
+        assert ret & 0xffff == 0xc420, hex(ret)
+        ret = yield from self.spi(1, 40, 0x123456)
+        assert ret & 0xffff == 0, hex(ret)
+
+    def test_io_update_seq(self):
+        """IO_UPDATE sequencer (``io_update_seq``, SYNC_CLK = sys)"""
+        delay = [0, 3, 7, 15]
+        yield self.ifc_mode[0].eq(1)  # en_9910
+        yield
+        upd_dly = sum(d << 4*i for i, d in enumerate(delay))
+        yield from self.spi(1, 40, upd_dly << 24)
+        for i in range(4):
+            d = yield self.dut.cfg.data.upd_dly[4*i:4*i + 4]
+            assert d == delay[i], (i, d)
+        # a standard 24 bit CFG write leaves UPD_DLY unchanged
+        ret = yield from self.spi(1, 24, 0x5)
+        assert ret & 0x7f0000 == self.dut.proto_rev << 16, hex(ret)
+        assert self.dut.proto_rev == PROTO_REV_OPTIONS | 16
+        cfg = yield self.dut.cfg.data.raw_bits()
+        assert cfg == (upd_dly << 24) | 0x5, hex(cfg)
+        for run in range(2):
+            yield self.eem[6].io.eq(1)
+            pulses = [[] for i in range(4)]
+            for t in range(24):
+                yield
+                if t == 3:
+                    yield self.eem[6].io.eq(0)
+                for i in range(4):
+                    if (yield self.dds[i].io_update):
+                        pulses[i].append(t)
+            # one cycle wide, the trigger is first sampled at t = 1
+            for i in range(4):
+                assert pulses[i] == [1 + delay[i] + 2], (run, i, pulses[i])
+
+        # masked: CFG.IO_UPDATE
+        yield from self.spi(1, 40, (0xffff << 24) | (0x8 << 13) | (1 << 12))
+        upd = yield self.dds[3].io_update
+        assert upd == 1
+        # no SYNC_CLK without EN_9910: pass through
+        yield self.ifc_mode[0].eq(0)
+        yield self.eem[6].io.eq(1)
+        yield
+        upd = yield Cat([self.dds[i].io_update for i in range(4)])
+        assert upd == 0xf, hex(upd)
+        # shorter transfers write CFG (read-only only with status_poll)
+        yield from self.spi(1, 8, 0xa3)
+        cfg = yield self.dut.cfg.data.raw_bits()
+        assert cfg & 0xff == 0xa3 and cfg >> 24 == 0xffff, hex(cfg)
+
+    def test_profile(self):
+        """DDS profile from EEM1 with EN_PROFILE"""
+        yield self.ifc_mode[0].eq(1)  # en_9910
+        yield self.ifc_mode[2].eq(1)  # en_eemb
+        yield
+        yield from self.spi(1, 24, 0x5 << 8)
+        for p in range(8):
+            for i in range(3):
+                yield self.eem[9 + i].io.eq((p >> i) & 1)
+            yield
+            profile = yield self.dds[0].profile
+            assert profile == 0x5, profile
+        sync_out_en = yield self.dds_sync.sync_out_en
+        assert sync_out_en == 1
+        yield self.ifc_mode[3].eq(1)  # en_profile
+        for p in range(8):
+            for i in range(3):
+                yield self.eem[9 + i].io.eq((p >> i) & 1)
+            yield
+            for i in range(4):
+                profile = yield self.dds[i].profile
+                assert profile == p, (i, p, profile)
+        sync_out_en = yield self.dds_sync.sync_out_en
+        assert sync_out_en == 0
+        oe = yield self.dut.eem[10].oe
+        assert oe == 0
+        ret = yield from self.spi(1, 24, 0x5 << 8)
+        assert ret & 0xf000 == 0xd000, hex(ret)
+        # NU-Servo mode takes precedence
+        yield self.ifc_mode[1].eq(1)  # en_nu
+        yield
+        profile = yield self.dds[0].profile
+        assert profile == 0x5, profile
+
+    def test_cfg_mask(self):
+        """Masked CFG writes with ``cfg_mask`` (CFG + one bit per field)"""
+        fields = self.dut.cfg.fields
+        n = len(self.dut.cfg.data) + len(fields)
+        proto_rev = self.dut.proto_rev << 16
+        assert self.dut.proto_rev & (PROTO_REV_OPTIONS | 32) == \
+            PROTO_REV_OPTIONS | 32
+        yield
+        yield from self.spi(1, 24, 0x123456)
+        cfg = yield self.dut.cfg.data.raw_bits()
+        assert cfg == 0x123456, hex(cfg)
+        expect = cfg
+        for data, mask in [(0xabcdef, 0x001), (0xabcdef, 0x005),
+                           (0x000000, 0x400), (0xffffff, 0x000),
+                           (0x5a5a5a, 0x7ff), (0x9 << 24, 0x800)]:
+            ret = yield from self.spi(1, n, (data << len(fields)) | mask)
+            assert (ret >> n - 24) & 0x7f0000 == proto_rev, hex(ret)
+            for i, (start, stop) in enumerate(fields):
+                if (mask >> i) & 1:
+                    m = ((1 << stop) - 1) ^ ((1 << start) - 1)
+                    expect = (expect & ~m) | (data & m)
+            cfg = yield self.dut.cfg.data.raw_bits()
+            assert cfg == expect, (hex(mask), hex(cfg), hex(expect))
+        # plain 24 bit writes and reads are unchanged: all standard fields
+        # are written, optional fields (ATT_EN) are kept
+        for data in 0x654321, 0:
+            ret = yield from self.spi(1, 24, data)
+            assert ret & 0x7f0000 == proto_rev, hex(ret)
+            expect = (expect & ~0xffffff) | data
+            cfg = yield self.dut.cfg.data.raw_bits()
+            assert cfg == expect, (hex(cfg), hex(expect))
+
+    def test_serve(self):
+        """Co-simulation requests, invalid ones answered with errors"""
+        requests = [
+            [["set", "ifc_mode", 1], ["spi", 1, 24, 0x000f0], ["wait", 2]],
+            5,
+            [["wait"], ["qspi", 4, [1]], ["spi", 9, 8, 0], ["spi", 1, -1, 0],
+             ["spi", 2, 8, 256], ["set", "sw", 16], ["set", ["sw"], 1],
+             ["state", 1], ["nop"], [], "spi"],
+            [["spi", 1, 24, 0x000f0], ["state"]],
+        ]
+        rx = io.StringIO("".join(json.dumps(r) + "\n" for r in requests) +
+                "[\n")
+        tx = io.StringIO()
+        yield from self.serve(rx, tx)
+        results = [json.loads(line) for line in tx.getvalue().splitlines()]
+        assert len(results) == 5, results
+        assert results[0] == [None, results[0][1], None], results[0]
+        for r in results[1] + results[2] + results[4]:
+            assert set(r) == {"error"}, r
+        assert len(results[2]) == 11, results[2]
+        ret, state = results[3]
+        assert ret & 0x7fffff == (self.dut.proto_rev << 16) | 0x1000, hex(ret)
+        assert state["cfg"] == 0x000f0, state
+
+    def test_idle(self):
+        """Long idle periods between transfers and input changes"""
+        yield self.ifc_mode[0].eq(1)  # en_9910
+        yield
+        yield from self.spi(1, 24, 0x000f0)  # LED
+        yield from self.spi(2, 32, 0x11223344)
+        for i in range(4):
+            yield self.eem[12 + i].io.eq(1)  # SW
+            yield fastsim.Wait(1000)
+            sw = yield Cat([self.dds[j].rf_sw for j in range(4)])
+            assert sw == (1 << i + 1) - 1, (i, hex(sw))
+        ret = yield from self.spi(1, 24, 0x000f0)
+        assert ret & 0xfff == 0x00f, hex(ret)
+        att = yield Cat(self.att_model.data)
+        assert att == 0x11223344, hex(att)
+        yield fastsim.Wait(1000)
+        ret = yield from self.spi(2, 32, 0)
+        assert ret == 0x11223344, hex(ret)
+
+
+# testbench method, Urukul generator options
+TESTS = [
+        ("test", {}),
+        ("test_profile", {}),
+        ("test_registered_miso", dict(registered_miso=True)),
+        ("test_att_sel", dict(att_sel=True)),
+        ("test_status_poll", dict(status_poll=True)),
+        ("test_status_events", dict(status_events=True)),
+        ("test_io_update_seq", dict(io_update_seq=True)),
+        ("test_cfg_mask", dict(cfg_mask=True)),
+        ("test_cfg_mask", dict(cfg_mask=True, att_sel=True)),
+        ("test_idle", {}),
+        ("test_serve", {}),
+]
+
+
+# just operate on sck0
+CLOCKS = {"sys": 8, "sck1": (16, 4), "sck0": (16, 12), "le": 8,
+        "sync_clk": 8}
+OVERRIDES = {Tristate: SimTristate, Instance: SimInstance}
+
+
+def sim_kwargs(dut):
+    """Simulator clocks and special overrides for a :class:`TB` of ``dut``"""
+    # the TB ticks the event counter domains
+    return dict(special_overrides=OVERRIDES, clocks=dict(CLOCKS,
+        **{domain: 8 for domain in dut.stat.event_domains}))
+
+
+def listen(address):
+    """Listening socket on ``host:port`` (TCP) or a Unix socket path"""
+    if ":" in address:
+        host, port = address.rsplit(":", 1)
+        return socket.create_server((host, int(port)))
+    try:
+        if stat.S_ISSOCK(os.stat(address).st_mode):
+            os.unlink(address)  # stale
+    except FileNotFoundError:
+        pass
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.bind(address)
+    sock.listen()
+    return sock
+
+
+def serve(address, options):
+    """Co-simulation server
+
+    Elaborates and compiles the gateware once. Every connection restarts
+    the simulation from reset and is served by :meth:`TB.serve`.
+    """
     p = Platform()
-    dut = Urukul(p)
+    dut = Urukul(p, **options)
     tb = TB(p, dut)
-    run_simulation(tb, [tb.test()], vcd_name="urukul.vcd",
-            # just operate on sck0
-            clocks={"sys": 8, "sck1": (16, 4), "sck0": (16, 12),
-                "le": 8},
-            special_overrides={Tristate: SimTristate, Instance: SimInstance})
+    sim = fastsim.FastSimulator(tb, [], **sim_kwargs(dut))
+    with listen(address) as sock:
+        print("listening on", address)
+        while True:
+            conn, _ = sock.accept()
+            # separate files: text mode rw files drop read-ahead on write
+            with conn, conn.makefile("r") as rx, conn.makefile("w") as tx:
+                sim.reset([tb.serve(rx, tx)])
+                sim.run()
+
+
+class Client:
+    """Co-simulation client (see :meth:`TB.serve`)
+
+    ``send()`` request batches (pipelined), ``receive()`` their results in
+    order, or call the client for a single round trip.
+    """
+    def __init__(self, address):
+        if ":" in address:
+            host, port = address.rsplit(":", 1)
+            self.sock = socket.create_connection((host, int(port)))
+        else:
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.sock.connect(address)
+        self.rx = self.sock.makefile("r")
+        self.tx = self.sock.makefile("w")
+
+    def send(self, requests):
+        self.tx.write(json.dumps(requests) + "\n")
+        self.tx.flush()
+
+    def receive(self):
+        return json.loads(self.rx.readline())
+
+    def __call__(self, requests):
+        self.send(requests)
+        return self.receive()
+
+    def close(self):
+        self.rx.close()
+        self.tx.close()
+        self.sock.close()
+
+
+class _Timer:
+    """Call count and time of a wrapped function"""
+    def __init__(self, f):
+        self.f = f
+        self.calls = 0
+        self.time = 0.
+
+    def __call__(self, *args):
+        t0 = time.perf_counter()
+        try:
+            return self.f(*args)
+        finally:
+            self.time += time.perf_counter() - t0
+            self.calls += 1
+
+
+class _TimedGenerator:
+    """Generator proxy accumulating the time spent in ``send()``"""
+    def __init__(self, generator):
+        self.generator = generator
+        self.gi_frame = generator.gi_frame
+        self.send = _Timer(generator.send)
+
+
+class _TimedVCD:
+    """VCD writer proxy timing ``set()`` and ``delay()``"""
+    def __init__(self, vcd):
+        self.vcd = vcd
+        self.set = _Timer(vcd.set)
+        self.delay = _Timer(vcd.delay)
+
+    def __getattr__(self, name):
+        return getattr(self.vcd, name)
+
+
+class Profile:
+    """Simulation profile
+
+    Runs a :class:`urukul_fastsim.FastSimulator` constructed with
+    ``profile=True`` and measures the wall time per generator, per clock
+    domain (sync logic), of the comb logic (per comb block), of the VCD
+    writer and of the clock bookkeeping, plus evaluation and change counts
+    per signal. The simulator is only instrumented for the run; without
+    ``profile=True`` none of this code is active.
+    """
+    def __init__(self, sim):
+        if not sim.program.profile:
+            raise ValueError("simulator not compiled with profile=True")
+        self.sim = sim
+        self.wall = 0.
+
+    def run(self):
+        sim = self.sim
+        program = sim.program
+        self.generators = []
+        for cd, generators in sim.generators.items():
+            timed = [_TimedGenerator(g) for g in generators]
+            self.generators.extend(timed)
+            generators[:] = timed
+        self.sync = {cd: _Timer(f) for cd, f in program.sync.items()}
+        program.sync.update(self.sync)
+        self.comb = program.comb = _Timer(program.comb)
+        self.tick = sim.time.tick = _Timer(sim.time.tick)
+        self.vcd = None
+        if sim.vcd_changes:
+            self.vcd = sim.vcd = _TimedVCD(sim.vcd)
+        t0 = time.perf_counter()
+        try:
+            sim.run()
+        finally:
+            self.wall = time.perf_counter() - t0
+            for cd, t in self.sync.items():
+                program.sync[cd] = t.f
+            program.comb = self.comb.f
+            if self.vcd is not None:
+                sim.vcd = self.vcd.vcd
+
+    def _names(self):
+        return build_namespace(self.sim.program.signals)
+
+    def blocks(self):
+        """Comb blocks ``(time, count, line, targets)``, hottest first"""
+        p = self.sim.program
+        ns = self._names()
+        r = []
+        for i, (targets, stmts, loop) in enumerate(p.comb_blocks):
+            r.append((p.block_time[i], p.block_count[i], p.block_lines[i][0],
+                      sorted(ns.get_name(t) for t in targets)))
+        r.sort(key=lambda b: -b[0])
+        return r
+
+    def signals(self):
+        """``{name: (evaluations, changes)}`` for every signal
+
+        Comb driven signals are evaluated with their block, others on every
+        write (sync logic, generators, clocks).
+        """
+        p = self.sim.program
+        ev = self.sim.evaluator
+        ns = self._names()
+        evals = dict(ev.writes)
+        for i, (targets, stmts, loop) in enumerate(p.comb_blocks):
+            for t in targets:
+                evals[p.slot(t)] = p.block_count[i]
+        return {ns.get_name(s): (evals.get(n, 0),
+                                 p.changes[n] + ev.changes.get(n, 0))
+                for n, s in enumerate(p.signals)}
+
+    def entries(self):
+        """``[(name, calls, time)]`` of the top level activities"""
+        r = [("generator " + g.generator.__qualname__, g.send.calls,
+              g.send.time) for g in self.generators]
+        r += [("sync " + cd, t.calls, t.time)
+              for cd, t in sorted(self.sync.items())]
+        r.append(("comb", self.comb.calls, self.comb.time))
+        if self.vcd is not None:
+            r.append(("vcd set", self.vcd.set.calls, self.vcd.set.time))
+            r.append(("vcd delay", self.vcd.delay.calls,
+                      self.vcd.delay.time))
+        r.append(("clock ticks", self.tick.calls, self.tick.time))
+        return r
+
+    def report(self, top=10):
+        lines = ["wall {:.4g} s".format(self.wall)]
+        for name, calls, t in self.entries():
+            lines.append("  {:36s} {:9d} calls {:9.4g} s {:5.1f}%".format(
+                name, calls, t, 100*t/self.wall if self.wall else 0))
+        lines.append("hottest comb blocks:")
+        for t, count, line, targets in self.blocks()[:top]:
+            lines.append("  {:9.4g} s {:9d} evals  line {:5d}  {}".format(
+                t, count, line, " ".join(targets)[:60]))
+        lines.append("most evaluated signals:")
+        signals = sorted(self.signals().items(), key=lambda kv: -kv[1][0])
+        for name, (evals, changes) in signals[:top]:
+            lines.append("  {:40s} {:9d} evals {:9d} changes".format(
+                name, evals, changes))
+        return "\n".join(lines)
+
+    def dump_stats(self, filename):
+        """Write the profile in the :mod:`pstats` (cProfile) format
+
+        The run is the root, the activities of :meth:`entries` its callees
+        and the comb blocks (as lines of the generated source) callees of
+        the comb logic. Readable with ``pstats.Stats(filename)`` and the
+        usual viewers.
+        """
+        root = ("urukul_sim.py", 0, "run")
+        comb = ("<urukul_fastsim>", 0, "comb")
+        stats = dict()
+        children = 0.
+        for name, calls, t in self.entries():
+            key = comb if name == "comb" else ("<simulation>", 0, name)
+            tt = t
+            if key == comb:
+                tt -= sum(self.sim.program.block_time)
+            stats[key] = (calls, calls, tt, t, {root: (calls, calls, tt, t)})
+            children += t
+        for t, count, line, targets in self.blocks():
+            key = ("<urukul_fastsim>", line, "comb " + " ".join(targets))
+            stats[key] = (count, count, t, t, {comb: (count, count, t, t)})
+        stats[root] = (1, 1, max(self.wall - children, 0.), self.wall, {})
+        with open(filename, "wb") as f:
+            marshal.dump(stats, f)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Urukul CPLD simulation")
+    parser.add_argument("--pysim", action="store_true",
+            help="use the interpreted migen simulator")
+    parser.add_argument("--check", action="store_true",
+            help="check the compiled simulator against pysim")
+    parser.add_argument("--test", action="append",
+            choices=[name for name, options in TESTS],
+            help="run only this test (repeatable, default: all)")
+    parser.add_argument("--vcd", default="urukul.vcd",
+            help="VCD output file of the first test, .gz/.xz/.bz2 "
+            "compressed, empty to disable (default: %(default)s)")
+    parser.add_argument("--signals", action="append", metavar="PATTERN",
+            help="trace only signals matching this glob pattern "
+            "(repeatable, e.g. '*dds_cs_n')")
+    parser.add_argument("--window", action="append", metavar="START:STOP",
+            help="dump only within this time window (repeatable)")
+    parser.add_argument("--profile", metavar="FILE",
+            help="profile the simulation, print a report and write the "
+            "profile (pstats format, one file per test: FILE.<test>)")
+    parser.add_argument("--coverage", metavar="FILE",
+            help="collect toggle and functional coverage over all tests "
+            "into FILE (JSON, see urukul_coverage.py)")
+    parser.add_argument("--skip-idle", action="store_true",
+            help="jump simulated time over quiescent periods (no CS "
+            "asserted, testbench waiting, periodic state) and report the "
+            "speedup")
+    parser.add_argument("--serve", metavar="ADDRESS",
+            help="run the co-simulation server on HOST:PORT or a Unix "
+            "socket path")
+    parser.add_argument("--option", action="append", default=[],
+            metavar="NAME", help="enable a gateware option for --serve "
+            "(repeatable, e.g. registered_miso)")
+    args = parser.parse_args()
+
+    if args.serve:
+        serve(args.serve, {k: True for k in args.option})
+        return
+
+    if args.coverage:
+        import urukul_coverage
+        coverage = []
+
+    vcd = args.vcd
+    for name, options in TESTS:
+        if args.test and name not in args.test:
+            continue
+        p = Platform()
+        dut = Urukul(p, **options)
+        tb = TB(p, dut)
+        kwargs = sim_kwargs(dut)
+        if args.pysim:
+            run_simulation(tb, [fastsim.expand_waits(getattr(tb, name)())],
+                    vcd_name=vcd or None, **kwargs)
+        else:
+            wave = None
+            if vcd:
+                windows = None
+                if args.window:
+                    windows = [tuple(map(int, w.split(":")))
+                               for w in args.window]
+                wave = WaveWriter(vcd, signals=args.signals,
+                        windows=windows)
+            idle = [tb.cs] if args.skip_idle else None
+            with fastsim.FastSimulator(tb, [getattr(tb, name)()],
+                    check=args.check, wave=wave, idle=idle,
+                    profile=bool(args.profile), **kwargs) as sim:
+                if args.coverage:
+                    cov = urukul_coverage.Coverage(sim, tb)
+                    sim.generators["sys"].append(cov.sampler())
+                if args.profile:
+                    profile = Profile(sim)
+                    profile.run()
+                    print(name, profile.report())
+                    profile.dump_stats("{}.{}".format(args.profile, name))
+                else:
+                    sim.run()
+            if args.skip_idle:
+                print("{}: {} of {} transitions skipped ({} ns jumped), "
+                      "{:.3g}x".format(name, sim.skipped, sim.ticks,
+                          sim.jumped, sim.speedup()))
+            if args.coverage:
+                coverage.append(cov.data())
+        vcd = None
+
+    if args.coverage:
+        data = urukul_coverage.merge(*coverage)
+        urukul_coverage.save(data, args.coverage)
+        print(urukul_coverage.report(data))
 
 
 if __name__ == "__main__":
@@ -0,0 +1,304 @@
+"""Static logic depth and product term estimates
+
+Lowers the elaborated :class:`urukul.Urukul` fragment to a single
+:class:`urukul_batch.BitGraph` (comb logic inlined, registers, instance
+outputs and input pins as sources) and reports for every endpoint bit:
+
+  - ``depth``: gate levels (AND/OR/XOR 1, MUX 2, inversion free)
+  - ``fanin``: number of source bits in the cone
+  - ``pterms``: product terms of the unminimized sum-of-products (capped)
+
+Endpoints are output pins (tristate ``o``/``oe`` for bidirectional pins),
+register inputs and instance inputs (e.g. FDPE CE/PRE). The metrics are
+memoized per graph node and shared between endpoints.
+
+Increases against the stored baseline (``urukul_timing.json``) are reported
+as regressions. The per channel endpoints (DDS[i] pins, ATT[i].LE) must have
+equal metrics for all channels. ``--compare OPTION`` lists the endpoints
+whose depth differs in the build with a generator option (e.g. the MISO pin
+of ``registered_miso``).
+"""
+
+import argparse
+import json
+import os
+import re
+
+from migen import *
+from migen.fhdl.structure import _Slice
+from migen.fhdl.specials import Tristate
+from migen.fhdl.tools import list_signals, list_targets
+from migen.fhdl.namer import build_namespace
+
+from urukul_batch import BitLowering
+
+
+PTERM_CAP = 1 << 16
+
+# channel index of per channel endpoints
+CHANNEL = re.compile(r"^dds(\d+)\.|le\[(\d+)\]")
+
+
+class Metrics:
+    """Memoized depth, product terms and support of :class:`BitGraph`
+    nodes"""
+    def __init__(self, graph):
+        self.graph = graph
+        self.depths = dict()
+        self.pterms = dict()
+        self.supports = dict()
+
+    def _walk(self, a, memo, leaf, op):
+        stack = [a]
+        while stack:
+            i = stack[-1]
+            if i in memo:
+                stack.pop()
+                continue
+            n = self.graph.nodes[i]
+            if n[0] in ("const", "var"):
+                memo[i] = leaf(n)
+            else:
+                pending = [j for j in n[1:] if j not in memo]
+                if pending:
+                    stack.extend(pending)
+                    continue
+                memo[i] = op(n[0], [memo[j] for j in n[1:]])
+            stack.pop()
+        return memo[a]
+
+    def depth(self, a):
+        return self._walk(a, self.depths, lambda n: 0,
+                lambda op, d: max(d) + {"not": 0, "mux": 2}.get(op, 1))
+
+    @staticmethod
+    def _sop(op, args):
+        # (terms of f, terms of ~f)
+        c = lambda x: min(x, PTERM_CAP)
+        if op == "not":
+            return args[0][::-1]
+        (pa, na), (pb, nb) = args[-2:]
+        if op == "and":
+            return c(pa*pb), c(na + nb)
+        elif op == "or":
+            return c(pa + pb), c(na*nb)
+        elif op == "xor":
+            return c(pa*nb + na*pb), c(pa*pb + na*nb)
+        elif op == "mux":
+            pc, nc = args[0]
+            return c(pc*pa + nc*pb), c(pc*na + nc*nb)
+        raise ValueError(op)
+
+    def pterm(self, a):
+        return self._walk(a, self.pterms,
+                lambda n: (n[1], 1 - n[1]) if n[0] == "const" else (1, 1),
+                self._sop)[0]
+
+    def fanin(self, a):
+        return len(self.graph.support(a, self.supports))
+
+
+class Analysis:
+    """Endpoint cones of an elaborated module
+
+    :param module: the top level module
+    :param platform: the platform the pins were requested from
+    """
+    def __init__(self, module, platform):
+        fragment = module.get_fragment()
+        self.lowering = low = BitLowering(fragment.clock_domains)
+        self.graph = g = low.graph
+        comb = low.comb(fragment.comb)
+        memo = dict()
+        self.resolve = lambda bits: [g.substitute(b, comb, memo)
+                                     for b in bits]
+
+        signals = set()
+        for stmts in [fragment.comb] + list(fragment.sync.values()):
+            signals |= list_signals(stmts) | list_targets(stmts)
+        tristates = [s for s in fragment.specials if isinstance(s, Tristate)]
+        instances = [s for s in fragment.specials if isinstance(s, Instance)]
+        for s in tristates:
+            signals |= list_signals(s.target) | list_signals(s.o)
+            signals |= list_signals(s.oe)
+        for s in instances:
+            for i in s.items:
+                if isinstance(i, (Instance.Input, Instance.Output)):
+                    signals |= list_signals(i.expr)
+        ns = build_namespace(signals)
+
+        pins = dict()
+        for sig, _, _, (name, number, sub) in (
+                platform.constraint_manager.get_sig_constraints()):
+            pins[sig] = "{}{}{}".format(name, number,
+                    "." + sub if sub else "")
+
+        def label(sig):
+            return pins.get(sig, None) or ns.get_name(sig)
+
+        def bitnames(name, n):
+            return [name if n == 1 else "{}[{}]".format(name, i)
+                    for i in range(n)]
+
+        def name_of(e):
+            if isinstance(e, Signal):
+                return label(e)
+            elif isinstance(e, _Slice) and isinstance(e.value, Signal):
+                if e.stop - e.start == 1:
+                    return "{}[{}]".format(label(e.value), e.start)
+                return "{}[{}:{}]".format(label(e.value), e.start, e.stop)
+            return str(e)
+
+        self.endpoints = endpoints = dict()
+        # comb driven pins
+        for sig, name in pins.items():
+            slot = low.slot(sig)
+            for i, n in enumerate(bitnames(name, len(sig))):
+                if slot + i in comb:
+                    endpoints[n] = comb[slot + i]
+        for s in tristates:
+            name = name_of(s.target)
+            for port in "o", "oe":
+                bits = self.resolve(low.expr(getattr(s, port)))
+                for n, b in zip(bitnames(name + "." + port, len(bits)), bits):
+                    endpoints[n] = b
+        for s in instances:
+            out = [name_of(i.expr) for i in s.items
+                   if isinstance(i, Instance.Output)]
+            for i in s.items:
+                if (isinstance(i, Instance.Input)
+                        and not isinstance(i.expr, (ClockSignal, Constant))):
+                    bits = self.resolve(low.expr(i.expr))
+                    name = "{}({}).{}".format(s.of, ",".join(out), i.name)
+                    for n, b in zip(bitnames(name, len(bits)), bits):
+                        endpoints[n] = b
+        # register inputs
+        for cd, stmts in sorted(fragment.sync.items()):
+            env = dict()
+            low.execute(stmts, env, g.var)
+            for t in list_targets(stmts):
+                slot = low.slot(t)
+                for i, n in enumerate(bitnames(label(t), len(t))):
+                    if slot + i in env:
+                        endpoints["{}:{}".format(cd, n)] = self.resolve(
+                                [env[slot + i]])[0]
+
+        self.metrics = Metrics(g)
+
+    def report(self):
+        """``{endpoint: {"depth", "fanin", "pterms"}}``"""
+        m = self.metrics
+        return {name: dict(depth=m.depth(b), fanin=m.fanin(b),
+                           pterms=m.pterm(b))
+                for name, b in sorted(self.endpoints.items())}
+
+
+def compare(report, baseline):
+    """Endpoints with any metric above the baseline
+
+    Returns ``[(endpoint, metric, baseline, current)]``.
+    """
+    r = []
+    for name, metrics in report.items():
+        base = baseline.get(name)
+        if base is None:
+            continue
+        for k, v in metrics.items():
+            if v > base.get(k, v):
+                r.append((name, k, base[k], v))
+    return r
+
+
+def asymmetric(report):
+    """Per channel endpoints whose metrics differ between the channels
+
+    Returns ``[(endpoint, {channel: metrics})]`` with the channel index
+    replaced by ``#`` in the endpoint name.
+    """
+    groups = dict()
+    for name, metrics in report.items():
+        m = CHANNEL.search(name)
+        if m is None:
+            continue
+        i = m.lastindex
+        key = name[:m.start(i)] + "#" + name[m.end(i):]
+        groups.setdefault(key, dict())[int(m.group(i))] = metrics
+    return [(key, channels) for key, channels in sorted(groups.items())
+            if any(v != channels[min(channels)] for v in channels.values())]
+
+
+def difference(report, other):
+    """Endpoints whose depth differs (or that exist in only one report)
+
+    Returns ``[(endpoint, metrics, other metrics)]``, ``None`` for missing
+    endpoints.
+    """
+    depth = lambda m: None if m is None else m["depth"]
+    return [(name, report.get(name), other.get(name))
+            for name in sorted(set(report) | set(other))
+            if depth(report.get(name)) != depth(other.get(name))]
+
+
+def main():
+    from urukul import Urukul
+    from urukul_cpld import Platform
+
+    parser = argparse.ArgumentParser(
+            description="Urukul static logic depth/product term estimate")
+    parser.add_argument("-b", "--baseline", default=os.path.join(
+            os.path.dirname(os.path.abspath(__file__)), "urukul_timing.json"))
+    parser.add_argument("-u", "--update", action="store_true",
+            help="write the current estimate as the new baseline")
+    parser.add_argument("-t", "--top", type=int, default=10,
+            help="list the deepest endpoints")
+    parser.add_argument("--compare", metavar="OPTION",
+            help="list the endpoint depths that differ in the build with "
+            "this generator option (e.g. registered_miso)")
+    args = parser.parse_args()
+
+    p = Platform()
+    report = Analysis(Urukul(p), p).report()
+
+    if args.compare:
+        p = Platform()
+        other = Analysis(Urukul(p, **{args.compare: True}), p).report()
+        fmt = lambda m: "-" if m is None else \
+                "depth {depth} fanin {fanin} pterms {pterms}".format(**m)
+        for name, a, b in difference(report, other):
+            print("{:40s} {} -> {}".format(name, fmt(a), fmt(b)))
+        return
+
+    worst = sorted(report.items(), key=lambda kv: (
+        -kv[1]["depth"], -kv[1]["pterms"], kv[0]))
+    for name, m in worst[:args.top]:
+        print("{:40s} depth {depth:3d} fanin {fanin:3d} pterms {pterms}"
+              .format(name, **m))
+
+    asym = asymmetric(report)
+    for name, channels in asym:
+        print("ASYMMETRIC {}: {}".format(name, ", ".join(
+            "{}: depth {depth} fanin {fanin} pterms {pterms}".format(i, **m)
+            for i, m in sorted(channels.items()))))
+    if asym:
+        raise SystemExit(1)
+
+    if args.update:
+        with open(args.baseline, "w") as f:
+            json.dump(report, f, indent=1, sort_keys=True)
+        return
+    if not os.path.exists(args.baseline):
+        return
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    new = sorted(set(report) - set(baseline))
+    if new:
+        print("new endpoints:", ", ".join(new))
+    regressions = compare(report, baseline)
+    for name, k, base, v in regressions:
+        print("REGRESSION {}: {} {} -> {}".format(name, k, base, v))
+    if regressions:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,423 @@
+"""Transaction-level model of the Urukul SPI router
+
+Models the protocol documented in :class:`urukul.Urukul` on whole
+transactions as integers: CS decoding, the CFG/Status exchange through the
+24 bit shift register, the 32 bit attenuator daisy chain, MASK_NU multicast
+and EN_NU QSPI routing, and the resulting pin states.
+
+:func:`lockstep` replays the same transactions against the RTL (in the
+compiled simulator) and reports the first divergence. :class:`Lockstep` keeps
+the compiled simulation warm for repeated runs.
+"""
+
+from collections import namedtuple
+import argparse
+import random
+import time
+
+from urukul_codec import CFG, STATUS, PROTO_REV
+
+
+SPI = namedtuple("SPI", "cs n mosi")
+SPI.__doc__ = """SPI transfer of ``n`` >= 1 bits, MSB first"""
+QSPI = namedtuple("QSPI", "n mosi")
+QSPI.__doc__ = """QSPI write of ``n`` >= 1 bits per lane (``mosi``: 4 words)"""
+Set = namedtuple("Set", "pin value")
+Set.__doc__ = """Change a board input (see :attr:`Urukul.inputs`)"""
+
+def _bit(v, i):
+    return (v >> i) & 1
+
+
+class Urukul:
+    """Transaction-level Urukul model
+
+    Board inputs are attributes (see :attr:`inputs`): ``ifc_mode`` (4 bit),
+    ``variant``, ``sw`` (EEM1.SW[0:3]), ``smp_err``, ``pll_lock``, ``sdo``
+    (DDS[0:3].SDO), ``io_update`` (EEM0.IO_UPDATE), ``dds_reset``
+    (EEM0.DDS_RESET), ``profile`` (EEM1.PROFILE[0:2]).
+
+    Attenuator chips are modelled as a 32 bit shift register latched per
+    channel (``att``) on deselection. Data received by each DDS is logged in
+    ``dds`` as ``(n, data)`` tuples.
+    """
+    inputs = ("ifc_mode", "variant", "sw", "smp_err", "pll_lock", "sdo",
+              "io_update", "dds_reset", "profile")
+
+    def __init__(self, **kwargs):
+        for k in self.inputs:
+            setattr(self, k, 0)
+        for k, v in kwargs.items():
+            if k not in self.inputs:
+                raise ValueError("unknown input", k)
+            setattr(self, k, v)
+        self.cfg = 0
+        self.att_sr = 0
+        self.att = [0]*4
+        self.dds = [[] for i in range(4)]
+
+    @property
+    def en_9910(self):
+        return _bit(self.ifc_mode, 0) | self.variant
+
+    @property
+    def en_nu(self):
+        return _bit(self.ifc_mode, 1)
+
+    @property
+    def en_eem1(self):
+        return _bit(self.ifc_mode, 2)
+
+    @property
+    def en_profile(self):
+        return _bit(self.ifc_mode, 3) & (self.en_nu ^ 1)
+
+    def rf_sw(self):
+        return CFG.get(self.cfg, "rf_sw") | (self.sw & 0xf)
+
+    def status(self):
+        return STATUS.encode(rf_sw=self.rf_sw(), smp_err=self.smp_err & 0xf,
+                pll_lock=self.pll_lock & 0xf, ifc_mode=self.ifc_mode & 0xf,
+                proto_rev=PROTO_REV)
+
+    def selected(self, cs):
+        """DDS selected through the SPI interface by (effective) ``cs``"""
+        mask_nu = CFG.get(self.cfg, "mask_nu")
+        r = []
+        for i in range(4):
+            if self.en_nu and not _bit(mask_nu, i):
+                continue  # routed to QSPI
+            if cs == i + 4 or (cs == 3 and _bit(mask_nu, i)):
+                r.append(i)
+        return r
+
+    def spi(self, cs, n, mosi):
+        """SPI transfer, returns MISO (the routed value, see ``miso_oe``)
+
+        For CFG, the first MISO bit (the MSB of the result) is undefined.
+        """
+        assert n >= 1
+        mask = (1 << n) - 1
+        mosi &= mask
+        if self.en_nu:
+            cs &= 3  # CS2 is NU_CS
+        if cs == 1:
+            z = (self.status() << n) | mosi
+            self.cfg = z & ((1 << CFG.width) - 1)
+            return (z >> STATUS.width) & mask
+        elif cs == 2:
+            z = (self.att_sr << n) | mosi
+            self.att_sr = z & 0xffffffff
+            self.att = [(self.att_sr >> 8*i) & 0xff for i in range(4)]
+            return (z >> 32) & mask
+        elif cs >= 3:
+            for i in self.selected(cs):
+                self.dds[i].append((n, mosi))
+            return mask if _bit(self.sdo, 0 if cs == 3 else cs - 4) else 0
+        return 0
+
+    def qspi(self, n, mosi):
+        """QSPI write to all DDS not masked by CFG.MASK_NU (EN_NU only)"""
+        assert n >= 1
+        # NU_MOSI1-3 share the EEM1 pairs with PROFILE0-2
+        self.profile = sum((mosi[j + 1] & 1) << j for j in range(3))
+        if not self.en_nu:
+            return
+        mask_nu = CFG.get(self.cfg, "mask_nu")
+        for i in range(4):
+            if not _bit(mask_nu, i):
+                self.dds[i].append((n, mosi[i] & ((1 << n) - 1)))
+
+    def apply(self, t):
+        """Apply a :class:`SPI`, :class:`QSPI` or :class:`Set` transaction"""
+        if isinstance(t, SPI):
+            return self.spi(t.cs, t.n, t.mosi)
+        elif isinstance(t, QSPI):
+            return self.qspi(t.n, t.mosi)
+        elif isinstance(t, Set):
+            if t.pin not in self.inputs:
+                raise ValueError("unknown input", t.pin)
+            setattr(self, t.pin, t.value)
+        else:
+            raise ValueError("unknown transaction", t)
+
+    def pins(self):
+        """Idle output pin state (not selected)"""
+        cfg = self.cfg
+        mask_nu = CFG.get(cfg, "mask_nu")
+        rst = CFG.get(cfg, "rst")
+        rf_sw = self.rf_sw()
+        led = CFG.get(cfg, "led")
+        if self.en_9910:
+            led |= self.smp_err | ~self.pll_lock
+        io_update = 0
+        for i in range(4):
+            if _bit(mask_nu, i):
+                io_update |= CFG.get(cfg, "io_update") << i
+            else:
+                io_update |= self.io_update << i
+        sync_en = int(not self.en_nu and self.en_eem1 and self.en_9910)
+        if self.en_profile:
+            profile = self.profile & 0x7
+        else:
+            profile = CFG.get(cfg, "profile")
+        return dict(
+            rf_sw=rf_sw,
+            led=led & 0xf,
+            profile=profile,
+            io_update=io_update,
+            reset=0xf*int(rst or (not self.en_9910 and self.dds_reset)),
+            cs_n=0xf,
+            master_reset=rst,
+            io_reset=CFG.get(cfg, "io_rst"),
+            att_rst_n=rst ^ 1,
+            att_le=0xf,
+            in_sel=CFG.get(cfg, "clk_sel0"),
+            mmcx_osc_sel=CFG.get(cfg, "clk_sel1"),
+            osc_en_n=CFG.get(cfg, "clk_sel0") | CFG.get(cfg, "clk_sel1"),
+            sync_sel=CFG.get(cfg, "sync_sel"),
+            clk_out_en=sync_en,
+            sync_out_en=sync_en & (self.en_profile ^ 1),
+            miso_oe=self.en_nu ^ 1,
+        )
+
+
+Divergence = namedtuple("Divergence", "index transaction field model rtl")
+
+
+def rtl_pins(tb):
+    """RTL signals of the :meth:`Urukul.pins` fields"""
+    d = tb.dds
+    return dict(
+        rf_sw=[x.rf_sw for x in d],
+        led=[x.led[1] for x in d],
+        profile=d[0].profile,
+        io_update=[x.io_update for x in d],
+        reset=[x.reset for x in d],
+        cs_n=[x.cs_n for x in d],
+        master_reset=tb.dds_common.master_reset,
+        io_reset=tb.dds_common.io_reset,
+        att_rst_n=tb.att.rst_n,
+        att_le=tb.att.le,
+        in_sel=tb.clk.in_sel,
+        mmcx_osc_sel=tb.clk.mmcx_osc_sel,
+        osc_en_n=tb.clk.osc_en_n,
+        sync_sel=tb.dds_sync.sync_sel,
+        clk_out_en=tb.dds_sync.clk_out_en,
+        sync_out_en=tb.dds_sync.sync_out_en,
+        miso_oe=tb.dut.eem[2].oe,
+    )
+
+
+def _monitor(tb, rx):
+    """Log bits received by each DDS on SCK rising edges while selected"""
+    yield "passive"
+    sck = [0]*4
+    bits = [None]*4
+    while True:
+        for i, d in enumerate(tb.dds):
+            cs_n, clk, sdi = (yield d.cs_n), (yield d.sck), (yield d.sdi)
+            if cs_n:
+                if bits[i]:
+                    rx[i].append(bits[i])
+                bits[i] = None
+            else:
+                if bits[i] is None:
+                    bits[i] = []
+                if clk and not sck[i]:
+                    bits[i].append(sdi)
+            sck[i] = clk
+        yield
+
+
+def rtl_inputs(tb):
+    """TB signals of the board inputs (see :attr:`Urukul.inputs`), LSB
+    first"""
+    return {
+        "ifc_mode": [tb.ifc_mode],
+        "variant": [tb.platform.lookup_request("variant")],
+        "sw": [tb.eem[12 + i].io for i in range(4)],
+        "smp_err": [d.smp_err for d in tb.dds],
+        "pll_lock": [d.pll_lock for d in tb.dds],
+        "sdo": [d.sdo for d in tb.dds],
+        "io_update": [tb.eem[6].io],
+        "dds_reset": [tb.eem[7].io],
+        "profile": [tb.eem[9 + i].io for i in range(3)],
+    }
+
+
+def rtl_apply(tb, t, inputs):
+    """Apply a transaction to the TB (generator), returns MISO for
+    :class:`SPI`"""
+    miso = None
+    if isinstance(t, SPI):
+        miso = yield from tb.spi(t.cs, t.n, t.mosi)
+    elif isinstance(t, QSPI):
+        yield from tb.qspi(t.n, t.mosi)
+    elif isinstance(t, Set):
+        targets = inputs[t.pin]
+        if len(targets) == 1:
+            yield targets[0].eq(t.value)
+        else:
+            for i, s in enumerate(targets):
+                yield s.eq((t.value >> i) & 1)
+        yield
+    else:
+        raise ValueError("unknown transaction", t)
+    yield
+    return miso
+
+
+def rtl_state(tb, pins):
+    """Pin states (see :func:`rtl_pins`), CFG and latched attenuation
+    (generator)"""
+    state = dict()
+    for k, v in pins.items():
+        if isinstance(v, list):
+            x = 0
+            for i, s in enumerate(v):
+                x |= (yield s) << i
+            v = x
+        else:
+            v = yield v
+        state[k] = v
+    state["cfg"] = yield tb.dut.cfg.data.raw_bits()
+    state["att"] = []
+    for a in tb.att_model.data:
+        state["att"].append((yield a))
+    return state
+
+
+def _rtl(tb, transactions, observed, rx):
+    inputs = rtl_inputs(tb)
+    pins = rtl_pins(tb)
+    for t in transactions:
+        miso = yield from rtl_apply(tb, t, inputs)
+        state = yield from rtl_state(tb, pins)
+        observed.append((miso, state, [list(r) for r in rx]))
+        for r in rx:
+            r.clear()
+
+
+class Lockstep:
+    """Warm RTL simulation for repeated lockstep checks
+
+    The gateware is elaborated and compiled once; every :meth:`run` restarts
+    the simulation from reset. Set :attr:`coverage` to a
+    :class:`urukul_coverage.Coverage` to sample every run.
+    """
+    def __init__(self):
+        from urukul import Urukul as Gateware
+        from urukul_cpld import Platform
+        from urukul_sim import TB, sim_kwargs
+        from urukul_fastsim import FastSimulator
+
+        p = Platform()
+        dut = Gateware(p)
+        self.tb = TB(p, dut)
+        self.sim = FastSimulator(self.tb, [], **sim_kwargs(dut))
+        self.coverage = None
+
+    def run(self, transactions, **inputs):
+        """Replay ``transactions`` on the model and the RTL
+
+        Compares MISO (excluding the undefined first CFG bit), CFG contents,
+        latched attenuation, output pin states and the data received by each
+        DDS after every transaction. Returns the first :class:`Divergence`
+        or ``None``.
+        """
+        transactions = [Set(k, v) for k, v in inputs.items()] + list(
+                transactions)
+        observed = []
+        rx = [[] for i in range(4)]
+        generators = [_rtl(self.tb, transactions, observed, rx),
+            _monitor(self.tb, rx)]
+        if self.coverage is not None:
+            generators.append(self.coverage.sampler())
+        self.sim.reset(generators)
+        self.sim.run()
+        return compare(transactions, observed)
+
+
+def compare(transactions, observed):
+    """Check the RTL observations of :meth:`Lockstep.run` against the model"""
+    model = Urukul()
+    for i, (t, (miso, state, dds)) in enumerate(zip(transactions, observed)):
+        ref = model.apply(t)
+        if isinstance(t, SPI):
+            mask = (1 << t.n) - 1
+            if t.cs & (3 if model.en_nu else 7) == 1:
+                mask >>= 1
+            if ref & mask != miso & mask:
+                return Divergence(i, t, "miso", ref & mask, miso & mask)
+        expect = model.pins()
+        expect["cfg"] = model.cfg
+        expect["att"] = model.att
+        for k, v in expect.items():
+            if state[k] != v:
+                return Divergence(i, t, k, v, state[k])
+        for j in range(4):
+            got = [(len(b), sum(x << k for k, x in enumerate(reversed(b))))
+                   for b in dds[j]]
+            if got != model.dds[j]:
+                return Divergence(i, t, "dds{}".format(j), model.dds[j],
+                        dds[j])
+            model.dds[j].clear()
+    return None
+
+
+def lockstep(transactions, **inputs):
+    """Single :meth:`Lockstep.run` on a fresh simulation"""
+    return Lockstep().run(transactions, **inputs)
+
+
+def transactions(count, seed=None):
+    """Random transaction sequence (QSPI only with EN_NU)"""
+    rng = random.Random(seed)
+    r = []
+    en_nu = 0
+    for i in range(count):
+        k = rng.random()
+        if k < 0.1:
+            pin = rng.choice(Urukul.inputs)
+            width = {"variant": 1, "io_update": 1, "dds_reset": 1,
+                     "profile": 3}.get(pin, 4)
+            r.append(Set(pin, rng.randrange(1 << width)))
+            if pin == "ifc_mode":
+                en_nu = _bit(r[-1].value, 1)
+        elif k < 0.2 and en_nu:
+            # without EN_NU this would be an SPI transfer to CS=4
+            n = rng.randrange(1, 33)
+            r.append(QSPI(n, [rng.randrange(1 << n) for j in range(4)]))
+        else:
+            cs = rng.randrange(8)
+            n = rng.choice([8, 16, 24, 32, 40, 72, rng.randrange(1, 80)])
+            r.append(SPI(cs, n, rng.randrange(1 << n)))
+    return r
+
+
+def main():
+    parser = argparse.ArgumentParser(
+            description="Urukul transaction-level model lockstep check")
+    parser.add_argument("-n", "--count", type=int, default=200)
+    parser.add_argument("-s", "--seed", type=int, default=None)
+    args = parser.parse_args()
+
+    t = transactions(args.count, args.seed)
+    t0 = time.monotonic()
+    model = Urukul()
+    for ti in t:
+        model.apply(ti)
+    t1 = time.monotonic()
+    d = lockstep(t)
+    t2 = time.monotonic()
+    print("model: {:.2g} s, RTL: {:.2g} s for {} transactions".format(
+        t1 - t0, t2 - t1, len(t)))
+    if d is not None:
+        print("divergence at {}: {}".format(d.index, d.transaction))
+        print("  {}: model={} rtl={}".format(d.field, d.model, d.rtl))
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,651 @@
+"""Logic analyzer trace capture and replay
+
+Converts logic analyzer captures of the EEM signals (CSV or VCD) into a
+compact binary transaction trace and replays it against the simulated
+gateware, flagging every transfer where the recorded MISO differs from the
+simulated MISO.
+
+Capture channels are matched (case insensitive) by EEM pair (``eem0_0`` to
+``eem1_7``), PCB net (``A0`` to ``B15``) or function name as in the pin out
+table of :class:`urukul.Urukul` (``SCLK``, ``MOSI``, ``MISO``, ``CS0``, ...,
+``SW0``). Other columns can be mapped with ``--map``, unmapped ones are
+ignored, missing channels read as 0.
+
+Transfers are decoded by the CS table: a frame is the time CS[0:2] is
+constant and non-zero, MOSI and MISO are sampled on rising SCLK edges (the
+values before the edge). With EN_NU, CS2 is NU_CS and frames on it are QSPI
+writes (NU_MOSI[0:3] sampled on rising NU_CLK edges). Changes of the board
+inputs on EEM0/EEM1 (IO_UPDATE, DDS_RESET, SW[0:3], and PROFILE[0:2] with
+EN_PROFILE) become :class:`urukul_tlm.Set` records, delayed to the end of a
+frame in progress. Frames without clock edges are dropped.
+
+The trace file is a header (``"<4sBBH"``: magic, version, IFC_MODE,
+reserved) followed by variable length records: ``"<QBBH"`` (time in ps,
+kind, CS or input index, bit count) and the little endian payload (SPI:
+MOSI, MISO; QSPI: NU_MOSI[0:3]; Set: the value), each ``ceil(n/8)`` bytes.
+:class:`Trace` memory maps it and decodes records lazily.
+"""
+
+from collections import namedtuple
+import argparse
+import csv
+import io
+import itertools
+import mmap
+import random
+import struct
+import time
+
+import urukul_tlm as tlm
+
+
+MAGIC = b"URKT"
+VERSION = 1
+HEADER = struct.Struct("<4sBBH")
+RECORD = struct.Struct("<QBBH")
+SPI, QSPI, SET = range(3)
+
+CHANNELS = ["eem{}_{}".format(i // 8, i % 8) for i in range(16)]
+ALIASES = dict(
+    sclk=0, mosi=1, miso=2, nu_clk=2, cs0=3, cs1=4, cs2=5, nu_cs=5,
+    io_update=6, dds_reset=7, sync_out=7,
+    nu_mosi0=8, nu_mosi1=9, nu_mosi2=10, nu_mosi3=11,
+    profile0=9, profile1=10, profile2=11,
+    sw0=12, sw1=13, sw2=14, sw3=15,
+)
+ALIASES.update({c: i for i, c in enumerate(CHANNELS)})
+ALIASES.update({"a{}".format(i): i for i in range(8)})
+ALIASES.update({"b{}".format(i): i for i in range(8, 16)})
+
+# board inputs (see urukul_tlm.Urukul.inputs) and their channels, LSB first
+INPUTS = dict(io_update=[6], dds_reset=[7], sw=[12, 13, 14, 15],
+              profile=[9, 10, 11])
+
+Record = namedtuple("Record", "time transaction miso")
+Record.__doc__ = """Trace record, ``miso`` only for :class:`urukul_tlm.SPI`"""
+Mismatch = namedtuple("Mismatch", "index time cs n recorded simulated")
+
+
+def channel(name, mapping={}):
+    """Channel index of a capture column name (or ``None``)"""
+    name = name.strip()
+    if name in mapping:
+        name = mapping[name]
+    return ALIASES.get(name.strip().lower())
+
+
+def read_csv(f, mapping={}, period=None):
+    """Samples ``(time_ps, values)`` from a CSV capture
+
+    The first row names the columns. A column starting with "time" is the
+    time in seconds, without one the row index times ``period`` (in ps).
+    Lines starting with ``;`` or ``#`` are skipped.
+    """
+    rows = csv.reader(line for line in f if line[:1] not in ";#")
+    header = next(rows)
+    t_col = None
+    cols = []
+    for i, name in enumerate(header):
+        if name.strip().lower().startswith("time") and t_col is None:
+            t_col = i
+            continue
+        c = channel(name, mapping)
+        if c is not None:
+            cols.append((i, c))
+    if t_col is None and period is None:
+        raise ValueError("no time column and no sample period")
+    values = [0]*16
+    for k, row in enumerate(rows):
+        if not row:
+            continue
+        for i, c in cols:
+            values[c] = int(row[i].strip() in ("1", "H", "h"))
+        if t_col is None:
+            t = k*period
+        else:
+            t = round(float(row[t_col])*1e12)
+        yield t, tuple(values)
+
+
+_timescale = {"s": 10**12, "ms": 10**9, "us": 10**6, "ns": 10**3, "ps": 1,
+              "fs": 10**-3}
+
+
+def read_vcd(f, mapping={}):
+    """Samples ``(time_ps, values)`` from a VCD capture
+
+    Single bit variables are matched by their reference name (the last
+    component of the hierarchical name also matches). One sample is produced
+    per time step with changes.
+    """
+    tokens = (tok for line in f for tok in line.split())
+    codes = dict()
+    scale = 1000  # 1 ns
+    for tok in tokens:
+        if tok == "$timescale":
+            spec = "".join(itertools.takewhile(lambda x: x != "$end",
+                tokens))
+            num = "".join(c for c in spec if c.isdigit())
+            scale = int(num or 1)*_timescale[spec[len(num):]]
+        elif tok == "$var":
+            kind, width, code, name, *_ = itertools.takewhile(
+                    lambda x: x != "$end", tokens)
+            c = channel(name, mapping)
+            if c is not None and int(width) == 1:
+                codes.setdefault(code, []).append(c)
+        elif tok == "$enddefinitions":
+            next(tokens)  # $end
+            break
+    values = [0]*16
+    t = None
+    changed = False
+    for tok in tokens:
+        k = tok[0]
+        if k == "#":
+            if changed and t is not None:
+                yield t, tuple(values)
+            t = round(int(tok[1:])*scale)
+            changed = False
+        elif k in "01xXzZ":
+            for c in codes.get(tok[1:], ()):
+                values[c] = int(k == "1")
+                changed = True
+        elif k in "bBrR":
+            next(tokens)  # vectors and reals are not mapped
+        elif k == "$" and tok in ("$comment", "$dumpvars", "$dumpall",
+                "$dumpon", "$dumpoff"):
+            if tok == "$comment":
+                for tok in tokens:
+                    if tok == "$end":
+                        break
+    if t is not None:
+        yield t, tuple(values)
+
+
+class Decoder:
+    """Decode EEM samples into transactions by the CS table
+
+    :param ifc_mode: IFC_MODE of the board (EN_NU and EN_PROFILE change the
+        decoding)
+    """
+    def __init__(self, ifc_mode=0):
+        self.en_nu = (ifc_mode >> 1) & 1
+        en_profile = (ifc_mode >> 3) & 1 and not self.en_nu
+        self.inputs = [(tlm.Urukul.inputs.index(k), v)
+                       for k, v in INPUTS.items()
+                       if k != "profile" or en_profile]
+        self.v = (0,)*16  # board reset state
+        self.t0 = 0
+        self.cs = 0
+        self.bits = []
+        self.nu = []
+        self.nu_t0 = 0
+        self.pending = []
+
+    def _input(self, v, channels):
+        return sum(v[c] << i for i, c in enumerate(channels))
+
+    def sample(self, t, v):
+        """Process a sample (time and channel values), returns the records
+        ``(time, kind, arg, n, payload)`` completed by it"""
+        r = []
+        p = self.v
+        self.v = v
+        cs = v[3] | v[4] << 1 | v[5] << 2
+        if self.en_nu:
+            # CS2 is NU_CS, NU_CLK on MISO
+            if v[5] and not p[5]:
+                self.nu_t0 = t
+            if v[5] and p[5] and v[2] and not p[2]:
+                self.nu.append(p[8:12])
+            if p[5] and not v[5] and self.nu:
+                r.append(self._qspi())
+            cs &= 3
+        if self.cs and v[0] and not p[0]:
+            self.bits.append((p[1], p[2]))
+        if cs != self.cs:
+            if self.bits:
+                r.append(self._spi())
+            self.bits = []
+            self.cs = cs
+            self.t0 = t
+        for index, channels in self.inputs:
+            value = self._input(v, channels)
+            if value != self._input(p, channels):
+                self.pending.append((t, SET, index, len(channels), [value]))
+        if not self.cs and not (self.en_nu and v[5]):
+            r.extend(self.pending)
+            self.pending.clear()
+        return r
+
+    def _spi(self):
+        n = len(self.bits)
+        mosi = miso = 0
+        for o, i in self.bits:
+            mosi = (mosi << 1) | o
+            miso = (miso << 1) | i
+        if self.en_nu:
+            miso = 0  # MISO is NU_CLK
+        return self.t0, SPI, self.cs, n, [mosi, miso]
+
+    def _qspi(self):
+        mosi = [0]*4
+        for lanes in self.nu:
+            for j in range(4):
+                mosi[j] = (mosi[j] << 1) | lanes[j]
+        n = len(self.nu)
+        self.nu = []
+        return self.nu_t0, QSPI, 0, n, mosi
+
+    def flush(self):
+        """Records of the frames still open at the end of the capture"""
+        r = []
+        if self.bits:
+            r.append(self._spi())
+            self.bits = []
+        if self.nu:
+            r.append(self._qspi())
+        r.extend(self.pending)
+        self.pending.clear()
+        return r
+
+
+class Writer:
+    """Binary trace writer (see the module docstring for the format)"""
+    def __init__(self, f, ifc_mode=0):
+        self.f = f
+        self.count = 0
+        f.write(HEADER.pack(MAGIC, VERSION, ifc_mode, 0))
+
+    def write(self, t, kind, arg, n, payload):
+        if n > 0xffff:
+            raise ValueError("frame of {} bits at {} ps exceeds the record "
+                    "limit of 65535 bits (CS stuck asserted?)".format(n, t))
+        size = (n + 7)//8
+        self.f.write(RECORD.pack(t, kind, arg, n) + b"".join(
+            x.to_bytes(size, "little") for x in payload))
+        self.count += 1
+
+
+def convert(samples, f, ifc_mode=0):
+    """Decode ``samples`` and write the trace to the binary file ``f``,
+    returns the number of records"""
+    decoder = Decoder(ifc_mode)
+    w = Writer(f, ifc_mode)
+    for t, v in samples:
+        for r in decoder.sample(t, v):
+            w.write(*r)
+    for r in decoder.flush():
+        w.write(*r)
+    return w.count
+
+
+class Trace:
+    """Memory mapped binary trace
+
+    Iterating yields :class:`Record` tuples without loading the file.
+    """
+    def __init__(self, filename):
+        self.file = open(filename, "rb")
+        self.mm = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, self.ifc_mode, _ = HEADER.unpack_from(self.mm)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError("not an Urukul trace", filename)
+
+    def __iter__(self):
+        mm = self.mm
+        end = len(mm)
+        offset = HEADER.size
+        while offset < end:
+            t, kind, arg, n = RECORD.unpack_from(mm, offset)
+            offset += RECORD.size
+            size = (n + 7)//8
+            words = [int.from_bytes(mm[offset + i*size:
+                                       offset + (i + 1)*size], "little")
+                     for i in range({SPI: 2, QSPI: 4, SET: 1}[kind])]
+            offset += len(words)*size
+            miso = None
+            if kind == SPI:
+                tr = tlm.SPI(arg, n, words[0])
+                miso = words[1]
+            elif kind == QSPI:
+                tr = tlm.QSPI(n, words)
+            else:
+                tr = tlm.Set(tlm.Urukul.inputs[arg], words[0])
+            yield Record(t, tr, miso)
+
+    def close(self):
+        self.mm.close()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def _check(index, record, miso, en_nu):
+    """Mismatch of the recorded and the simulated MISO or ``None``
+
+    Only CFG and ATT reads are checked (the DDS are not simulated). The
+    undefined first CFG bit is ignored.
+    """
+    t = record.transaction
+    if en_nu or t.cs not in (1, 2):
+        return None
+    mask = (1 << t.n) - 1
+    if t.cs == 1:
+        mask >>= 1
+    if record.miso & mask != miso & mask:
+        return Mismatch(index, record.time, t.cs, t.n, record.miso & mask,
+                miso & mask)
+
+
+def _inputs(trace, inputs):
+    return [tlm.Set("ifc_mode", trace.ifc_mode)] + [
+        tlm.Set(k, v) for k, v in inputs.items()]
+
+
+def replay_model(trace, records, report, **inputs):
+    """Replay ``records`` of ``trace`` on the transaction-level model
+
+    ``report`` is called with every :class:`Mismatch`. Returns the number of
+    records replayed.
+    """
+    model = tlm.Urukul()
+    for t in _inputs(trace, inputs):
+        model.apply(t)
+    count = 0
+    for i, r in enumerate(records):
+        miso = model.apply(r.transaction)
+        if r.miso is not None:
+            m = _check(i, r, miso, model.en_nu)
+            if m is not None:
+                report(m)
+        count += 1
+    return count
+
+
+def _replay(tb, records, report, setup, count):
+    inputs = tlm.rtl_inputs(tb)
+    en_nu = 0
+    for t in itertools.chain(setup, records):
+        if isinstance(t, Record):
+            r, t = t, t.transaction
+        else:
+            r = None
+        if isinstance(t, tlm.Set) and t.pin == "ifc_mode":
+            en_nu = (t.value >> 1) & 1
+        miso = yield from tlm.rtl_apply(tb, t, inputs)
+        if r is None:
+            continue
+        if r.miso is not None:
+            m = _check(count[0], r, miso, en_nu)
+            if m is not None:
+                report(m)
+        count[0] += 1
+
+
+def replay(trace, records, report, options={}, **inputs):
+    """Replay ``records`` of ``trace`` on the compiled RTL simulation
+
+    ``options`` are passed to :class:`urukul.Urukul`. ``report`` is called
+    with every :class:`Mismatch`. Returns the number of records replayed.
+    """
+    from urukul import Urukul
+    from urukul_cpld import Platform
+    from urukul_fastsim import FastSimulator
+    from urukul_sim import TB, sim_kwargs
+
+    p = Platform()
+    dut = Urukul(p, **options)
+    tb = TB(p, dut)
+    count = [0]
+    sim = FastSimulator(tb, [_replay(tb, records, report,
+        _inputs(trace, inputs), count)], **sim_kwargs(dut))
+    sim.run()
+    return count[0]
+
+
+# synthetic capture channels
+NAMES = ["sclk", "mosi", "miso", "cs0", "cs1", "cs2", "io_update",
+         "dds_reset", "nu_mosi0", "nu_mosi1", "nu_mosi2", "nu_mosi3", "sw0",
+         "sw1", "sw2", "sw3"]
+
+
+def _capture(transactions, model):
+    """Channel states of a synthetic capture of ``transactions`` (SPI, QSPI
+    with EN_NU, Set), one per half SCLK period"""
+    state = dict.fromkeys(NAMES, 0)
+
+    def row(**kw):
+        state.update(kw)
+        return dict(state)
+
+    yield row()
+    for tr in transactions:
+        if isinstance(tr, tlm.Set):
+            model.apply(tr)
+            yield row(**{k: (tr.value >> i) & 1
+                for i, k in enumerate(["sw0", "sw1", "sw2", "sw3"]
+                    if tr.pin == "sw" else [tr.pin])})
+            continue
+        if isinstance(tr, tlm.QSPI):
+            model.apply(tr)
+            yield row(cs2=1)  # NU_CS
+            for i in range(tr.n - 1, -1, -1):
+                # NU_CLK on MISO
+                yield row(miso=0, **{"nu_mosi{}".format(j):
+                    (tr.mosi[j] >> i) & 1 for j in range(4)})
+                yield row(miso=1)
+            yield row(miso=0)
+            yield row(cs2=0)
+            continue
+        miso = model.apply(tr)
+        if model.en_nu:
+            miso = 0  # MISO is NU_CLK
+        yield row(cs0=tr.cs & 1, cs1=(tr.cs >> 1) & 1, cs2=tr.cs >> 2)
+        for i in range(tr.n - 1, -1, -1):
+            yield row(sclk=0, mosi=(tr.mosi >> i) & 1, miso=(miso >> i) & 1)
+            yield row(sclk=1)
+        yield row(sclk=0)
+        yield row(cs0=0, cs1=0, cs2=0)
+    yield row()
+
+
+def synthesize(transactions, f, half_period=10000, **inputs):
+    """Write a CSV capture of ``transactions`` (SPI, QSPI and Set) to ``f``
+
+    MISO is taken from the transaction-level model. For round trip tests of
+    the converter.
+    """
+    w = csv.writer(f)
+    w.writerow(["Time [s]"] + NAMES)
+    for i, state in enumerate(_capture(transactions, tlm.Urukul(**inputs))):
+        w.writerow(["{:.12g}".format(i*half_period*1e-12)] +
+                   [state[k] for k in NAMES])
+
+
+def synthesize_vcd(transactions, filename, half_period=1, timescale="10ns",
+        **inputs):
+    """Write a VCD capture of ``transactions`` with
+    :class:`urukul_wave.WaveWriter` (``half_period`` in ``timescale``
+    units), see :func:`synthesize`"""
+    from migen import Signal
+    from urukul_wave import WaveWriter
+
+    signals = {k: Signal(name=k) for k in NAMES}
+    wave = WaveWriter(filename, timescale=timescale)
+    wave.select(list(signals.values()))
+    try:
+        for state in _capture(transactions, tlm.Urukul(**inputs)):
+            for k, v in state.items():
+                wave.set(signals[k], v)
+            wave.delay(half_period)
+    finally:
+        wave.close()
+
+
+def _round_trip(transactions, ifc_mode=0, **inputs):
+    """Convert a synthetic CSV and VCD capture of ``transactions``, check
+    the decoded records and replay them on the RTL"""
+    import os
+    import tempfile
+
+    with tempfile.TemporaryDirectory() as tmp:
+        capture = io.StringIO()
+        synthesize(transactions, capture, ifc_mode=ifc_mode, **inputs)
+        capture.seek(0)
+        vcd = os.path.join(tmp, "capture.vcd")
+        synthesize_vcd(transactions, vcd, ifc_mode=ifc_mode, **inputs)
+        records = []
+        for name, samples in ("csv", read_csv(capture)), ("vcd", None):
+            filename = os.path.join(tmp, name + ".trace")
+            with open(filename, "wb") as f:
+                if samples is None:
+                    with open(vcd) as v:
+                        convert(read_vcd(v), f, ifc_mode)
+                else:
+                    convert(samples, f, ifc_mode)
+            with Trace(filename) as trace:
+                got = [r.transaction for r in trace]
+                assert got == transactions, "{} decode mismatch".format(name)
+                records.append([(r.time, r.miso) for r in trace])
+                mismatches = []
+                replay(trace, iter(trace), mismatches.append, **inputs)
+                assert not mismatches, mismatches[0]
+        # same times: the VCD timescale (10 ns) matches the CSV period
+        assert records[0] == records[1], "CSV/VCD record mismatch"
+
+
+def selftest(count, seed=None):
+    """Round trips of random CFG/ATT transfers and SW changes, and of CFG
+    transfers and QSPI writes with EN_NU, through synthetic CSV and VCD
+    captures, the converter and the RTL replay"""
+    rng = random.Random(seed)
+    transactions = []
+    sw = 0
+    for i in range(count):
+        if rng.random() < .2:
+            sw ^= 1 << rng.randrange(4)  # only changes are recorded
+            transactions.append(tlm.Set("sw", sw))
+        else:
+            n = rng.choice([8, 24, 32, rng.randrange(1, 48)])
+            transactions.append(tlm.SPI(rng.choice([1, 2]), n,
+                rng.randrange(1 << n)))
+    _round_trip(transactions, pll_lock=0xf)
+
+    transactions = []
+    for i in range(max(count//4, 1)):
+        if rng.random() < .5:
+            n = rng.choice([16, 32, rng.randrange(1, 40)])
+            transactions.append(tlm.QSPI(n,
+                [rng.randrange(1 << n) for j in range(4)]))
+        else:
+            # CS2 is NU_CS
+            transactions.append(tlm.SPI(1, 24, rng.randrange(1 << 24)))
+    _round_trip(transactions, ifc_mode=2)
+
+    # frames longer than a record are rejected
+    w = Writer(io.BytesIO())
+    try:
+        w.write(0, SPI, 1, 1 << 16, [0, 0])
+    except ValueError:
+        pass
+    else:
+        raise AssertionError("no error for an oversized frame")
+
+
+def _assignments(values):
+    r = dict()
+    for kv in values:
+        k, v = kv.split("=", 1)
+        r[k] = v
+    return r
+
+
+def main():
+    parser = argparse.ArgumentParser(
+            description="Urukul logic analyzer trace converter and replay")
+    sub = parser.add_subparsers(dest="command", required=True)
+    p = sub.add_parser("convert", help="capture (CSV/VCD) to binary trace")
+    p.add_argument("capture")
+    p.add_argument("trace")
+    p.add_argument("--ifc-mode", type=lambda x: int(x, 0), default=0,
+            help="board IFC_MODE (EN_NU/EN_PROFILE decoding)")
+    p.add_argument("--map", action="append", default=[],
+            metavar="COLUMN=CHANNEL", help="map a capture column to a "
+            "channel (e.g. 'Channel 0=sclk', repeatable)")
+    p.add_argument("--period", type=float, default=None,
+            help="sample period in s for CSV without a time column")
+    p = sub.add_parser("dump", help="print the trace records")
+    p.add_argument("trace")
+    p = sub.add_parser("replay", help="replay the trace and report MISO "
+            "mismatches")
+    p.add_argument("trace")
+    p.add_argument("--tlm", action="store_true",
+            help="replay on the transaction-level model (fast)")
+    p.add_argument("--skip", type=int, default=0,
+            help="skip this many records (inputs are not restored)")
+    p.add_argument("--limit", type=int, default=None,
+            help="replay at most this many records")
+    p.add_argument("--set", action="append", default=[],
+            metavar="INPUT=VALUE", help="board input not in the capture "
+            "(e.g. pll_lock=15, repeatable)")
+    p.add_argument("--option", action="append", default=[],
+            metavar="NAME", help="enable a gateware option (repeatable)")
+    p = sub.add_parser("selftest", help="synthetic capture round trip")
+    p.add_argument("-n", "--count", type=int, default=100)
+    p.add_argument("-s", "--seed", type=int, default=None)
+    args = parser.parse_args()
+
+    if args.command == "convert":
+        mapping = _assignments(args.map)
+        period = args.period and round(args.period*1e12)
+        with open(args.capture) as f, open(args.trace, "wb") as o:
+            if args.capture.endswith(".vcd"):
+                samples = read_vcd(f, mapping)
+            else:
+                samples = read_csv(f, mapping, period)
+            n = convert(samples, o, args.ifc_mode)
+        print("{} records".format(n))
+    elif args.command == "dump":
+        with Trace(args.trace) as trace:
+            for r in trace:
+                print(r.time, r.transaction, "" if r.miso is None
+                      else "miso={:#x}".format(r.miso))
+    elif args.command == "replay":
+        inputs = {k: int(v, 0) for k, v in _assignments(args.set).items()}
+        for k in inputs:
+            if k not in tlm.Urukul.inputs:
+                parser.error("unknown input {}".format(k))
+        mismatches = [0]
+
+        def report(m):
+            mismatches[0] += 1
+            print("MISMATCH #{} t={} ps CS={} n={}: recorded={:#x} "
+                  "simulated={:#x}".format(m.index + args.skip, m.time, m.cs,
+                      m.n, m.recorded, m.simulated))
+
+        t0 = time.monotonic()
+        with Trace(args.trace) as trace:
+            records = itertools.islice(trace, args.skip,
+                    None if args.limit is None else args.skip + args.limit)
+            if args.tlm:
+                n = replay_model(trace, records, report, **inputs)
+            else:
+                n = replay(trace, records, report,
+                        {k: True for k in args.option}, **inputs)
+        dt = time.monotonic() - t0
+        print("{} records in {:.3g} s ({:.3g}/s), {} mismatches".format(
+            n, dt, n/dt if dt else 0, mismatches[0]))
+        if mismatches[0]:
+            raise SystemExit(1)
+    elif args.command == "selftest":
+        selftest(args.count, args.seed)
+        print("ok")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,304 @@
+"""Exhaustive truth table check of the SPI routing
+
+The chip select decode, DDS routing, MISO selection and the clock divider
+configuration in :class:`urukul.Urukul` are combinatorial in the EEM
+inputs, IFC_MODE/VARIANT, a few CFG fields and the device serial outputs.
+The comb logic is lowered to a hash-consed bit graph
+(:class:`urukul_batch.BitLowering`) with those signals as free inputs and
+evaluated for every combination of the inputs of each group of outputs at
+once: lane ``k`` of the bit planes is input combination ``k``, shared
+subexpressions are evaluated once per group.
+
+The reference is computed from the CS, IFC_MODE and CFG.DIV tables in the
+:class:`urukul.Urukul` docstring. An output depending on an input that is
+not declared for its group is an error as well.
+"""
+
+from collections import namedtuple
+import argparse
+import time
+
+from migen import *
+from migen.fhdl.specials import Tristate
+from migen.fhdl.tools import list_targets, lower_specials
+
+from urukul_batch import BitLowering
+from urukul_coverage import doc_table, cs_table, ifc_mode_table
+
+
+Tables = namedtuple("Tables", "cs ifc_mode div")
+Tables.__doc__ = """Docstring tables: ``{cs: chip}``, ``{name: bit}``,
+``{(div, en_9910): clk_div}`` (``None`` for Z)"""
+
+
+def div_table():
+    """``[(div, en_9910, clk_div)]`` from the CFG.DIV table of
+    :class:`urukul.Urukul`, ``en_9910`` is ``None`` for X and ``clk_div``
+    ``None`` for Z"""
+    from urukul import Urukul
+    return [(int(div), None if en == "X" else int(en),
+             None if pin == "Z" else int(pin))
+            for div, en, _, pin in doc_table(Urukul.__doc__, "CFG.DIV")]
+
+
+def tables():
+    div = dict()
+    for d, en, pin in div_table():
+        for e in ([en] if en is not None else [0, 1]):
+            div[d, e] = pin
+    return Tables(dict(cs_table()), {name: bit for bit, name in
+        ifc_mode_table()}, div)
+
+
+def _bit(x, i):
+    return (x >> i) & 1
+
+
+def _modes(x, t):
+    """EN_9910 and EN_NU (IFC_MODE[0] | VARIANT on Urukul/v1.1)"""
+    en_9910 = _bit(x["ifc_mode"], t.ifc_mode["EN_9910"]) | x["variant"]
+    en_nu = _bit(x["ifc_mode"], t.ifc_mode["EN_NU"])
+    return en_9910, en_nu
+
+
+def _chip(x, t):
+    """Selected chip, CS2 is unavailable with EN_NU"""
+    en_9910, en_nu = _modes(x, t)
+    return t.cs[x["cs"] & 3 if en_nu else x["cs"]]
+
+
+def _spi_dds(x, t, i):
+    chip = _chip(x, t)
+    return chip == "DDS{}".format(i) or (chip.startswith("Multiple DDS") and
+            _bit(x["mask_nu"], i))
+
+
+def _nu(x, t, i):
+    """DDS ``i`` is driven from QSPI"""
+    en_9910, en_nu = _modes(x, t)
+    return en_nu and not _bit(x["mask_nu"], i)
+
+
+def spec_select(x, t):
+    r = {"sr.sel": int(_chip(x, t) == "CFG")}
+    for i in range(4):
+        cs = _bit(x["cs"], 2) if _nu(x, t, i) else _spi_dds(x, t, i)
+        r["dds{}.cs_n".format(i)] = int(not cs)
+    return r
+
+
+def spec_clock(x, t):
+    r = {"att.clk": int(_chip(x, t) == "ATT") & x["sck"]}
+    for i in range(4):
+        r["dds{}.sck".format(i)] = x["nu_clk"] if _nu(x, t, i) else x["sck"]
+    return r
+
+
+def spec_data(x, t):
+    return {"dds{}.sdi".format(i): _bit(x["nu_mosi"], i) if _nu(x, t, i)
+            else x["mosi"] for i in range(4)}
+
+
+def spec_control(x, t):
+    en_9910, en_nu = _modes(x, t)
+    r = dict()
+    for i in range(4):
+        r["dds{}.io_update".format(i)] = (x["cfg_io_update"]
+                if _bit(x["mask_nu"], i) else x["io_update"])
+        r["dds{}.reset".format(i)] = x["cfg_rst"] | (
+                (not en_9910) & x["dds_reset"])
+    return r
+
+
+def spec_miso(x, t):
+    en_9910, en_nu = _modes(x, t)
+    chip = _chip(x, t)
+    if chip == "None":
+        miso = 0
+    elif chip == "CFG":
+        miso = x["sr_sdo"]
+    elif chip == "ATT":
+        miso = _bit(x["att_sdo"], 3)  # end of the chain
+    elif chip.startswith("Multiple DDS"):
+        miso = _bit(x["dds_sdo"], 0)
+    else:
+        miso = _bit(x["dds_sdo"], int(chip[3:]))
+    return {"miso": miso, "miso.oe": int(not en_nu)}
+
+
+def spec_clk_div(x, t):
+    en_9910, en_nu = _modes(x, t)
+    pin = t.div[x["div"], en_9910]
+    return {"clk_div.oe": int(pin is not None), "clk_div": pin}
+
+
+Group = namedtuple("Group", "name inputs spec")
+Group.__doc__ = """Outputs of ``spec(x, tables)`` (``None`` is don't care),
+checked over all combinations of ``inputs``"""
+
+GROUPS = [
+    Group("select", ["cs", "ifc_mode", "variant", "mask_nu"], spec_select),
+    Group("clock", ["cs", "ifc_mode", "variant", "mask_nu", "sck",
+        "nu_clk"], spec_clock),
+    Group("data", ["ifc_mode", "variant", "mask_nu", "mosi", "nu_mosi"],
+        spec_data),
+    Group("control", ["ifc_mode", "variant", "mask_nu", "cfg_io_update",
+        "io_update", "cfg_rst", "dds_reset"], spec_control),
+    Group("miso", ["cs", "ifc_mode", "variant", "sr_sdo", "att_sdo",
+        "dds_sdo"], spec_miso),
+    Group("clk_div", ["ifc_mode", "variant", "div"], spec_clk_div),
+]
+
+
+Mismatch = namedtuple("Mismatch", "group output inputs expect rtl")
+
+
+class Router:
+    """Comb logic of :class:`urukul.Urukul` as functions of the inputs
+
+    ``inputs`` maps names to the bit slots of the free input signals,
+    ``outputs`` output names to their graph nodes. Bits that are not
+    inputs and not driven are replaced by their reset value.
+    """
+    def __init__(self):
+        from urukul import Urukul
+        from urukul_cpld import Platform
+        from urukul_sim import SimTristate, SimInstance
+
+        p = Platform()
+        dut = Urukul(p)
+        fragment = dut.get_fragment()
+        clk_div = [s for s in fragment.specials if isinstance(s, Tristate)
+                   and s.target is p.lookup_request("clk").div][0]
+        lower_specials({Tristate: SimTristate, Instance: SimInstance},
+                fragment)
+
+        eem = [e.i for e in dut.eem]
+        dds = [p.lookup_request("dds", i) for i in range(4)]
+        att = p.lookup_request("att")
+        cfg = dut.cfg.data
+        self.lowering = lw = BitLowering(fragment.clock_domains)
+        inputs = dict(
+            cs=Cat(eem[3], eem[4], eem[5]),
+            mosi=eem[1],
+            nu_clk=eem[2],
+            io_update=eem[6],
+            dds_reset=eem[7],
+            nu_mosi=Cat(eem[8:12]),
+            sck=dut.cd_sck1.clk,
+            ifc_mode=p.lookup_request("ifc_mode"),
+            variant=p.lookup_request("variant"),
+            mask_nu=cfg.mask_nu,
+            cfg_io_update=cfg.io_update,
+            cfg_rst=cfg.rst,
+            div=cfg.div,
+            sr_sdo=dut.sr.sdo,
+            att_sdo=att.s_out,
+            dds_sdo=Cat(d.sdo for d in dds),
+        )
+        self.inputs = {k: lw.lvalue(v) for k, v in inputs.items()}
+        outputs = {
+            "sr.sel": dut.sr.sel,
+            "att.clk": att.clk,
+            "miso": dut.eem[2].o,
+            "miso.oe": dut.eem[2].oe,
+            "clk_div": clk_div.o,
+            "clk_div.oe": clk_div.oe,
+        }
+        for i, d in enumerate(dds):
+            for k in "cs_n sck sdi io_update reset".split():
+                outputs["dds{}.{}".format(i, k)] = getattr(d, k)
+        cut = set()
+        for slots in self.inputs.values():
+            cut.update(slots)
+        comb = lw.comb(fragment.comb, cut)
+        # undriven bits are constant
+        driven = set(comb) | cut
+        for stmts in fragment.sync.values():
+            for t in list_targets(stmts):
+                driven.update(lw.lvalue(t))
+        const = dict()
+        for signal in lw.signals:
+            n = lw.slots[signal]
+            for i in range(len(signal)):
+                if n + i not in driven:
+                    const[n + i] = lw.graph.const(
+                            (signal.reset.value >> i) & 1)
+        self.outputs = dict()
+        memo = dict()
+        for k, v in outputs.items():
+            slot, = lw.lvalue(v)
+            self.outputs[k] = lw.graph.substitute(
+                    comb.get(slot, lw.graph.var(slot)), const, memo)
+
+    def check(self, group, tables):
+        """Evaluate ``group`` exhaustively, returns the :class:`Mismatch`
+        list and the number of input combinations"""
+        g = self.lowering.graph
+        nodes = {k: self.outputs[k] for k in group.spec(
+            dict.fromkeys(self.inputs, 0), tables)}
+        slots = sorted(set(s for k in group.inputs for s in self.inputs[k]))
+        memo = dict()
+        for k, n in nodes.items():
+            extra = g.support(n, memo) - set(slots)
+            if extra:
+                raise ValueError("undeclared inputs", group.name, k,
+                        sorted(self.lowering.name(s) for s in extra))
+
+        lanes = 1 << len(slots)
+        mask = (1 << lanes) - 1
+        planes = dict()
+        for j, s in enumerate(slots):
+            # lanes with bit j of the lane index set
+            period = (1 << (1 << (j + 1))) - 1
+            planes[s] = (((1 << (1 << j)) - 1) << (1 << j))*(mask//period)
+        rtl = dict(zip(nodes, g.evaluate(list(nodes.values()),
+            planes.__getitem__, mask)))
+
+        index = {k: [slots.index(s) for s in self.inputs[k]]
+                 for k in group.inputs}
+        mismatches = []
+        for lane in range(lanes):
+            x = dict.fromkeys(self.inputs, 0)
+            for k, bits in index.items():
+                x[k] = sum(((lane >> j) & 1) << i for i, j in enumerate(bits))
+            for k, v in group.spec(x, tables).items():
+                r = (rtl[k] >> lane) & 1
+                if v is not None and r != v:
+                    mismatches.append(Mismatch(group.name, k,
+                        {k: x[k] for k in group.inputs}, v, r))
+        return mismatches, lanes
+
+
+def main():
+    parser = argparse.ArgumentParser(
+            description="Exhaustive Urukul routing truth table check")
+    parser.add_argument("group", nargs="*",
+            help="groups to check (default: all of {})".format(
+                ", ".join(g.name for g in GROUPS)))
+    args = parser.parse_args()
+
+    groups = {g.name: g for g in GROUPS}
+    for name in args.group:
+        if name not in groups:
+            parser.error("unknown group {}".format(name))
+
+    t0 = time.monotonic()
+    router = Router()
+    t = tables()
+    print("lowered: {:.3f} s".format(time.monotonic() - t0))
+    failed = 0
+    for name in args.group or groups:
+        t0 = time.monotonic()
+        mismatches, lanes = router.check(groups[name], t)
+        print("{}: {} combinations, {} mismatches, {:.3f} s".format(
+            name, lanes, len(mismatches), time.monotonic() - t0))
+        for m in mismatches[:10]:
+            print("FAIL", m)
+        failed += len(mismatches)
+    if failed:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
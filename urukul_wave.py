@@ -0,0 +1,187 @@
+"""Filtered, streaming waveform output
+
+:class:`WaveWriter` is a replacement for the migen VCD writer for the
+compiled simulator (:mod:`urukul_fastsim`):
+
+  - only an allow-list of signals is traced (signals, records or glob
+    patterns on the VCD names); the simulator only diffs those
+  - dumping can be restricted to time windows and to windows opened by
+    trigger conditions (``$dumpoff``/``$dumpon``)
+  - the VCD is streamed through a bounded buffer into the output file,
+    compressed according to the file name (``.gz``, ``.xz``, ``.bz2``)
+
+For throughput runs, pass no writer at all.
+"""
+
+from fnmatch import fnmatchcase
+import bz2
+import gzip
+import lzma
+
+from migen import Record
+from migen.fhdl.namer import build_namespace
+from migen.sim.vcd import vcd_codes
+
+
+_openers = {".gz": gzip.open, ".xz": lzma.open, ".bz2": bz2.open}
+
+
+def _open(filename):
+    for suffix, opener in _openers.items():
+        if filename.endswith(suffix):
+            return opener(filename, "wt")
+    return open(filename, "w")
+
+
+class WaveWriter:
+    """Streaming VCD writer
+
+    :param filename: output file; the suffix selects compression
+    :param signals: allow-list of :class:`Signal`, :class:`Record` or glob
+        patterns matched against the signal names. ``None`` traces all.
+    :param windows: ``(start, stop)`` time windows to dump. ``None`` dumps
+        from the start (unless triggers are given).
+    :param triggers: ``(signal, value, duration)``: dump for ``duration``
+        after ``signal`` changes to ``value``. Trigger signals are traced.
+    :param buffer: number of characters buffered before writing out
+    :param timescale: VCD time unit (simulation time unit, the clock periods
+        of :mod:`urukul_sim` are in ns)
+    """
+    def __init__(self, filename, signals=None, windows=None, triggers=(),
+            buffer=1 << 16, timescale="1ns"):
+        self.filename = filename
+        self.timescale = timescale
+        self.patterns = signals
+        self.windows = sorted(windows or [])
+        self.triggers = {}
+        for signal, value, duration in triggers:
+            self.triggers.setdefault(signal, []).append((value, duration))
+        self.always = windows is None and not self.triggers
+        self.buffer = buffer
+        self.lines = []
+        self.size = 0
+        self.t = 0
+        self.stamp = None
+        self.until = -1
+        self.on = None
+        self.values = dict()
+        self.codes = None
+        self.file = None
+
+    def select(self, signals):
+        """Resolve the allow-list against the simulated ``signals``
+
+        Writes the VCD header and returns the traced signals.
+        """
+        ns = build_namespace(signals)
+        if self.patterns is None:
+            traced = list(signals)
+        else:
+            wanted = set()
+            patterns = []
+            for p in self.patterns:
+                if isinstance(p, str):
+                    patterns.append(p)
+                elif isinstance(p, Record):
+                    wanted.update(p.flatten())
+                else:
+                    wanted.add(p)
+            traced = [s for s in signals if s in wanted or any(
+                fnmatchcase(ns.get_name(s), p) for p in patterns)]
+        known = set(traced)
+        traced += [s for s in self.triggers if s not in known]
+        codes = vcd_codes()
+        self.codes = {s: next(codes) for s in traced}
+        self.values = {s: s.reset.value for s in traced}
+
+        self.file = _open(self.filename)
+        self.file.write("$timescale {} $end\n".format(self.timescale))
+        for s, code in self.codes.items():
+            self.file.write("$var wire {} {} {} $end\n".format(
+                len(s), code, ns.get_name(s)))
+        self.file.write("$enddefinitions $end\n")
+        return traced
+
+    def _write(self, line):
+        self.lines.append(line)
+        self.size += len(line)
+        if self.size >= self.buffer:
+            self.flush()
+
+    def flush(self):
+        self.file.write("".join(self.lines))
+        self.lines.clear()
+        self.size = 0
+
+    def _value(self, signal, value):
+        if len(signal) > 1:
+            if value < 0:
+                value += 1 << len(signal)
+            return "b{:b} {}\n".format(value, self.codes[signal])
+        return "{}{}\n".format(value, self.codes[signal])
+
+    def _timestamp(self):
+        if self.stamp != self.t:
+            self._write("#{}\n".format(self.t))
+            self.stamp = self.t
+
+    def _active(self):
+        if self.always or self.t < self.until:
+            return True
+        for start, stop in self.windows:
+            if start <= self.t < stop:
+                return True
+            if start > self.t:
+                break
+        return False
+
+    def _update(self):
+        on = self._active()
+        if on == self.on:
+            return
+        self._timestamp()
+        if self.on is None:
+            self._write("$dumpvars\n")
+            for s, v in self.values.items():
+                self._write(self._value(s, v))
+            self._write("$end\n")
+        self.on, was = on, self.on
+        if on:
+            if was is None:
+                return
+            self._write("$dumpon\n")
+            for s, v in self.values.items():
+                self._write(self._value(s, v))
+        else:
+            self._write("$dumpoff\n")
+            for s, code in self.codes.items():
+                self._write("x{}\n".format(code) if len(s) == 1 else
+                        "bx {}\n".format(code))
+        self._write("$end\n")
+
+    def set(self, signal, value):
+        if signal not in self.codes or self.values[signal] == value:
+            return
+        self.values[signal] = value
+        on = self.on
+        for trigger, duration in self.triggers.get(signal, ()):
+            if value == trigger:
+                self.until = max(self.until, self.t + duration)
+                # before the first delay, the dump starts at time 0
+                if on is not None:
+                    self._update()
+        if on:
+            self._timestamp()
+            self._write(self._value(signal, value))
+
+    def delay(self, delay):
+        if self.on is None:
+            self._update()
+        self.t += delay
+        self._update()
+
+    def close(self):
+        if self.file is not None:
+            self.flush()
+            self.file.close()
+            self.file = None